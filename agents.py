@@ -1,17 +1,14 @@
 from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Type
+import json
 
 from pydantic_ai import Agent
 from pydantic_ai.models.groq import GroqModelSettings, GroqModel, GroqModelName
 from pydantic_ai.providers.groq import GroqProvider
-from pydantic import BaseModel, Field
-from supabase import Client, create_client
-import groq
-import logfire
-from settings import Settings
-
-settings = Settings()
-logfire.configure(token=settings.logfire_write_token)
-logfire.instrument_pydantic_ai()
+from pydantic import BaseModel, Field, create_model
+from cache import digest
+from scheduler import BATCH, prioritized
 
 # Groq Model Definition
 groq_settings = GroqModelSettings(
@@ -24,17 +21,8 @@ groq_model_name: GroqModelName = "llama-3.3-70b-versatile"
 
 report_model_name : GroqModelName = "deepseek-r1-distill-llama-70b"
 
-async_groq_client = groq.AsyncGroq(api_key=settings.groq_api_key)
-
-groq_model = GroqModel(
-    model_name=groq_model_name,
-    provider=GroqProvider(groq_client=async_groq_client),
-)
-
-report_model = GroqModel(
-    model_name=report_model_name,
-    provider=GroqProvider(groq_client=async_groq_client),
-)
+# Small and fast, for chat memory compaction
+summary_model_name : GroqModelName = "llama-3.1-8b-instant"
 
 class Form(BaseModel):
     responder_name: str = Field(description="The full name of the responder attending to the request, if given, else return 'null'")
@@ -43,64 +31,97 @@ class Form(BaseModel):
     issue_summary: str = Field(description="Detailed description of 50 lines of the issue being reported by the caller")
     caller_sentiment: str = Field(description="The emotion of the customer to be given in one word out of the list: [happy, sad, angry, frustrated]")
 
-class Questionary(BaseModel):
-    product_sold: str = Field(description="What did the agent sell out of the list: [TV, Wireless Connection, Internet]")
+def answer_field(index: int) -> str:
+    return f"answer_{index}"
+
+def build_extraction_model(questions: List[Dict[str, Any]]) -> Type[BaseModel]:
+    """
+    The Form fields plus one answer field per question, for a single extraction call.
+    Every field is optional so a partial answer still validates; the caller retries
+    just the fields that came back empty.
+    """
+    fields: Dict[str, Any] = {
+        name: (Optional[str], Field(None, description=info.description))
+        for name, info in Form.model_fields.items()
+    }
+    for index, question in enumerate(questions, start=1):
+        fields[answer_field(index)] = (Optional[str], Field(None, description=f"Answer to: {question['question_text']}"))
+    return create_model("CallExtraction", **fields)
+
+def build_retry_model(model: Type[BaseModel], names: List[str]) -> Type[BaseModel]:
+    """A model with only the named fields of `model`, all required."""
+    return create_model(
+        "MissingFields",
+        **{name: (str, Field(description=model.model_fields[name].description)) for name in names},
+    )
+
+@lru_cache(maxsize=None)
+def load_prompt(name: str) -> str:
+    with open(f"prompts/{name}.txt", "r", encoding="utf-8") as file:
+        return file.read()
 
 @dataclass
-class Deps:
-    supabase_url: str = settings.supabase_url
-    supabase_key: str = settings.supabase_key
-    supabase_client: Client = create_client(supabase_key=supabase_key, supabase_url=supabase_url)
-    
-deps = Deps()
-
-with open("prompts/call_log_agent_prompt.txt", "r", encoding="utf-8") as file:
-    call_log_agent_prompt = file.read()
-
-with open("prompts/report_agent_prompt.txt", "r", encoding="utf-8") as file:
-    report_agent_prompt = file.read()
-
-with open("prompts/database_agent_prompt.txt", "r", encoding="utf-8") as file:
-    database_agent_prompt = file.read()
-
-with open("prompts/chat_agent_prompt.txt", "r", encoding="utf-8") as file:
-    chat_agent_prompt = file.read()
-
-with open("prompts/questionary_agent_prompt.txt", "r", encoding="utf-8")as file:
-    questionary_agent_prompt = file.read()
-
-call_log_agent = Agent(
-    model=groq_model,
-    model_settings=groq_settings,
-    system_prompt=call_log_agent_prompt,
-    retries=3,
-)
-
-report_agent = Agent(
-    model=report_model,
-    model_settings=groq_settings,
-    system_prompt=report_agent_prompt,
-    retries=3,
-)
-
-database_agent = Agent(
-    model=groq_model,
-    model_settings=groq_settings,
-    system_prompt=database_agent_prompt,
-    retries=3,
-    output_type=Form
-)
-
-chat_agent = Agent(
-    model=groq_model,
-    model_settings=groq_settings,
-    system_prompt=chat_agent_prompt,
-    retries=3
-)
-
-questionary_agent = Agent(
-    model=groq_model,
-    model_settings=groq_settings,
-    system_prompt=questionary_agent_prompt,
-    retries=3
-)
\ No newline at end of file
+class Agents:
+    call_log: Agent
+    report: Agent
+    # Output type is built per organisation at run time, see build_extraction_model
+    extraction: Agent
+    chat: Agent
+    summary: Agent
+    # Cache versions: a change to an agent's model, settings or prompt invalidates only that agent's results
+    versions: Dict[str, str]
+
+    async def summarize_conversation(self, previous_summary: str, turns: str) -> str:
+        prompt = f"Earlier summary:\n{previous_summary or '(none)'}\n\nTurns since then:\n{turns}"
+        # Runs in the background after a chat turn, so it shouldn't compete with the next one
+        with prioritized(BATCH):
+            response = await self.summary.run(user_prompt=prompt)
+        return response.output
+
+def build_agents(groq_client) -> Agents:
+    """Every agent, on models that share one Groq client."""
+    groq_model = GroqModel(model_name=groq_model_name, provider=GroqProvider(groq_client=groq_client))
+    report_model = GroqModel(model_name=report_model_name, provider=GroqProvider(groq_client=groq_client))
+    summary_model = GroqModel(model_name=summary_model_name, provider=GroqProvider(groq_client=groq_client))
+
+    call_log_agent_prompt = load_prompt("call_log_agent_prompt")
+    report_agent_prompt = load_prompt("report_agent_prompt")
+    extraction_agent_prompt = load_prompt("extraction_agent_prompt")
+
+    return Agents(
+        call_log=Agent(
+            model=groq_model,
+            model_settings=groq_settings,
+            system_prompt=call_log_agent_prompt,
+            retries=3,
+        ),
+        report=Agent(
+            model=report_model,
+            model_settings=groq_settings,
+            system_prompt=report_agent_prompt,
+            retries=3,
+        ),
+        extraction=Agent(
+            model=groq_model,
+            model_settings=groq_settings,
+            system_prompt=extraction_agent_prompt,
+            retries=3,
+        ),
+        chat=Agent(
+            model=groq_model,
+            model_settings=groq_settings,
+            system_prompt=load_prompt("chat_agent_prompt"),
+            retries=3
+        ),
+        summary=Agent(
+            model=summary_model,
+            model_settings=GroqModelSettings(temperature=0.2),
+            system_prompt=load_prompt("summary_agent_prompt"),
+            retries=2
+        ),
+        versions={
+            "call_log": digest(groq_model_name, repr(groq_settings), call_log_agent_prompt),
+            "report": digest(report_model_name, repr(groq_settings), report_agent_prompt),
+            "extraction": digest(groq_model_name, repr(groq_settings), extraction_agent_prompt, json.dumps(Form.model_json_schema())),
+        },
+    )
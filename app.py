@@ -1,60 +1,46 @@
-import bcrypt
+from services import configure_logfire, get_settings, services
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Depends
-from fastapi.responses import JSONResponse
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import JSONResponse, StreamingResponse
 from filename_parser import parse_call_filename
 from upload_filename_parser import upload_parse_call_filename
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from agents import deps
-from auth import create_access_token, verify_password, SECRET_KEY, ALGORITHM
-from jose import jwt, JWTError
-from database import DatabaseHandler
+from auth import create_access_token, create_upload_token, decode_upload_token, get_current_user, hash_password, verify_password
+from jose import JWTError
+from database import encode_cursor, execute_query, keyset_page
 from fastapi.middleware.cors import CORSMiddleware
-from main import chat, process_log, upload_process_log
+from main import chat, chat_stream, complete_log, process_log, transcribe_log, upload_process_log
+import asyncio
 import traceback
+import json
 import shutil
-import asyncio
-from uuid import UUID
+import tempfile
+from contextlib import asynccontextmanager
+from uuid import UUID, uuid4
 import os
 from datetime import datetime
-import boto3
-from transcription import TranscriptionService
+from ingest import ArchiveSource, ManifestSource
+from scheduler import INTERACTIVE, prioritized
+from transcript import Transcript
+import jobs
 import logfire
-from settings import Settings
-
-settings = Settings()
-
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=settings.aws_access_key,
-    aws_secret_access_key=settings.aws_secret_access_key,
-    #region_name="us-east-1"  # Adjust region as needed
-)
-
-BUCKET_NAME = "call-logs-audio-files" 
-
-db = DatabaseHandler(deps)
 
-transcription_service = TranscriptionService(bucket_name=BUCKET_NAME)
+settings = get_settings()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+# Text fields of a call log that go into the search index
+SEARCH_FIELDS = ("transcription", "report_generated", "call_log")
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        organisation_id = payload.get("organisation_id")
-        role = payload.get("role")
-        if email is None or organisation_id is None or role is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return {"email": email, "organisation_id": organisation_id, "role": role}
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await services.start()
+    rebuild = asyncio.ensure_future(rebuild_search_index())
+    yield
+    rebuild.cancel()
+    await services.aclose()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-logfire.configure(token=settings.logfire_write_token)
+configure_logfire()
 logfire.instrument_fastapi(app=app)
 
 origins = [
@@ -98,7 +84,20 @@ class SearchRequest(BaseModel):
     limit: int = 20
     offset: int = 0
 
+class PresignUpload(BaseModel):
+    filename: str
+    content_type: Optional[str] = None  # if set, the PUT must send the same Content-Type
+
+class CompleteUpload(BaseModel):
+    filename: str
+    upload_token: str  # from /upload/presign
+
 # --- Models for super admin actions ---
+class BulkManifest(BaseModel):
+    filenames: List[str]
+    source_bucket: Optional[str] = None  # copied from here when it isn't our bucket
+    source_prefix: str = ""
+
 class OrganisationCreate(BaseModel):
     name: str
 
@@ -115,7 +114,7 @@ async def create_organisation(
 ):
     if user["role"] != "super_admin":
         raise HTTPException(status_code=403, detail="Not authorized")
-    org_id = await db.create_organisation(org.name)
+    org_id = await services.db.create_organisation(org.name)
     return {"msg": "Organisation created", "organisation_id": org_id}
 
 @app.post("/admin/create_user")
@@ -139,11 +138,11 @@ async def create_user(
         if user_req.role != "user":
             raise HTTPException(status_code=403, detail="Admins can only create users with role 'user'")
     
-    existing_user = await db.get_user_by_email(user_req.email)
+    existing_user = await services.db.get_user_by_email(user_req.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed = bcrypt.hashpw(user_req.password.encode(), bcrypt.gensalt()).decode()
-    created = await db.create_user(
+    hashed = await hash_password(user_req.password)
+    created = await services.db.create_user(
         user_req.email, hashed, user_req.organisation_id, user_req.role
     )
     if not created:
@@ -153,7 +152,7 @@ async def create_user(
 @app.post("/logs/date")
 async def get_all_by_dates(req: Dates):
     try:
-        call_logs = await db.get_all_by_dates(req.from_date, req.to_date)
+        call_logs = await services.db.get_all_by_dates(req.from_date, req.to_date)
         return {"data": call_logs}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -162,25 +161,39 @@ async def get_all_by_dates(req: Dates):
 async def get_all_logs(
     limit: int = Query(30, gt=0),
     offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
+    exact_count: bool = Query(False),
     user=Depends(get_current_user)
 ):
-    data = await db.get_logs_paginated(
-        limit=limit,
-        offset=offset,
-        organisation_id=user["organisation_id"]
-    )
-    total = await db.get_logs_count(organisation_id=user["organisation_id"])
-    return {
-        "data": data,
-        "limit": limit,
-        "offset": offset,
-        "total": total
-    }
+    try:
+        return await services.db.get_logs_paginated(
+            limit=limit,
+            organisation_id=user["organisation_id"],
+            cursor=cursor,
+            offset=offset,
+            exact_count=exact_count,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Ranked, typo-tolerant search across caller, numbers, filename and transcript
+@app.get("/logs/search")
+async def search_logs_ranked(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, gt=0, le=100),
+    offset: int = Query(0, ge=0),
+    user=Depends(get_current_user)
+):
+    try:
+        data = await services.db.search_logs(organisation_id=user["organisation_id"], text=q, limit=limit, offset=offset)
+        return {"data": data, "limit": limit, "offset": offset}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/logs/{id}")
 async def get_all_by_id(id: str):  # or `id: str` depending on your data type
     try:
-        result = await db.get_log(id=id)
+        result = await services.db.get_log(id=id)
         return {"data": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -188,7 +201,7 @@ async def get_all_by_id(id: str):  # or `id: str` depending on your data type
 @app.post("/logs/columns")
 async def get_columns(req: ColumnRequest):
     try:
-        result = await db.get_columns(req.columns, req.limit)
+        result = await services.db.get_columns(req.columns, req.limit)
         return {"data": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -196,7 +209,7 @@ async def get_columns(req: ColumnRequest):
 @app.post("/logs/report")
 async def get_report(req: ReportRequest):
     try:
-        result = await db.get_report(req.uuid)
+        result = await services.db.get_report(req.uuid)
         return {"data": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -212,7 +225,7 @@ async def create_log(
     if ext not in allowed_exts:
         raise HTTPException(status_code=400, detail="Only .wav or .mp3 files are supported")
 
-    if await db.file_exists(file.filename):
+    if await services.db.file_exists(file.filename):
         raise HTTPException(status_code=409, detail="File with this name already uploaded")
     
     # Parse metadata from filename
@@ -225,17 +238,15 @@ async def create_log(
         "organisation_id": user["organisation_id"],  # <-- Add this line
     }   
 
-    initial_row = await db.create_call_log(initial_payload)
+    initial_row = await services.db.create_call_log(initial_payload)
     log_id = initial_row["id"] 
     
     try:
-        file_data = await file.read()
-
-        s3.put_object(
-            Bucket=BUCKET_NAME,
-            Key=file.filename,
-            Body=file_data,
-            ContentType=file.content_type
+        await services.storage.stream_upload(
+            key=file.filename,
+            file=file,
+            content_type=file.content_type,
+            part_size=settings.s3_upload_part_size_mb * 1024 * 1024,
         )
 
     # except Exception as e:
@@ -245,7 +256,11 @@ async def create_log(
     #     raise HTTPException(status_code=500, detail="S3 upload failed")
 
         #Start processing in the background
-        asyncio.create_task(process_and_update_log(file.filename, log_id))
+        await services.job_queue.enqueue("create_log", {
+            "filename": file.filename,
+            "log_id": log_id,
+            "organisation_id": user["organisation_id"],
+        })
 
         return JSONResponse(content={
             "status": "success",
@@ -253,16 +268,114 @@ async def create_log(
             "uuid": log_id
         })
 
-    except Exception as e:
+    except Exception:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# Add this function to handle background processing and update
-async def process_and_update_log(filename: str, log_id: str):
-    # from main import process_log
-    payload = await process_log(filename)
-    update_data = {**payload, "status": "complete"}
-    await db.update_call_log(log_id, update_data)
+async def _check_new_recording(filename: str) -> Dict[str, Any]:
+    """The call metadata in a recording's filename, or the HTTPException for why it can't be uploaded."""
+    if os.path.splitext(filename)[-1].lower() not in (".wav", ".mp3"):
+        raise HTTPException(status_code=400, detail="Only .wav or .mp3 files are supported")
+    try:
+        metadata = await parse_call_filename(filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if await services.db.file_exists(filename):
+        raise HTTPException(status_code=409, detail="File with this name already uploaded")
+    return metadata
+
+@app.post("/upload/presign")
+async def presign_upload(req: PresignUpload, user=Depends(get_current_user)):
+    """
+    Step one of uploading a recording without sending it through the API: returns a
+    URL the client PUTs the audio to, straight to the bucket, with the headers it
+    must send. Then call /upload/complete with the upload_token.
+    """
+    await _check_new_recording(req.filename)
+    if await services.storage.head(req.filename) is not None:
+        raise HTTPException(status_code=409, detail="File with this name already uploaded")
+
+    expires_in = settings.s3_presign_expiry_seconds
+    # Stored on the object by the PUT; /upload/complete only accepts it with the matching token
+    upload_id = uuid4().hex
+    url, headers = services.storage.presign_put(
+        req.filename,
+        content_type=req.content_type,
+        expires_in=expires_in,
+        metadata={"upload-id": upload_id},
+    )
+    return {
+        "url": url,
+        "method": "PUT",
+        "headers": headers,
+        "key": req.filename,
+        "expires_in": expires_in,
+        "upload_token": create_upload_token(req.filename, user["organisation_id"], upload_id, expires_in),
+    }
+
+@app.post("/upload/complete")
+async def complete_upload(req: CompleteUpload, user=Depends(get_current_user)):
+    """Registers a recording PUT to a presigned URL and queues it, like /create_log."""
+    try:
+        token = decode_upload_token(req.upload_token)
+    except JWTError:
+        raise HTTPException(status_code=403, detail="Invalid or expired upload token")
+    if token.get("key") != req.filename or token.get("org") != user["organisation_id"]:
+        raise HTTPException(status_code=403, detail="Upload token is not for this file")
+
+    metadata = await _check_new_recording(req.filename)
+    head = await services.storage.head(req.filename)
+    if head is None:
+        raise HTTPException(status_code=404, detail="No uploaded file with this name; PUT it to the presigned URL first")
+    # Whatever is there must be the object written with this token's URL
+    if (head.get("Metadata") or {}).get("upload-id") != token.get("upload_id"):
+        raise HTTPException(status_code=403, detail="Upload token is not for this file")
+    if not head.get("ContentLength"):
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+
+    initial_row = await services.db.create_call_log({
+        **metadata,
+        "status": "processing",
+        "organisation_id": user["organisation_id"],
+    })
+    log_id = initial_row["id"]
+
+    await services.job_queue.enqueue("create_log", {
+        "filename": req.filename,
+        "log_id": log_id,
+        "organisation_id": user["organisation_id"],
+    })
+
+    return JSONResponse(content={
+        "status": "success",
+        "message": "Log registered and queued for processing",
+        "uuid": log_id
+    })
+
+# Background processing stages, run by the job queue
+async def transcribe_log_stage(state: Dict[str, Any]) -> Dict[str, Any]:
+    # Saved with the job, so retrying a later stage needs neither Whisper nor the recording
+    transcript = await transcribe_log(state["filename"])
+    return {"transcript": transcript.to_columns()}
+
+def _saved_transcript(state: Dict[str, Any]) -> Optional[Transcript]:
+    # Jobs queued before the transcribe stage existed transcribe in the process stage
+    return Transcript.from_columns(state["transcript"]) if state.get("transcript") else None
+
+async def process_log_stage(state: Dict[str, Any]) -> Dict[str, Any]:
+    payload = await process_log(state["filename"], state["log_id"], state["organisation_id"], _saved_transcript(state))
+    return {"payload": payload}
+
+async def update_log_stage(state: Dict[str, Any]) -> None:
+    await complete_log(state["log_id"], state["payload"])
+    services.retriever.invalidate(state["log_id"])
+
+async def index_log_stage(state: Dict[str, Any]) -> None:
+    fields = {name: state["payload"].get(name) for name in SEARCH_FIELDS}
+    await services.search_index.add(state["log_id"], state["organisation_id"], fields)
+
+async def mark_log_failed(state: Dict[str, Any], error: str) -> None:
+    await services.db.update_call_log(state["log_id"], {"status": "failed"})
 
 # async def process_and_update_log(filename: str, log_id: str, parser: str = "strict"):
 #     if parser == "upload":
@@ -284,8 +397,8 @@ async def filter_logs_by_date(req: Dict[str, Any], user=Depends(get_current_user
         limit = req.get("limit", 20)
         offset = req.get("offset", 0)
 
-        columns = "id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status, filename, organisation_id"
-        query = db.client.table(db.table).select(columns)
+        columns = "id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status, filename, organisation_id, created_at"
+        query = services.db.client.table(services.db.table).select(columns)
         query = query.eq("organisation_id", user["organisation_id"])  # <-- filter by organisation
 
         if call_date_from:
@@ -293,24 +406,27 @@ async def filter_logs_by_date(req: Dict[str, Any], user=Depends(get_current_user
         if call_date_to:
             query = query.lte("call_date", call_date_to)
 
-        total_query = db.client.table(db.table).select("id", count="exact")
+        total_query = services.db.client.table(services.db.table).select("id", count="exact")
         total_query = total_query.eq("organisation_id", user["organisation_id"])  # <-- filter by organisation
         if call_date_from:
             total_query = total_query.gte("call_date", call_date_from)
         if call_date_to:
             total_query = total_query.lte("call_date", call_date_to)
-        total_result = total_query.execute()
-        total_count = total_result.count or 0
-
-        query = query.order("created_at", desc=False).range(offset, offset + limit - 1)
-        result = query.execute()
-
-        return {
-            "data": result.data or [],
-            "limit": limit,
-            "offset": offset,
-            "total": total_count
-        }
+
+        return await services.db.paginate_logs(
+            query,
+            total_query,
+            organisation_id=user["organisation_id"],
+            limit=limit,
+            cursor=req.get("cursor"),
+            offset=offset,
+            desc=False,
+            count_key=f"datefilter:{json.dumps([call_date_from, call_date_to])}",
+            exact_count=req.get("exact_count", False),
+            name="filter_logs_by_date",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))  
 
@@ -323,8 +439,8 @@ async def search_logs(req: Dict[str, Any], user=Depends(get_current_user)):
         limit = req.get("limit", 20)
         offset = req.get("offset", 0)
 
-        columns = "id,call_date,call_type,caller_name,status,filename,customer_number,toll_free_did, organisation_id"
-        query = db.client.table(db.table).select(columns)
+        columns = "id,call_date,call_type,caller_name,status,filename,customer_number,toll_free_did, organisation_id, created_at"
+        query = services.db.client.table(services.db.table).select(columns)
         query = query.eq("organisation_id", user["organisation_id"])  # <-- filter by organisation
 
         def apply_filters(query, filters):
@@ -344,25 +460,29 @@ async def search_logs(req: Dict[str, Any], user=Depends(get_current_user)):
 
         query = apply_filters(query, filters)
 
-        total_query = db.client.table(db.table).select("id", count="exact")
+        total_query = services.db.client.table(services.db.table).select("id", count="exact")
         total_query = total_query.eq("organisation_id", user["organisation_id"])  # <-- filter by organisation
         total_query = apply_filters(total_query, filters)
-        total_result = total_query.execute()
-        total_count = total_result.count or 0
 
+        # Only the default created_at sort can use cursors, other columns page by offset
         sort_column = sort.get("column", "created_at")
         sort_direction = sort.get("direction", "desc")
-        query = query.order(sort_column, desc=(sort_direction == "desc"))
-
-        query = query.range(offset, offset + limit - 1)
-        result = query.execute()
 
-        return {
-            "data": result.data or [],
-            "limit": limit,
-            "offset": offset,
-            "total": total_count
-        }
+        return await services.db.paginate_logs(
+            query,
+            total_query,
+            organisation_id=user["organisation_id"],
+            limit=limit,
+            cursor=req.get("cursor"),
+            offset=offset,
+            desc=(sort_direction == "desc"),
+            sort_column=sort_column,
+            count_key=f"search:{json.dumps(filters, sort_keys=True)}",
+            exact_count=req.get("exact_count", False),
+            name="search_logs",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -375,7 +495,8 @@ async def report_chat(
         response = await chat(
             user_prompt=ctx.user_prompt,
             uuid=ctx.uuid,
-            organisation_id=user["organisation_id"]
+            organisation_id=user["organisation_id"],
+            user_id=user["email"]
         )
         return JSONResponse(content={
             "status": "success",
@@ -384,6 +505,36 @@ async def report_chat(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _chat_events(user_prompt: str, uuid: UUID, organisation_id: str, user_id: str, first: Optional[str] = None):
+    # A client disconnect cancels this generator, which closes the upstream model request
+    if first:
+        yield first
+    try:
+        async for delta in chat_stream(user_prompt=user_prompt, uuid=uuid, organisation_id=organisation_id, user_id=user_id):
+            yield _sse("token", {"delta": delta})
+        yield _sse("done", {})
+    except Exception as e:
+        logfire.exception("Chat stream failed")
+        yield _sse("error", {"detail": str(e)})
+
+def _event_stream(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Same as /chat, but streams the answer as server-sent events: token* then done (or error)
+@app.post("/chat/stream")
+async def report_chat_stream(
+    ctx: ChatRequest,
+    user=Depends(get_current_user)
+):
+    return _event_stream(_chat_events(ctx.user_prompt, ctx.uuid, user["organisation_id"], user["email"]))
+
 # @app.post("/voice_chat")
 # async def report_voice_chat(file: UploadFile = File(...), uuid: UUID = Form(...)):
 #     try:
@@ -415,24 +566,17 @@ async def report_voice_chat(
     user=Depends(get_current_user)  # <-- Require authentication
 ):
     try:
-        temp_filename = file.filename
-
-        with open(temp_filename, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        with open(temp_filename, "rb") as f:
-            s3.upload_fileobj(f, BUCKET_NAME, temp_filename)
-
-        transcript = await transcription_service.transcribe(temp_filename)
+        # A spoken question is small enough to transcribe from memory; it never goes to the bucket
+        audio = await file.read()
+        with prioritized(INTERACTIVE):
+            transcript = await services.transcription_service.transcribe_audio(audio, filename=file.filename)
 
         response = await chat(
             user_prompt=transcript,
             uuid=uuid,
-            organisation_id=user["organisation_id"]  # <-- Pass organisation_id
+            organisation_id=user["organisation_id"],  # <-- Pass organisation_id
+            user_id=user["email"]
         )
-        
-        if os.path.exists(temp_filename):
-            os.remove(temp_filename)
 
         return JSONResponse(content={
             "status": "success",
@@ -440,18 +584,36 @@ async def report_voice_chat(
             "content": response
         })
     except Exception as e:
-        import traceback
-        print(traceback.format_exc())
+        logfire.exception("Voice chat failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Same as /voice_chat, but streams: transcript, token* then done (or error)
+@app.post("/voice_chat/stream")
+async def report_voice_chat_stream(
+    file: UploadFile = File(...),
+    uuid: UUID = Form(...),
+    user=Depends(get_current_user)
+):
+    try:
+        audio_bytes = await file.read()
+        with prioritized(INTERACTIVE):
+            transcript = await services.transcription_service.transcribe_audio(audio_bytes, filename=file.filename)
+    except Exception as e:
+        logfire.exception("Voice chat failed")
         raise HTTPException(status_code=500, detail=str(e))
 
+    return _event_stream(_chat_events(transcript, uuid, user["organisation_id"], user["email"], first=_sse("transcript", {"user_prompt": transcript})))
 
 @app.delete("/delete_log")
 async def delete_log_by_id(id: str):  # or `id: str` depending on your data type
     try:
         # Delete all answers for this call log first
-        await db.delete_answers_by_callid(id)
+        await services.db.delete_answers_by_callid(id)
         # Now delete the call log
-        result = await db.delete_call_log(id=id)
+        await services.db.delete_call_log(id=id)
+        await services.search_index.delete(id)
+        services.retriever.invalidate(id)
         return {"status": "successfully deleted"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -474,11 +636,12 @@ class Token(BaseModel):
 
 @app.post("/login", response_model=Token)
 async def login(user: UserLogin):
-        user_data = await db.get_user_by_email(user.email)
+        user_data = await services.db.get_user_by_email(user.email)
         if not user_data:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        # if not verify_password(user.password, user_data["hashed_password"]):
-        #     raise HTTPException(status_code=401, detail="Invalid credentials")
+        hashed = user_data.get("hashed_password")
+        if not hashed or not await verify_password(user.password, hashed):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
         token = create_access_token(data={
             "sub": str(user_data["email"]),
             "organisation_id": str(user_data["organisation_id"]),
@@ -486,20 +649,6 @@ async def login(user: UserLogin):
         })
         return {"access_token": token, "token_type": "bearer"}
 
-@app.post("/signup")
-async def signup(user: UserLogin):
-    existing_user = await db.get_user_by_email(user.email)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-
-    hashed = bcrypt.hashpw(user.password.encode(), bcrypt.gensalt()).decode()
-
-    created = await db.create_user(user.email, hashed   )
-    if not created:
-        raise HTTPException(status_code=500, detail="User creation failed")
-
-    return {"msg": "User created successfully"}
-
 @app.post("/upload")
 async def upload_any_file(
     file: UploadFile = File(...),
@@ -511,7 +660,7 @@ async def upload_any_file(
         ext = ".wav, .mp3"  # Default to .wav or .mp3 as needed
         filename = filename + ext
 
-    if await db.file_exists(filename):
+    if await services.db.file_exists(filename):
         raise HTTPException(status_code=409, detail="File with this name already uploaded")
 
     metadata = await upload_parse_call_filename(filename)
@@ -522,20 +671,21 @@ async def upload_any_file(
         "organisation_id": user["organisation_id"],  # <-- Add this line
     }   
 
-    initial_row = await db.create_call_log(initial_payload)
+    initial_row = await services.db.create_call_log(initial_payload)
     log_id = initial_row["id"] 
     
     try:
-        file_data = await file.read()
-
-        s3.put_object(
-            Bucket=BUCKET_NAME,
-            Key=filename,
-            Body=file_data,
-            ContentType=file.content_type
+        await services.storage.stream_upload(
+            key=filename,
+            file=file,
+            content_type=file.content_type,
+            part_size=settings.s3_upload_part_size_mb * 1024 * 1024,
         )
 
-        asyncio.create_task(upload_process_and_update_log(filename, log_id, db))
+        await services.job_queue.enqueue("upload", {
+            "filename": filename,
+            "log_id": log_id,
+        })
 
         return JSONResponse(content={
             "status": "success",
@@ -543,40 +693,164 @@ async def upload_any_file(
             "uuid": log_id
         })
 
-    except Exception as e:
+    except Exception:
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Internal server error")
     
 
-# Add this function to handle background processing and update
-async def upload_process_and_update_log(filename: str, log_id: str, db):
-    log_list = await db.get_log(log_id)
+# Background processing stage for /upload, run by the job queue
+async def upload_process_log_stage(state: Dict[str, Any]) -> Dict[str, Any]:
+    log_id = state["log_id"]
+    log_list = await services.db.get_log(log_id)
     log = log_list[0] if log_list else None
 
-    if log:
-        organisation_id = log["organisation_id"]
-        common_questions = await db.get_common_questions(organisation_id)
-        payload = await upload_process_log(filename, log_id, organisation_id, db)
-        update_data = {**payload, "status": "complete"}
-        await db.update_call_log(log_id, update_data)
-    else:
-        # handle log not found
-        print(f"Log with id {log_id} not found.")
-        # Optionally, raise an exception or return an error response
+    if not log:
+        raise ValueError(f"Log with id {log_id} not found.")
+
+    organisation_id = log["organisation_id"]
+    payload = await upload_process_log(state["filename"], log_id, organisation_id, services.db, _saved_transcript(state))
+    return {"payload": payload, "organisation_id": organisation_id}
+
+jobs.register(
+    "create_log",
+    [("transcribe", transcribe_log_stage), ("process", process_log_stage), ("update", update_log_stage), ("index", index_log_stage)],
+    on_failure=mark_log_failed,
+    keep=("filename", "log_id"),
+)
+jobs.register(
+    "upload",
+    [("transcribe", transcribe_log_stage), ("process", upload_process_log_stage), ("update", update_log_stage), ("index", index_log_stage)],
+    on_failure=mark_log_failed,
+    keep=("filename", "log_id"),
+)
+
+def _spool(file: UploadFile) -> str:
+    # The upload is closed once the response is sent, so the batch reads from its own copy
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename or "")[-1]) as tmp:
+        shutil.copyfileobj(file.file, tmp, 1024 * 1024)
+        return tmp.name
+
+@app.post("/logs/bulk", status_code=202)
+async def bulk_ingest(
+    file: UploadFile = File(...),
+    user=Depends(get_current_user)
+):
+    """Ingests a zip or tar of recordings named in the call filename format."""
+    path = await asyncio.to_thread(_spool, file)
+    try:
+        source = await asyncio.to_thread(ArchiveSource, path)
+    except ValueError as e:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    batch_id = await services.ingestor.start(source, user["organisation_id"])
+    return {"batch_id": batch_id}
+
+@app.post("/logs/bulk/manifest", status_code=202)
+async def bulk_ingest_manifest(
+    manifest: BulkManifest,
+    user=Depends(get_current_user)
+):
+    """Ingests recordings that are already in object storage."""
+    if not manifest.filenames:
+        raise HTTPException(status_code=400, detail="No filenames given")
+    source = ManifestSource(manifest.filenames, manifest.source_bucket, manifest.source_prefix)
+    if not services.ingestor.allows(source):
+        raise HTTPException(status_code=403, detail="source_bucket is not an allowed ingest source")
+    batch_id = await services.ingestor.start(source, user["organisation_id"])
+    return {"batch_id": batch_id}
+
+@app.get("/logs/bulk/{batch_id}")
+async def bulk_ingest_status(batch_id: str, user=Depends(get_current_user)):
+    status = await services.ingestor.status(batch_id, user["organisation_id"])
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return status
+
+@app.get("/jobs/status")
+async def jobs_status(user=Depends(get_current_user)):
+    return await services.job_queue.status()
+
+# Per-model Groq budgets, queue depth by priority, waits and 429s
+@app.get("/scheduler/stats")
+async def scheduler_stats(user=Depends(get_current_user)):
+    return services.groq_scheduler.stats()
+
+# Time to import and to become ready against STARTUP_BUDGET_MS, and what each service took to build
+@app.get("/startup/stats")
+async def startup_stats(user=Depends(get_current_user)):
+    return services.startup_report()
+
+@app.get("/cache/stats")
+async def cache_stats(user=Depends(get_current_user)):
+    return services.result_cache.stats()
+
+# Ranked call ids from the local keyword + semantic index
+@app.get("/search")
+async def search_calls(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, gt=0, le=100),
+    mode: str = Query("hybrid"),
+    user=Depends(get_current_user)
+):
+    try:
+        results = await services.search_index.search(user["organisation_id"], q, limit=limit, mode=mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"data": results, "mode": mode}
+
+async def reindex_logs(organisation_id: Optional[str] = None) -> int:
+    """Indexes completed call logs, of one organisation or of all of them. Returns how many."""
+    indexed = 0
+    cursor = None
+    while True:
+        query = (
+            services.db.client.table(services.db.table)
+            .select(f"id,created_at,organisation_id,{','.join(SEARCH_FIELDS)}")
+            .eq("status", "complete")
+        )
+        if organisation_id:
+            query = query.eq("organisation_id", organisation_id)
+        response = await execute_query(keyset_page(query, 200, cursor), "reindex_calls")
+        rows = response.data or []
+        for row in rows[:200]:
+            await services.search_index.add(row["id"], row["organisation_id"], {name: row.get(name) for name in SEARCH_FIELDS})
+            indexed += 1
+        if len(rows) <= 200:
+            break
+        cursor = encode_cursor(rows[199])
+    return indexed
+
+async def rebuild_search_index() -> None:
+    # The index is local to each host: a fresh volume (new host, lost disk) starts empty
+    try:
+        if (await services.search_index.stats())["documents"]:
+            return
+        with logfire.span("search index rebuild"):
+            indexed = await reindex_logs()
+        logfire.info("Rebuilt the search index from {count} calls", count=indexed)
+    except Exception as e:
+        logfire.exception("Search index rebuild failed: {error}", error=str(e))
+
+# Index the organisation's existing completed logs, e.g. after first deploying the index
+@app.post("/search/reindex")
+async def reindex_calls(user=Depends(get_current_user)):
+    indexed = await reindex_logs(user["organisation_id"])
+    return {"indexed": indexed, **await services.search_index.stats()}
 
 @app.get("/get_answers/{call_id}")
 async def get_answers(call_id: str, user=Depends(get_current_user)):
-    callresults = await db.get_answers_by_callid(call_id=call_id, organisation_id=user["organisation_id"])
+    callresults = await services.db.get_answers_by_callid(call_id=call_id, organisation_id=user["organisation_id"])
     return callresults
 
 @app.get("/get_all_questions")
 async def get_all_questions(user=Depends(get_current_user)):
-    questions = await db.get_all_questions(organisation_id=user["organisation_id"])
+    questions = await services.db.get_all_questions(organisation_id=user["organisation_id"])
     return questions
 
 @app.put("/update_question/{id}")
 async def update_question(id: str, question_text: str, is_active: bool, user=Depends(get_current_user)):
-    question_updated = await db.update_question_text(id, question_text, is_active, organisation_id=user["organisation_id"])
+    question_updated = await services.db.update_question_text(id, question_text, is_active, organisation_id=user["organisation_id"])
     if not question_updated:
         raise HTTPException(status_code=404, detail="Question not found")
     return {"message": "Question updated successfully"}
@@ -585,10 +859,12 @@ async def update_question(id: str, question_text: str, is_active: bool, user=Dep
 async def list_organisations(user=Depends(get_current_user)):
     if user["role"] != "super_admin":
         raise HTTPException(status_code=403, detail="Not authorized")
-    orgs = await db.get_all_organisations()
+    orgs = await services.db.get_all_organisations()
     return {"organisations": orgs}
 
 
+services.mark("imported")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
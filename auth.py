@@ -1,16 +1,128 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generic, Optional, Tuple, TypeVar
+
 import bcrypt
-from jose import jwt
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+from jose import jwt, JWTError
 from datetime import datetime, timedelta
+from services import get_settings
+
+settings = get_settings()
 
 SECRET_KEY = "your-super-secret"
 ALGORITHM = "HS256"
 EXPIRE_DAYS = 30
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+V = TypeVar("V")
+
+class ExpiringLRU(Generic[V]):
+    """Bounded LRU whose entries expire at their own time, or ttl seconds after being set."""
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[V, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: str, value: V, expires_at: Optional[float] = None) -> None:
+        if self.max_entries <= 0:
+            return
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if self.ttl is not None else float("inf"))
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Claims of tokens that already passed verification, keyed by a hash of the token
+token_cache: ExpiringLRU[Dict[str, Any]] = ExpiringLRU(settings.auth_token_cache_size)
+
+# bcrypt takes ~250ms of CPU per call; this keeps it off the event loop and caps how
+# many run at once so a burst of logins can't take every core
+bcrypt_pool = ThreadPoolExecutor(max_workers=settings.bcrypt_concurrency, thread_name_prefix="bcrypt")
+
+async def hash_password(password: str) -> str:
+    hashed = await asyncio.get_running_loop().run_in_executor(
+        bcrypt_pool, lambda: bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    )
+    return hashed.decode()
+
+def _check_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+    except ValueError:
+        # Not a bcrypt hash; never matches
+        return False
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(bcrypt_pool, _check_password, plain_password, hashed_password)
 
 def create_access_token(data: dict):
     expire = datetime.utcnow() + timedelta(days=EXPIRE_DAYS)
     to_encode = data.copy()
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def decode_access_token(token: str) -> Dict[str, Any]:
+    """Verified claims of a token, from the cache until the token's exp. Raises JWTError."""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    claims = token_cache.get(key)
+    if claims is None:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # Tokens without an exp are verified every time
+        if isinstance(claims.get("exp"), (int, float)):
+            token_cache.set(key, claims, float(claims["exp"]))
+    return claims
+
+# Extra time after a presigned URL expires to call /upload/complete for what was PUT
+UPLOAD_COMPLETE_GRACE_SECONDS = 3600
+
+def create_upload_token(key: str, organisation_id: str, upload_id: str, expires_in: int) -> str:
+    """
+    Ties a presigned upload to the organisation that asked for it. Carries no sub or
+    role, so it is never accepted as an access token.
+    """
+    expire = datetime.utcnow() + timedelta(seconds=expires_in + UPLOAD_COMPLETE_GRACE_SECONDS)
+    claims = {"typ": "upload", "key": key, "org": organisation_id, "upload_id": upload_id, "exp": expire}
+    return jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+def decode_upload_token(token: str) -> Dict[str, Any]:
+    """Verified claims of an upload token. Raises JWTError."""
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if claims.get("typ") != "upload":
+        raise JWTError("Not an upload token")
+    return claims
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    try:
+        payload = decode_access_token(token)
+        email = payload.get("sub")
+        organisation_id = payload.get("organisation_id")
+        role = payload.get("role")
+        if email is None or organisation_id is None or role is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        return {"email": email, "organisation_id": organisation_id, "role": role}
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
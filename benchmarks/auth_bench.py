@@ -0,0 +1,201 @@
+"""
+Requests per second on an authenticated endpoint, with the auth path as it was
+(a full jwt.decode per request in a sync dependency, bcrypt on the event loop)
+and as it is now (cached token claims, bcrypt in its own thread pool).
+
+    python -m benchmarks.auth_bench --requests 3000 --concurrency 32 --signups 2
+
+Serves the app with uvicorn on a local port, so nothing else needs to be running.
+Each mode is measured on its own and again while --signups clients keep signing up
+(hashing a password per request) alongside, which is where bcrypt on the event
+loop hurts.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+ENDPOINT = "/scheduler/stats"
+SIGNUP_ENDPOINT = "/_bench/signup"
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def configure_environment(workdir: str) -> None:
+    """Test mode stand-ins; nothing here talks to Groq, S3 or Supabase. Must run before the app is imported."""
+    os.environ.update({
+        "TEST_MODE": "1",
+        "LOGFIRE_SEND_TO_LOGFIRE": "false",
+        "JOB_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "CACHE_DISK_PATH": os.path.join(workdir, "cache.sqlite3"),
+        "INVALIDATION_BUS_PATH": os.path.join(workdir, "bus.sqlite3"),
+        "SEARCH_INDEX_PATH": os.path.join(workdir, "search.sqlite3"),
+    })
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+class AuthBenchmark:
+    def __init__(self, args):
+        import bcrypt
+        import uvicorn
+        from fastapi import Depends, HTTPException
+        from jose import jwt, JWTError
+
+        import app as app_module
+        import auth
+
+        self.args = args
+        self.app = app_module.app
+        self.auth = auth
+        self.legacy = True
+        self.token = auth.create_access_token({"sub": "bench@example.com", "organisation_id": "bench", "role": "admin"})
+        self.base_url = f"http://127.0.0.1:{args.port}"
+
+        # The dependency as it was before the claims cache
+        def legacy_get_current_user(token: str = Depends(auth.oauth2_scheme)):
+            try:
+                payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+                email = payload.get("sub")
+                organisation_id = payload.get("organisation_id")
+                role = payload.get("role")
+                if email is None or organisation_id is None or role is None:
+                    raise HTTPException(status_code=401, detail="Invalid token")
+                return {"email": email, "organisation_id": organisation_id, "role": role}
+            except JWTError:
+                raise HTTPException(status_code=401, detail="Invalid token")
+
+        self.legacy_get_current_user = legacy_get_current_user
+
+        # The hashing half of /admin/create_user, without the database writes
+        async def bench_signup():
+            if self.legacy:
+                bcrypt.hashpw(b"benchmark-password", bcrypt.gensalt()).decode()
+            else:
+                await auth.hash_password("benchmark-password")
+            return {"msg": "User created successfully"}
+
+        self.app.add_api_route(SIGNUP_ENDPOINT, bench_signup, methods=["POST"])
+        self.server = uvicorn.Server(uvicorn.Config(
+            self.app, host="127.0.0.1", port=args.port, lifespan="off", log_level="warning", access_log=False,
+        ))
+
+    def start_server(self) -> threading.Thread:
+        thread = threading.Thread(target=self.server.run, daemon=True)
+        thread.start()
+        deadline = time.time() + 15
+        while not self.server.started:
+            if time.time() > deadline or not thread.is_alive():
+                raise RuntimeError("App server did not start")
+            time.sleep(0.05)
+        return thread
+
+    def _set_mode(self, legacy: bool) -> None:
+        self.legacy = legacy
+        if legacy:
+            self.app.dependency_overrides[self.auth.get_current_user] = self.legacy_get_current_user
+        else:
+            self.app.dependency_overrides.pop(self.auth.get_current_user, None)
+            self.auth.token_cache._entries.clear()
+
+    async def _poll(self, client: httpx.AsyncClient) -> Dict[str, Any]:
+        latencies: List[float] = []
+        remaining = iter(range(self.args.requests))
+        headers = {"Authorization": f"Bearer {self.token}"}
+
+        async def worker():
+            for _ in remaining:
+                start = time.perf_counter()
+                response = await client.get(ENDPOINT, headers=headers)
+                response.raise_for_status()
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            "requests_per_s": round(len(latencies) / elapsed, 1),
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "max_ms": _percentile(latencies, 100),
+        }
+
+    async def _mode(self, legacy: bool) -> Dict[str, Any]:
+        self._set_mode(legacy)
+        limits = httpx.Limits(max_connections=self.args.concurrency + self.args.signups)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=120) as client:
+            # Warm up connections, the token cache and the thread pools
+            headers = {"Authorization": f"Bearer {self.token}"}
+            await asyncio.gather(*(client.get(ENDPOINT, headers=headers) for _ in range(self.args.concurrency)))
+
+            results = {"polling": await self._poll(client)}
+
+            polling_done = asyncio.Event()
+
+            async def signups() -> int:
+                completed = 0
+                while not polling_done.is_set():
+                    (await client.post(SIGNUP_ENDPOINT)).raise_for_status()
+                    completed += 1
+                return completed
+
+            signing_up = [asyncio.ensure_future(signups()) for _ in range(self.args.signups)]
+            # Let the first signups reach the server before polling starts
+            await asyncio.sleep(0.05)
+            results["polling_during_signups"] = await self._poll(client)
+            polling_done.set()
+            results["polling_during_signups"]["signups"] = sum(await asyncio.gather(*signing_up))
+        return results
+
+    async def run(self) -> Dict[str, Any]:
+        before = await self._mode(legacy=True)
+        after = await self._mode(legacy=False)
+        return {
+            "config": vars(self.args),
+            "before": before,
+            "after": after,
+            "speedup": {
+                name: round(after[name]["requests_per_s"] / before[name]["requests_per_s"], 2)
+                for name in before
+            },
+        }
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="VoiceIQ auth path benchmark")
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--signups", type=int, default=2, help="Clients signing up during the second round of polling")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args(argv)
+    args.port = args.port or _free_port()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(workdir)
+        benchmark = AuthBenchmark(args)
+        server = benchmark.start_server()
+        try:
+            results = asyncio.run(benchmark.run())
+        finally:
+            benchmark.server.should_exit = True
+            server.join(timeout=10)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
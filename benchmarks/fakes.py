@@ -0,0 +1,460 @@
+"""
+Local stand-ins for Groq, Supabase (PostgREST) and S3, served from one FastAPI app.
+
+Each service has configurable latency and error injection so the pipeline can be
+measured without live credentials:
+
+    python -m benchmarks.fakes --port 9100 --groq-latency-ms 800 --groq-error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+@dataclass
+class Faults:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+
+    async def delay(self, extra_ms: float = 0.0) -> None:
+        total = self.latency_ms + extra_ms + random.uniform(0, self.jitter_ms)
+        if total > 0:
+            await asyncio.sleep(total / 1000)
+
+    def should_fail(self) -> bool:
+        return random.random() < self.error_rate
+
+class RateLimits:
+    """Per-model request and token limits over a sliding minute, answered like Groq's."""
+
+    def __init__(self, rpm: float = 0.0, tpm: float = 0.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests: Dict[str, deque] = defaultdict(deque)
+        self.tokens: Dict[str, deque] = defaultdict(deque)
+
+    def _trim(self, model: str, now: float) -> None:
+        for window in (self.requests[model], self.tokens[model]):
+            while window and window[0][0] <= now - 60:
+                window.popleft()
+
+    def _used(self, model: str) -> int:
+        return sum(tokens for _, tokens in self.tokens[model])
+
+    def check(self, model: str, tokens: int) -> Optional[float]:
+        """Records the request and returns None, or the seconds to wait if it's over a limit."""
+        now = time.time()
+        self._trim(model, now)
+        if self.rpm and len(self.requests[model]) >= self.rpm:
+            return self.requests[model][0][0] + 60 - now
+        if self.tpm and self.tokens[model] and self._used(model) + tokens > self.tpm:
+            return self.tokens[model][0][0] + 60 - now
+        self.requests[model].append((now, 1))
+        self.tokens[model].append((now, tokens))
+        return None
+
+    def headers(self, model: str) -> Dict[str, str]:
+        if not self.tpm:
+            return {}
+        return {"x-ratelimit-limit-tokens": str(int(self.tpm)), "x-ratelimit-remaining-tokens": str(max(0, int(self.tpm - self._used(model))))}
+
+    def rejected(self, model: str, retry_after: float) -> JSONResponse:
+        headers = {**self.headers(model), "retry-after": str(math.ceil(retry_after))}
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status_code=429, headers=headers)
+
+WORDS = (
+    "thanks for calling support my internet has been dropping every evening since the upgrade "
+    "could you check the line and the router settings I already restarted it twice today"
+).split()
+
+def _completion(model: str, message: Dict[str, Any], finish_reason: str) -> Dict[str, Any]:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+    }
+
+def _fake_value(schema: Dict[str, Any]) -> Any:
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: _fake_value(prop) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fake_value(schema.get("items", {}))]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    return "synthetic"
+
+def _fake_reply(body: Dict[str, Any]) -> Dict[str, Any]:
+    model = body.get("model", "fake")
+    tools = body.get("tools") or []
+    if tools:
+        # Structured output: answer with the first tool, arguments built from its schema
+        function = tools[0]["function"]
+        arguments = json.dumps(_fake_value(function.get("parameters", {})))
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{"id": f"call_{uuid.uuid4().hex[:8]}", "type": "function", "function": {"name": function["name"], "arguments": arguments}}],
+        }
+        return _completion(model, message, "tool_calls")
+
+    prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+    if "redaction assistant" in prompt:
+        content = json.dumps({"redact": [], "spans": []})
+    else:
+        content = " ".join(random.choice(WORDS) for _ in range(120))
+    return _completion(model, {"role": "assistant", "content": content}, "stop")
+
+async def _stream_reply(reply: Dict[str, Any], token_ms: float = 0.0):
+    content = reply["choices"][0]["message"].get("content") or ""
+    words = content.split(" ")
+    for i, word in enumerate(words):
+        chunk = {
+            "id": reply["id"],
+            "object": "chat.completion.chunk",
+            "created": reply["created"],
+            "model": reply["model"],
+            "choices": [{"index": 0, "delta": {"content": word + (" " if i < len(words) - 1 else "")}, "finish_reason": None}],
+        }
+        if token_ms:
+            await asyncio.sleep(token_ms / 1000)
+        yield f"data: {json.dumps(chunk)}\n\n"
+    done = {**reply, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+# --- PostgREST ---
+
+def _coerce(value: str) -> Any:
+    if value in ("true", "false"):
+        return value == "true"
+    if value == "null":
+        return None
+    return value
+
+def _match(row: Dict[str, Any], column: str, expr: str) -> bool:
+    op, _, raw = expr.partition(".")
+    negate = op == "not"
+    if negate:
+        op, _, raw = raw.partition(".")
+    value = row.get(column)
+    raw = raw.strip('"')
+    target = _coerce(raw)
+    if op == "eq":
+        result = str(value) == str(target) if value is not None and target is not None else value == target
+    elif op == "neq":
+        result = str(value) != str(target)
+    elif op in ("gt", "gte", "lt", "lte"):
+        if value is None:
+            return False
+        a, b = str(value), str(target)
+        result = {"gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+    elif op in ("like", "ilike"):
+        needle = str(target).replace("*", "%").strip("%")
+        hay = str(value or "")
+        result = needle.lower() in hay.lower() if op == "ilike" else needle in hay
+    elif op == "in":
+        result = str(value) in [v.strip('"') for v in raw.strip("()").split(",")]
+    elif op == "is":
+        result = value is target
+    else:
+        result = True
+    return not result if negate else result
+
+def _split_top(expr: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for ch in expr:
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += ch == "("
+        depth -= ch == ")"
+        current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+def _match_logic(row: Dict[str, Any], expr: str, any_of: bool) -> bool:
+    results = []
+    for part in _split_top(expr.strip("()")):
+        if part.startswith("and("):
+            results.append(_match_logic(row, part[3:], any_of=False))
+        elif part.startswith("or("):
+            results.append(_match_logic(row, part[2:], any_of=True))
+        else:
+            column, _, rest = part.partition(".")
+            results.append(_match(row, column, rest))
+    return any(results) if any_of else all(results)
+
+class FakeDatabase:
+    RESERVED = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _filtered(self, table: str, params) -> List[Dict[str, Any]]:
+        rows = self.tables.setdefault(table, [])
+        for column, expr in params:
+            if column in self.RESERVED or "." in column:
+                continue
+            if column == "or":
+                rows = [r for r in rows if _match_logic(r, expr, any_of=True)]
+            elif column == "and":
+                rows = [r for r in rows if _match_logic(r, expr, any_of=False)]
+            else:
+                rows = [r for r in rows if _match(r, column, expr)]
+        return rows
+
+    def select(self, table: str, params) -> List[Dict[str, Any]]:
+        rows = list(self._filtered(table, params))
+        query = dict(params)
+        for order in reversed((query.get("order") or "").split(",")):
+            if not order:
+                continue
+            column, _, direction = order.partition(".")
+            rows.sort(key=lambda r: (r.get(column) is None, str(r.get(column))), reverse=direction.startswith("desc"))
+        return rows
+
+    def insert(self, table: str, payload: Any) -> List[Dict[str, Any]]:
+        rows = payload if isinstance(payload, list) else [payload]
+        stored = []
+        for row in rows:
+            now = datetime.now(timezone.utc).isoformat()
+            row = {"id": str(uuid.uuid4()), "created_at": now, "timestamp": now, **row}
+            self.tables.setdefault(table, []).append(row)
+            stored.append(row)
+        return stored
+
+    def upsert(self, table: str, payload: Any, keys: List[str]) -> List[Dict[str, Any]]:
+        rows = payload if isinstance(payload, list) else [payload]
+        stored = []
+        for row in rows:
+            existing = next((r for r in self.tables.get(table, []) if all(str(r.get(k)) == str(row.get(k)) for k in keys)), None)
+            if existing is None:
+                stored.extend(self.insert(table, row))
+            else:
+                existing.update(row)
+                stored.append(existing)
+        return stored
+
+    def complete_call_log(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Same effect as migrations/005_complete_call_log.sql."""
+        log_id = params["p_log_id"]
+        answers = [{"call_id": log_id, **answer} for answer in params.get("p_answers") or []]
+        self.upsert("answers", answers, ["call_id", "question_id"])
+        rows = [r for r in self.tables.get("call_logs", []) if r.get("id") == log_id]
+        for row in rows:
+            row.update(params["p_update"])
+        return rows
+
+def create_app(
+    groq: Faults,
+    db: Faults,
+    s3: Faults,
+    transcribe_ms_per_mb: float = 0.0,
+    stream_token_ms: float = 0.0,
+    limits: Optional[RateLimits] = None,
+) -> FastAPI:
+    app = FastAPI()
+    limits = limits or RateLimits()
+    database = FakeDatabase()
+    objects: Dict[str, bytes] = {}
+    metadata: Dict[str, Dict[str, str]] = {}
+    uploads: Dict[str, Dict[int, bytes]] = {}
+
+    @app.get("/_health")
+    async def health():
+        return {"ok": True}
+
+    # --- Groq ---
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        retry_after = limits.check(model, len(json.dumps(body.get("messages", []))) // 4 + 200)
+        if retry_after is not None:
+            return limits.rejected(model, retry_after)
+        await groq.delay()
+        if groq.should_fail():
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status_code=429, headers={"retry-after": "1"})
+        reply = _fake_reply(body)
+        if body.get("stream"):
+            return StreamingResponse(_stream_reply(reply, stream_token_ms), media_type="text/event-stream", headers=limits.headers(model))
+        return JSONResponse(reply, headers=limits.headers(model))
+
+    @app.post("/openai/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        body = await request.body()
+        match = re.search(rb'name="model"\r\n\r\n([^\r]+)', body)
+        model = match.group(1).decode() if match else "fake"
+        retry_after = limits.check(model, 0)
+        if retry_after is not None:
+            return limits.rejected(model, retry_after)
+        size_mb = len(body) / (1024 * 1024)
+        await groq.delay(extra_ms=size_mb * transcribe_ms_per_mb)
+        if groq.should_fail():
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status_code=429, headers={"retry-after": "1"})
+
+        n_words = max(5, int(len(body) / 4000))
+        words, segments = [], []
+        t = 0.0
+        for i in range(n_words):
+            word = random.choice(WORDS)
+            words.append({"word": word, "start": round(t, 2), "end": round(t + 0.3, 2)})
+            t += 0.4
+        for i in range(0, n_words, 12):
+            chunk = words[i:i + 12]
+            segments.append({"id": len(segments), "start": chunk[0]["start"], "end": chunk[-1]["end"], "text": " " + " ".join(w["word"] for w in chunk) + "."})
+        return {
+            "task": "transcribe",
+            "language": "en",
+            "duration": t,
+            "text": " ".join(s["text"].strip() for s in segments),
+            "segments": segments,
+            "words": words,
+        }
+
+    # --- PostgREST ---
+
+    @app.post("/rest/v1/rpc/{function}")
+    async def rpc(function: str, request: Request):
+        await db.delay()
+        if function == "complete_call_log":
+            if db.should_fail():
+                return JSONResponse({"message": "injected failure"}, status_code=503)
+            return database.complete_call_log(await request.json())
+        return JSONResponse({"message": f"function {function} not found"}, status_code=404)
+
+    @app.api_route("/rest/v1/{table}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def rest(table: str, request: Request):
+        await db.delay()
+        if db.should_fail():
+            return JSONResponse({"message": "injected failure"}, status_code=503)
+
+        params = list(request.query_params.multi_items())
+        query = dict(params)
+        if request.method == "GET":
+            rows = database.select(table, params)
+            total = len(rows)
+            offset = int(query.get("offset", 0))
+            limit = int(query["limit"]) if "limit" in query else None
+            rows = rows[offset:offset + limit if limit is not None else None]
+            headers = {}
+            if "count=" in (request.headers.get("prefer") or ""):
+                headers["content-range"] = f"{offset}-{offset + max(len(rows) - 1, 0)}/{total}"
+            return JSONResponse(rows, headers=headers)
+        if request.method == "POST":
+            if "on_conflict" in query:
+                return database.upsert(table, await request.json(), query["on_conflict"].split(","))
+            return database.insert(table, await request.json())
+        matched = database._filtered(table, params)
+        if request.method == "PATCH":
+            update = await request.json()
+            for row in matched:
+                row.update(update)
+            return matched
+        database.tables[table] = [r for r in database.tables.get(table, []) if r not in matched]
+        return matched
+
+    # --- S3 (path-style) ---
+
+    @app.api_route("/{bucket}/{key:path}", methods=["GET", "PUT", "POST", "DELETE", "HEAD"])
+    async def s3_object(bucket: str, key: str, request: Request):
+        await s3.delay()
+        if s3.should_fail():
+            return Response("<Error><Code>SlowDown</Code></Error>", status_code=503, media_type="application/xml")
+
+        name = f"{bucket}/{key}"
+        query = request.query_params
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            uploads[upload_id] = {}
+            return Response(
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>",
+                media_type="application/xml",
+            )
+        if request.method == "PUT" and "uploadId" in query:
+            uploads[query["uploadId"]][int(query["partNumber"])] = await request.body()
+            return Response(headers={"ETag": f'"{uuid.uuid4().hex}"'})
+        if request.method == "POST" and "uploadId" in query:
+            parts = uploads.pop(query["uploadId"])
+            objects[name] = b"".join(parts[n] for n in sorted(parts))
+            return Response(
+                f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>\"done\"</ETag></CompleteMultipartUploadResult>",
+                media_type="application/xml",
+            )
+        if request.method == "DELETE" and "uploadId" in query:
+            uploads.pop(query["uploadId"], None)
+            return Response(status_code=204)
+        if request.method == "PUT":
+            if request.headers.get("if-none-match") == "*" and name in objects:
+                return Response("<Error><Code>PreconditionFailed</Code></Error>", status_code=412, media_type="application/xml")
+            objects[name] = await request.body()
+            metadata[name] = {k: v for k, v in request.headers.items() if k.startswith("x-amz-meta-")}
+            return Response(headers={"ETag": f'"{uuid.uuid4().hex}"'})
+        if request.method == "DELETE":
+            objects.pop(name, None)
+            return Response(status_code=204)
+        if name not in objects:
+            return Response("<Error><Code>NoSuchKey</Code></Error>", status_code=404, media_type="application/xml")
+        body = objects[name]
+        headers = {"Content-Length": str(len(body)), "ETag": '"fake"', **metadata.get(name, {})}
+        if request.method == "HEAD":
+            return Response(headers=headers)
+        return Response(body, media_type="application/octet-stream", headers=headers)
+
+    return app
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake Groq, Supabase and S3 for benchmarks")
+    parser.add_argument("--port", type=int, default=9100)
+    for service in ("groq", "db", "s3"):
+        parser.add_argument(f"--{service}-latency-ms", type=float, default=0.0)
+        parser.add_argument(f"--{service}-jitter-ms", type=float, default=0.0)
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+    parser.add_argument("--transcribe-ms-per-mb", type=float, default=0.0)
+    parser.add_argument("--stream-token-ms", type=float, default=0.0)
+    parser.add_argument("--groq-rpm", type=float, default=0.0, help="Requests per minute per model, 0 for no limit")
+    parser.add_argument("--groq-tpm", type=float, default=0.0, help="Tokens per minute per model, 0 for no limit")
+    args = parser.parse_args(argv)
+
+    def faults(service: str) -> Faults:
+        return Faults(
+            latency_ms=getattr(args, f"{service}_latency_ms"),
+            jitter_ms=getattr(args, f"{service}_jitter_ms"),
+            error_rate=getattr(args, f"{service}_error_rate"),
+        )
+
+    app = create_app(
+        faults("groq"),
+        faults("db"),
+        faults("s3"),
+        transcribe_ms_per_mb=args.transcribe_ms_per_mb,
+        stream_token_ms=args.stream_token_ms,
+        limits=RateLimits(args.groq_rpm, args.groq_tpm),
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Synthetic call recordings for benchmarks: 8 kHz mono 16-bit WAV, speech-like tone
+bursts separated by pauses so the silence-aware chunker has somewhere to cut.
+"""
+import io
+import math
+import random
+import struct
+import wave
+from typing import Dict
+
+SAMPLE_RATE = 8000
+
+# Name -> length in seconds. "long" is past the single-chunk size limit and needs ffmpeg.
+PRESETS: Dict[str, int] = {
+    "short": 60,
+    "medium": 300,
+    "long": 900,
+}
+
+def synthetic_wav(seconds: float, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    frames = bytearray()
+    remaining = int(seconds * SAMPLE_RATE)
+    while remaining > 0:
+        # A 1-4s "utterance" followed by a 0.3-1.2s pause
+        burst = min(remaining, int(rng.uniform(1.0, 4.0) * SAMPLE_RATE))
+        freq = rng.uniform(120, 300)
+        for n in range(burst):
+            envelope = math.sin(math.pi * n / burst)
+            frames += struct.pack("<h", int(12000 * envelope * math.sin(2 * math.pi * freq * n / SAMPLE_RATE)))
+        remaining -= burst
+        pause = min(remaining, int(rng.uniform(0.3, 1.2) * SAMPLE_RATE))
+        frames += b"\x00\x00" * pause
+        remaining -= pause
+
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(bytes(frames))
+    return buf.getvalue()
@@ -0,0 +1,248 @@
+"""
+Benchmarks process_log, upload_process_log and chat against the local fakes.
+
+    python -m benchmarks.run --calls 20 --concurrency 4 --recordings short,medium \\
+        --groq-latency-ms 600 --groq-error-rate 0.02 --output results.json
+
+Reports per-stage p50/p95 latency (from the pipeline's own logfire spans), calls per
+minute, Groq scheduler waits and 429s, and peak RSS as JSON so runs can be compared
+across commits. --groq-rpm/--groq-tpm make the fake Groq enforce provider limits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List
+
+import httpx
+
+from benchmarks.recordings import PRESETS, synthetic_wav
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+def _summary(values: List[float]) -> Dict[str, Any]:
+    return {"count": len(values), "p50_ms": _percentile(values, 50), "p95_ms": _percentile(values, 95), "max_ms": round(max(values), 2)}
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+def start_fakes(args) -> subprocess.Popen:
+    command = [sys.executable, "-m", "benchmarks.fakes", "--port", str(args.port)]
+    for service in ("groq", "db", "s3"):
+        for knob in ("latency_ms", "jitter_ms", "error_rate"):
+            command += [f"--{service}-{knob.replace('_', '-')}", str(getattr(args, f"{service}_{knob}"))]
+    command += ["--transcribe-ms-per-mb", str(args.transcribe_ms_per_mb)]
+    command += ["--groq-rpm", str(args.groq_rpm), "--groq-tpm", str(args.groq_tpm)]
+    process = subprocess.Popen(command)
+
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{args.port}/_health", timeout=1).raise_for_status()
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Fake services did not start")
+
+def configure_environment(args, workdir: str) -> None:
+    """Points every client at the fakes. Must run before the app modules are imported."""
+    base_url = f"http://127.0.0.1:{args.port}"
+    os.environ.update({
+        # Test mode fills in stand-in credentials and points Groq, S3 and Supabase here
+        "TEST_MODE": "1",
+        "TEST_SERVICES_URL": base_url,
+        "LOGFIRE_SEND_TO_LOGFIRE": "false",
+        # Every call should pay for the full pipeline
+        "CACHE_BACKEND": args.cache_backend,
+        "JOB_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "CACHE_DISK_PATH": os.path.join(workdir, "cache.sqlite3"),
+        "INVALIDATION_BUS_PATH": os.path.join(workdir, "bus.sqlite3"),
+        "SEARCH_INDEX_PATH": os.path.join(workdir, "search.sqlite3"),
+    })
+    if args.groq_rpm:
+        # The scheduler is told the request limit; it learns the token limit from response headers
+        from scheduler import DEFAULT_LIMITS
+        os.environ["GROQ_RATE_LIMITS"] = json.dumps({model: [args.groq_rpm, None] for model in DEFAULT_LIMITS})
+
+class Benchmark:
+    def __init__(self, args, exporter):
+        import main
+        from services import services
+
+        self.args = args
+        self.main = main
+        self.services = services
+        self.scheduler = services.groq_scheduler
+        self.exporter = exporter
+        self.base_url = f"http://127.0.0.1:{args.port}"
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def seed(self) -> Dict[str, str]:
+        async with httpx.AsyncClient(base_url=f"{self.base_url}/rest/v1") as client:
+            org = (await client.post("/organisations", json={"name": "Benchmark Org"})).json()[0]
+            await client.post("/questions", json=[
+                {"organisation_id": org["id"], "question_text": "Was the issue resolved?", "is_common": True, "is_active": True},
+                {"organisation_id": org["id"], "question_text": "Which product was discussed?", "is_common": True, "is_active": True},
+            ])
+        return {"organisation_id": org["id"]}
+
+    async def _upload(self, filename: str, audio: bytes) -> None:
+        await self.services.storage.put_bytes(filename, audio)
+
+    async def _timed(self, kind: str, coro) -> Any:
+        start = time.perf_counter()
+        try:
+            return await coro
+        except Exception as e:
+            self.errors[kind] += 1
+            print(f"[Benchmark] {kind} failed: {e!r}")
+        finally:
+            self.durations[kind].append((time.perf_counter() - start) * 1000)
+
+    async def process_call(self, kind: str, index: int, audio: bytes, organisation_id: str) -> None:
+        db = self.services.db
+        if kind == "process_log":
+            filename = f"in-8005551234-5551234567-20250101-101010-{uuid.uuid4().hex[:12]}.wav"
+        else:
+            filename = f"upload-{index}-{uuid.uuid4().hex[:12]}.wav"
+        await self._upload(filename, audio)
+        log = await db.create_call_log({"filename": filename, "organisation_id": organisation_id, "status": "processing"})
+
+        if kind == "process_log":
+            payload = await self._timed(kind, self.main.process_log(filename, log["id"], organisation_id))
+        else:
+            payload = await self._timed(kind, self.main.upload_process_log(filename, log["id"], organisation_id, db))
+        if payload is not None:
+            await self.main.complete_log(log["id"], payload)
+            return log["id"]
+
+    async def run(self) -> Dict[str, Any]:
+        seeded = await self.seed()
+        organisation_id = seeded["organisation_id"]
+        recordings = {name: synthetic_wav(PRESETS[name], seed=i) for i, name in enumerate(self.args.recordings)}
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        log_ids: List[str] = []
+
+        async def bounded(coro):
+            async with semaphore:
+                return await coro
+
+        self.exporter.clear()
+        start = time.perf_counter()
+
+        jobs = []
+        for i in range(self.args.calls):
+            audio = recordings[self.args.recordings[i % len(self.args.recordings)]]
+            kind = "process_log" if i % 2 == 0 else "upload_process_log"
+            jobs.append(bounded(self.process_call(kind, i, audio, organisation_id)))
+        log_ids = [log_id for log_id in await asyncio.gather(*jobs) if log_id]
+        pipeline_seconds = time.perf_counter() - start
+
+        chat_start = time.perf_counter()
+        chats = [
+            bounded(self._timed("chat", self.main.chat("What was the caller's problem?", log_ids[i % len(log_ids)], organisation_id, f"user{i % 4}@example.com")))
+            for i in range(self.args.chats)
+        ] if log_ids else []
+        await asyncio.gather(*chats)
+        chat_seconds = time.perf_counter() - chat_start
+        await self.services.aclose()
+
+        completed = self.args.calls - self.errors["process_log"] - self.errors["upload_process_log"]
+        return {
+            "config": {
+                "calls": self.args.calls,
+                "chats": self.args.chats,
+                "concurrency": self.args.concurrency,
+                "recordings": {name: {"seconds": PRESETS[name], "bytes": len(recordings[name])} for name in self.args.recordings},
+                "cache_backend": self.args.cache_backend,
+                "latency_ms": {"groq": self.args.groq_latency_ms, "db": self.args.db_latency_ms, "s3": self.args.s3_latency_ms},
+                "error_rate": {"groq": self.args.groq_error_rate, "db": self.args.db_error_rate, "s3": self.args.s3_error_rate},
+            },
+            "throughput": {
+                "calls_per_minute": round(completed / pipeline_seconds * 60, 2) if pipeline_seconds else 0.0,
+                "chats_per_minute": round(len(chats) / chat_seconds * 60, 2) if chats and chat_seconds else 0.0,
+            },
+            "end_to_end": {kind: _summary(values) for kind, values in self.durations.items()},
+            "stages": self._stage_summary(),
+            "errors": dict(self.errors),
+            "scheduler": self.scheduler.stats(),
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+
+    def _stage_summary(self) -> Dict[str, Any]:
+        by_name: Dict[str, List[float]] = defaultdict(list)
+        for span in self.exporter.get_finished_spans():
+            name = (span.attributes or {}).get("logfire.msg") or span.name
+            by_name[name].append((span.end_time - span.start_time) / 1e6)
+        return {name: _summary(values) for name, values in sorted(by_name.items())}
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="VoiceIQ pipeline benchmark")
+    parser.add_argument("--calls", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--recordings", default="short", help=f"Comma separated, from {', '.join(PRESETS)}")
+    parser.add_argument("--cache-backend", default="none")
+    parser.add_argument("--port", type=int, default=0)
+    for service, latency in (("groq", 300.0), ("db", 20.0), ("s3", 20.0)):
+        parser.add_argument(f"--{service}-latency-ms", type=float, default=latency)
+        parser.add_argument(f"--{service}-jitter-ms", type=float, default=latency / 4)
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+    parser.add_argument("--transcribe-ms-per-mb", type=float, default=200.0)
+    parser.add_argument("--groq-rpm", type=float, default=0.0, help="Per-model request limit enforced by the fake Groq")
+    parser.add_argument("--groq-tpm", type=float, default=0.0, help="Per-model token limit enforced by the fake Groq")
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args(argv)
+    args.recordings = [name.strip() for name in args.recordings.split(",") if name.strip()]
+    unknown = [name for name in args.recordings if name not in PRESETS]
+    if unknown:
+        parser.error(f"Unknown recordings: {', '.join(unknown)}")
+    args.port = args.port or _free_port()
+
+    fakes = start_fakes(args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configure_environment(args, workdir)
+
+            import logfire
+            from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+            from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+            import main as app_main  # noqa: F401
+
+            exporter = InMemorySpanExporter()
+            logfire.configure(send_to_logfire=False, console=False, additional_span_processors=[SimpleSpanProcessor(exporter)])
+
+            results = asyncio.run(Benchmark(args, exporter).run())
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
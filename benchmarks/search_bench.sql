@@ -0,0 +1,120 @@
+-- Search benchmark on a synthetic million-row call_logs table.
+--
+--     psql "$DATABASE_URL" -f benchmarks/search_bench.sql
+--
+-- Builds everything in a scratch schema (dropped at the end), times the old
+-- leading-wildcard ilike filters before and after the trigram indexes, and the
+-- ranked search used by search_call_logs. Run against a scratch database, not production.
+\timing on
+set client_min_messages = warning;
+
+create extension if not exists pg_trgm;
+drop schema if exists search_bench cascade;
+create schema search_bench;
+set search_path = search_bench, public;
+
+create table call_logs (
+    id uuid primary key default gen_random_uuid(),
+    organisation_id uuid not null,
+    created_at timestamptz not null,
+    call_date date,
+    call_type text,
+    caller_name text,
+    status text,
+    filename text,
+    customer_number text,
+    toll_free_did text,
+    transcription text
+);
+
+-- 1M rows across 20 organisations, the first one being a large tenant with half the rows
+insert into call_logs (organisation_id, created_at, call_date, call_type, caller_name, status, filename, customer_number, toll_free_did, transcription)
+select
+    ('00000000-0000-0000-0000-' || lpad(case when n % 2 = 0 then 0 else n % 20 end::text, 12, '0'))::uuid,
+    now() - (n || ' seconds')::interval,
+    (now() - (n || ' seconds')::interval)::date,
+    case when n % 3 = 0 then 'external' else 'in' end,
+    (array['John', 'Maria', 'Wei', 'Aisha', 'Carlos', 'Priya', 'Tom', 'Fatima', 'Liam', 'Sofia'])[1 + n % 10] || ' ' ||
+        (array['Smith', 'Garcia', 'Chen', 'Khan', 'Lopez', 'Patel', 'Brown', 'Ali', 'Murphy', 'Rossi'])[1 + (n / 10) % 10] ||
+        (n % 997)::text,
+    case when n % 50 = 0 then 'processing' else 'complete' end,
+    'in-800555' || lpad((n % 10000)::text, 4, '0') || '-' || (5550000000 + n)::text || '-20250101-101010-' || n || '.wav',
+    (5550000000 + n)::text,
+    '800555' || lpad((n % 10000)::text, 4, '0'),
+    'Thanks for calling support. My ' ||
+        (array['internet', 'router', 'bill', 'tv box', 'phone line'])[1 + n % 5] ||
+        ' has been ' || (array['dropping', 'overcharged', 'offline', 'slow', 'flickering'])[1 + (n / 5) % 5] ||
+        ' since the upgrade, could you check it?'
+from generate_series(1, 1000000) as n;
+
+create index on call_logs (organisation_id, created_at desc, id desc);
+analyze call_logs;
+
+\echo '--- Before: leading-wildcard ilike, sequential scan ---'
+explain (analyze, buffers, costs off)
+select id from call_logs
+where organisation_id = '00000000-0000-0000-0000-000000000000'
+  and caller_name ilike '%garc%'
+order by created_at desc limit 20;
+
+explain (analyze, buffers, costs off)
+select id from call_logs
+where organisation_id = '00000000-0000-0000-0000-000000000000'
+  and customer_number ilike '%555012%'
+order by created_at desc limit 20;
+
+-- Same definitions as migrations/003_call_logs_search.sql
+alter table call_logs
+    add column search_text text generated always as (
+        lower(coalesce(caller_name, '') || ' ' || coalesce(customer_number, '') || ' ' || coalesce(toll_free_did, '') || ' ' || coalesce(filename, ''))
+    ) stored;
+alter table call_logs
+    add column search_tsv tsvector generated always as (
+        setweight(to_tsvector('simple', coalesce(caller_name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(customer_number, '') || ' ' || coalesce(toll_free_did, '') || ' ' || coalesce(filename, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(transcription, '')), 'C')
+    ) stored;
+create index on call_logs using gin (search_text gin_trgm_ops);
+create index on call_logs using gin (search_tsv);
+create index on call_logs using gin (caller_name gin_trgm_ops);
+create index on call_logs using gin (customer_number gin_trgm_ops);
+analyze call_logs;
+
+\echo '--- After: the same ilike filters with trigram indexes ---'
+explain (analyze, buffers, costs off)
+select id from call_logs
+where organisation_id = '00000000-0000-0000-0000-000000000000'
+  and caller_name ilike '%garc%'
+order by created_at desc limit 20;
+
+explain (analyze, buffers, costs off)
+select id from call_logs
+where organisation_id = '00000000-0000-0000-0000-000000000000'
+  and customer_number ilike '%555012%'
+order by created_at desc limit 20;
+
+\echo '--- Ranked search: prefix, transcript and fuzzy ---'
+prepare ranked(text) as
+    with q as (
+        select
+            lower(trim($1)) as term,
+            to_tsquery('simple', array_to_string(array(
+                select quote_literal(word) || ':*'
+                from regexp_split_to_table(lower(trim($1)), '\s+') as word
+                where word <> ''
+            ), ' & ')) || websearch_to_tsquery('english', $1) as tsq
+    )
+    select c.id, c.caller_name, (ts_rank(c.search_tsv, q.tsq) + word_similarity(q.term, c.search_text))::real as rank
+    from call_logs c, q
+    where c.organisation_id = '00000000-0000-0000-0000-000000000000'
+      and (c.search_tsv @@ q.tsq or q.term <% c.search_text)
+    order by rank desc, c.created_at desc, c.id desc
+    limit 20;
+
+explain (analyze, buffers, costs off) execute ranked('maria garc');
+explain (analyze, buffers, costs off) execute ranked('5550001234');
+explain (analyze, buffers, costs off) execute ranked('router offline');
+explain (analyze, buffers, costs off) execute ranked('mraia');
+
+reset search_path;
+drop schema search_bench cascade;
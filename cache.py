@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple, Union
+
+import logfire
+
+class CacheBackend(ABC):
+    """Stores string values by key with an optional TTL in seconds."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        ...
+
+class NullCache(CacheBackend):
+    """Never stores anything; for benchmarks and debugging the uncached path."""
+
+    async def get(self, key: str) -> Optional[str]:
+        return None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        return None
+
+class MemoryCache(CacheBackend):
+    """In-process LRU bounded by entry count."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, Optional[float]]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (value, time.time() + ttl if ttl else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class DiskCache(CacheBackend):
+    """SQLite-backed cache bounded by total value size, evicting least recently used."""
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_idx ON cache (accessed_at)")
+        self._conn.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def _set(self, key: str, value: str, ttl: Optional[float]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + ttl if ttl else None, now),
+            )
+            self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            while total > self.max_bytes:
+                row = self._conn.execute("SELECT key, size FROM cache ORDER BY accessed_at LIMIT 1").fetchone()
+                if row is None:
+                    break
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (row[0],))
+                total -= row[1]
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+class RedisCache(CacheBackend):
+    """Any Redis-compatible server; size eviction is left to its maxmemory policy."""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis requires the 'redis' package") from e
+        self._client = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await self._client.set(key, value, ex=int(ttl) if ttl else None)
+
+def digest(*parts: Union[str, bytes]) -> str:
+    """Stable content hash of the given parts."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed cache for pipeline stages. Keys are a hash of the stage name and
+    everything its output depends on (input content, model, prompt version), so a
+    change to one prompt only invalidates the stage that uses it.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: Optional[float] = None, namespace: str = "voiceiq"):
+        self.backend = backend
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self._hit_counter = logfire.metric_counter("cache.hits", unit="1", description="Pipeline cache hits")
+        self._miss_counter = logfire.metric_counter("cache.misses", unit="1", description="Pipeline cache misses")
+
+    def key(self, stage: str, parts: Iterable[Union[str, bytes]]) -> str:
+        return f"{self.namespace}:{stage}:{digest(stage, *parts)}"
+
+    async def get_or_compute(
+        self,
+        stage: str,
+        parts: Iterable[Union[str, bytes]],
+        compute: Callable[[], Awaitable[Any]],
+        dumps: Callable[[Any], str] = json.dumps,
+        loads: Callable[[str], Any] = json.loads,
+    ) -> Any:
+        key = self.key(stage, parts)
+        try:
+            cached = await self.backend.get(key)
+        except Exception as e:
+            # A broken cache should cost a recompute, never a failed call
+            logfire.warn("Cache read failed for {stage}: {error!r}", stage=stage, error=e)
+            cached = None
+
+        if cached is not None:
+            try:
+                value = loads(cached)
+            except Exception as e:
+                # Corrupt, or written by an older format; recomputing overwrites it
+                logfire.warn("Cache entry for {stage} could not be decoded: {error!r}", stage=stage, error=e)
+            else:
+                self.hits[stage] = self.hits.get(stage, 0) + 1
+                self._hit_counter.add(1, {"stage": stage})
+                return value
+
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+        self._miss_counter.add(1, {"stage": stage})
+        value = await compute()
+        try:
+            await self.backend.set(key, dumps(value), self.ttl)
+        except Exception as e:
+            logfire.warn("Cache write failed for {stage}: {error!r}", stage=stage, error=e)
+        return value
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stages = sorted(set(self.hits) | set(self.misses))
+        return {
+            stage: {
+                "hits": self.hits.get(stage, 0),
+                "misses": self.misses.get(stage, 0),
+                "hit_rate": round(self.hits.get(stage, 0) / (self.hits.get(stage, 0) + self.misses.get(stage, 0)), 3),
+            }
+            for stage in stages
+        }
+
+def create_result_cache(settings) -> ResultCache:
+    if settings.cache_backend == "redis":
+        backend: CacheBackend = RedisCache(settings.redis_url)
+    elif settings.cache_backend == "disk":
+        backend = DiskCache(settings.cache_disk_path, max_bytes=settings.cache_max_mb * 1024 * 1024)
+    elif settings.cache_backend == "none":
+        backend = NullCache()
+    elif settings.cache_backend == "memory":
+        backend = MemoryCache(max_entries=settings.cache_max_entries)
+    else:
+        raise ValueError(f"Unknown cache backend: {settings.cache_backend}")
+    return ResultCache(backend, ttl=settings.cache_ttl_seconds)
@@ -1,65 +1,273 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Union
+import asyncio
+import base64
 import datetime
-from supabase import AsyncClient
+import json
+import time
+import uuid
+import httpx
+import logfire
+from postgrest import AsyncPostgrestClient
+from org_config import OrgConfig, OrgConfigCache
+from auth import ExpiringLRU
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """Async PostgREST client whose HTTP/2 session has configurable pool limits."""
+
+    def __init__(self, base_url: str, *, headers: Dict[str, str], limits: httpx.Limits, timeout: Union[int, float, httpx.Timeout]):
+        self.limits = limits
+        super().__init__(base_url, headers=headers, timeout=timeout)
+
+    def create_session(
+        self,
+        base_url: str,
+        headers: Dict[str, str],
+        timeout: Union[int, float, httpx.Timeout],
+        verify: bool = True,
+        proxy: Optional[str] = None,
+    ) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=self.limits,
+        )
+
+def create_postgrest_client(
+    supabase_url: str,
+    supabase_key: str,
+    max_connections: int = 20,
+    max_keepalive_connections: int = 10,
+    timeout: float = 30.0,
+) -> PooledPostgrestClient:
+    return PooledPostgrestClient(
+        f"{supabase_url.rstrip('/')}/rest/v1",
+        headers={
+            "apiKey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        },
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+        timeout=timeout,
+    )
+
+async def execute_query(query, name: str):
+    """Awaits a PostgREST query inside a timing span."""
+    with logfire.span("db {name}", name=name):
+        return await query.execute()
+
+class CountCache:
+    """Row counts per organisation and filter, dropped whenever that organisation's logs change."""
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._entries: Dict[str, Dict[str, Tuple[int, float]]] = {}
+
+    def get(self, organisation_id: str, key: str) -> Optional[int]:
+        entry = self._entries.get(organisation_id, {}).get(key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def set(self, organisation_id: str, key: str, count: int) -> None:
+        self._entries.setdefault(organisation_id, {})[key] = (count, time.time() + self.ttl)
+
+    def invalidate(self, organisation_id: Optional[str] = None) -> None:
+        if organisation_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(organisation_id, None)
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Opaque cursor for the (created_at, id) position of a row."""
+    raw = json.dumps([row["created_at"], row["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    The (created_at, id) a cursor points at. Both go into a PostgREST filter, so a
+    cursor is only accepted if they really are an ISO timestamp and a UUID.
+    """
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        datetime.datetime.fromisoformat(created_at)
+        return created_at, str(uuid.UUID(id))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def keyset_page(query, limit: int, cursor: Optional[str] = None, desc: bool = True):
+    """
+    Orders by (created_at, id) and seeks past the cursor instead of using an offset, so
+    every page costs the same as the first. Fetches one extra row to detect a next page.
+    """
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        op = "lt" if desc else "gt"
+        query = query.or_(f'created_at.{op}."{created_at}",and(created_at.eq."{created_at}",id.{op}.{id})')
+    return query.order("created_at", desc=desc).order("id", desc=desc).limit(limit + 1)
 
 class DatabaseHandler:
     def __init__(self, deps):
-        self.client : AsyncClient = deps.supabase_client
+        self.client : AsyncPostgrestClient = deps.postgrest_client
+        self.counts : CountCache = deps.log_counts
+        self.org_configs : OrgConfigCache = deps.org_configs
+        self.users : ExpiringLRU = deps.users
         self.table : str = "call_logs"
     
     # Create Organisation
     async def create_organisation(self, name: str) -> str:
-        response = self.client.table("organisations").insert({"name": name}).execute()
+        response = await execute_query(self.client.table("organisations").insert({"name": name}), "create_organisation")
         if response.data and len(response.data) > 0:
             return response.data[0]["id"]
         raise Exception("Failed to create organisation")
 
     # Create
     async def create_call_log(self, data: Dict[str, Any]) -> Dict:
-        response = self.client.table(self.table).insert(data).execute()
+        response = await execute_query(self.client.table(self.table).insert(data), "create_call_log")
+        self.counts.invalidate(data.get("organisation_id"))
         return response.data[0] if response.data else {}
 
+    async def create_call_logs(self, rows: List[Dict[str, Any]], batch_size: int = 500) -> List[Dict]:
+        """Inserts many call logs with one insert per batch_size rows; rows must share the same keys."""
+        created: List[Dict] = []
+        for start in range(0, len(rows), batch_size):
+            response = await execute_query(self.client.table(self.table).insert(rows[start:start + batch_size]), "create_call_logs")
+            created.extend(response.data or [])
+        for organisation_id in {row.get("organisation_id") for row in rows}:
+            self.counts.invalidate(organisation_id)
+        return created
+
     # Get all columns, limited rows
     async def get_all_logs(self) -> List[Dict]:
-        response = self.client.table(self.table).select("id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status, filename").order("created_at", desc=True).execute()
+        response = await execute_query(self.client.table(self.table).select("id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status, filename").order("created_at", desc=True), "get_all_logs")
         return response.data or []
     
     async def get_log(self, id: str) -> List[Dict]:
-        response = self.client.table(self.table).select("*").eq("id",id).order("created_at", desc=True).execute()
+        response = await execute_query(self.client.table(self.table).select("*").eq("id",id).order("created_at", desc=True), "get_log")
         return response.data or []
     
     # get count
     async def get_logs_count(self, organisation_id: str):
-        response = (
+        total = self.counts.get(organisation_id, "all")
+        if total is None:
+            query = (
+                self.client.table(self.table)
+                .select("id", count="exact")
+                .eq("organisation_id", organisation_id)
+            )
+            response = await execute_query(query, "get_logs_count")
+            total = response.count or 0
+            self.counts.set(organisation_id, "all", total)
+        return total
+    
+    # Get all logs with pagination
+    async def get_logs_paginated(
+        self,
+        limit: int,
+        organisation_id: str,
+        cursor: Optional[str] = None,
+        offset: int = 0,
+        exact_count: bool = False,
+    ) -> Dict[str, Any]:
+        query = (
             self.client.table(self.table)
-            .select("id", count="exact")
+            .select("id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status,filename,created_at")
             .eq("organisation_id", organisation_id)
-            .execute()
         )
-        return response.count or 0
-    
-    # Get all logs with pagination
-    async def get_logs_paginated(self, limit: int, offset: int, organisation_id: str):
-        response = (
+        count_query = (
             self.client.table(self.table)
-            .select("id,call_type,call_date,caller_name,toll_free_did,customer_number,report_generated, status,filename")
+            .select("id", count="exact")
             .eq("organisation_id", organisation_id)
-            .order("created_at", desc=True)
-            .range(offset, offset + limit - 1)
-            .execute()
         )
+        return await self.paginate_logs(
+            query,
+            count_query,
+            organisation_id=organisation_id,
+            limit=limit,
+            cursor=cursor,
+            offset=offset,
+            exact_count=exact_count,
+            name="get_logs_paginated",
+        )
+
+    async def paginate_logs(
+        self,
+        query,
+        count_query,
+        organisation_id: str,
+        limit: int,
+        cursor: Optional[str] = None,
+        offset: int = 0,
+        desc: bool = True,
+        sort_column: str = "created_at",
+        count_key: str = "all",
+        exact_count: bool = False,
+        name: str = "paginate_logs",
+    ) -> Dict[str, Any]:
+        """
+        Returns one page of an organisation's logs plus the total. Pages are read with a
+        (created_at, id) keyset; offsets are still accepted for old clients and for sorts
+        on other columns. The total comes from the count cache unless exact_count is set,
+        and when it has to be queried it runs alongside the page query.
+
+        Raises ValueError for a cursor with any other sort, which would otherwise be
+        silently ignored and return the first page again.
+        """
+        if cursor and sort_column != "created_at":
+            raise ValueError(f"cursor paging only supports sorting by created_at, not {sort_column}; use offset")
+        keyset = sort_column == "created_at" and (cursor or not offset)
+        if keyset:
+            page_query = keyset_page(query, limit, cursor, desc=desc)
+        else:
+            page_query = query.order(sort_column, desc=desc).order("id", desc=desc).range(offset, offset + limit)
+
+        total = None if exact_count else self.counts.get(organisation_id, count_key)
+        if total is None:
+            response, count_response = await asyncio.gather(
+                execute_query(page_query, name),
+                execute_query(count_query, f"{name}.count"),
+            )
+            total = count_response.count or 0
+            self.counts.set(organisation_id, count_key, total)
+        else:
+            response = await execute_query(page_query, name)
+
+        rows = response.data or []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "data": rows,
+            "limit": limit,
+            "offset": 0 if keyset else offset,
+            "next_cursor": encode_cursor(rows[-1]) if has_more and sort_column == "created_at" else None,
+            "total": total,
+        }
+
+    # Ranked search over caller name, customer number, DID, filename and transcript
+    async def search_logs(self, organisation_id: str, text: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        query = self.client.rpc("search_call_logs", {
+            "p_organisation_id": organisation_id,
+            "p_query": text,
+            "p_limit": limit,
+            "p_offset": offset,
+        })
+        response = await execute_query(query, "search_logs")
         return response.data or []
 
-    
     # Get specific columns, limited rows
     async def get_columns(self, columns: List[str], limit: int) -> List[Dict]:
         column_str = ", ".join(columns)
-        response = self.client.table(self.table).select(column_str).limit(limit).execute()
+        response = await execute_query(self.client.table(self.table).select(column_str).limit(limit), "get_columns")
         return response.data or []
 
     # Get report by uuid
     async def get_report(self, uuid: str) -> Dict:
-        response = self.client.table(self.table).select("report_generated").eq("id", uuid).execute()
+        response = await execute_query(self.client.table(self.table).select("report_generated").eq("id", uuid), "get_report")
         return response.data or []
     
     # Get transcription by uuid
@@ -67,78 +275,139 @@ class DatabaseHandler:
     #     response = self.client.table(self.table).select("transcription").eq("id", uuid).execute()
     #     return response.data[0] or []
 
+    async def get_chat_context(self, uuid: str, organisation_id: str) -> Dict:
+        query = (
+            self.client.table(self.table)
+            .select("transcription,transcript_segments,issue_summary")
+            .eq("id", uuid)
+            .eq("organisation_id", organisation_id)
+        )
+        response = await execute_query(query, "get_chat_context")
+        return response.data[0] if response.data else {}
+
     async def get_transcription(self, uuid: str) -> Dict:
-        response = self.client.table(self.table).select("transcription").eq("id", uuid).execute()
+        response = await execute_query(self.client.table(self.table).select("transcription").eq("id", uuid), "get_transcription")
         if response.data and len(response.data) > 0:
             return response.data[0]
         return {}  # or return None, depending on your usage
     
     async def get_all_by_dates(self, start_date: datetime, end_date: datetime) -> List[Dict]:
-        response = (
+        query = (
             self.client.table(self.table)
             .select("*")
             .gte("call_date", start_date.isoformat())
             .lte("call_date", end_date.isoformat())
             .order("call_date", desc=True)
-            .execute()
         )
+        response = await execute_query(query, "get_all_by_dates")
         return response.data or []
 
     async def file_exists(self, filename: str) -> bool:
-        response = self.client.table(self.table).select("id").eq("filename", filename).execute()
+        response = await execute_query(self.client.table(self.table).select("id").eq("filename", filename), "file_exists")
         return bool(response.data)
 
+    async def existing_filenames(self, filenames: List[str], batch_size: int = 200) -> set:
+        """The subset of filenames already uploaded, with one `in` query per batch_size names."""
+        existing = set()
+        for start in range(0, len(filenames), batch_size):
+            query = self.client.table(self.table).select("filename").in_("filename", filenames[start:start + batch_size])
+            response = await execute_query(query, "existing_filenames")
+            existing.update(row["filename"] for row in response.data or [])
+        return existing
+
     # Update
     async def update_call_log(self, call_id: str, update_data: Dict[str, Any]) -> Dict:
-        response = self.client.table(self.table).update(update_data).eq("id", call_id).execute()
+        response = await execute_query(self.client.table(self.table).update(update_data).eq("id", call_id), "update_call_log")
+        # Filtered counts (status, caller name, ...) can change on update too
+        for row in response.data or []:
+            self.counts.invalidate(row.get("organisation_id"))
         return response.data[0] if response.data else {}
 
+    async def update_call_logs(self, call_ids: List[str], update_data: Dict[str, Any], batch_size: int = 200) -> int:
+        """Applies the same update to many call logs, with one `in` query per batch_size ids. Returns rows updated."""
+        updated = 0
+        for start in range(0, len(call_ids), batch_size):
+            query = self.client.table(self.table).update(update_data).in_("id", call_ids[start:start + batch_size])
+            response = await execute_query(query, "update_call_logs")
+            for organisation_id in {row.get("organisation_id") for row in response.data or []}:
+                self.counts.invalidate(organisation_id)
+            updated += len(response.data or [])
+        return updated
+
     # Delete
     async def delete_call_log(self, id: str) -> bool:
-        response = self.client.table(self.table).delete().eq("id", id).execute()
+        response = await execute_query(self.client.table(self.table).delete().eq("id", id), "delete_call_log")
+        for row in response.data or []:
+            self.counts.invalidate(row.get("organisation_id"))
         return bool(response.data)
 
 
     # User stuff
     async def get_user_by_email(self, email: str) -> Dict:
-        response = self.client.table("users").select("*").eq("email", email).execute()
-        return response.data[0] if response.data else {}
+        user = self.users.get(email)
+        if user is not None:
+            return user
+        response = await execute_query(self.client.table("users").select("*").eq("email", email), "get_user_by_email")
+        # Misses aren't cached, so a user created by another worker is found straight away
+        if not response.data:
+            return {}
+        self.users.set(email, response.data[0])
+        return response.data[0]
 
     async def create_user(self, email: str, hashed_password: str, organisation_id: str, role: str) -> bool:
-        response = self.client.table("users").insert({
+        query = self.client.table("users").insert({
             "email": email,
             "hashed_password": hashed_password,
             "organisation_id": organisation_id,
             "role": role
-        }).execute()
+        })
+        response = await execute_query(query, "create_user")
+        self.users.pop(email)
         return bool(response.data and len(response.data) > 0)
     
     # Get common questions for an organisation
-    async def get_common_questions(self, organisation_id: str) -> List[Dict[str, Any]]:
-        response = (
+    async def _load_org_config(self, organisation_id: str) -> OrgConfig:
+        query = (
             self.client.table("questions")
-            .select("*")
-            .eq("is_common", True)
+            .select("id", "question_text", "is_active", "is_common")
             .eq("organisation_id", organisation_id)
-            .execute()
         )
-        return response.data if response.data else []
+        response = await execute_query(query, "get_org_config")
+        return OrgConfig(organisation_id=organisation_id, questions=response.data or [], loaded_at=time.time())
 
-    # Create answer (ensure data contains organisation_id)
-    async def create_answer(self, data: Dict[str, Any]) -> Dict:
-        print("Completed")
-        response = self.client.table("answers").insert(data).execute()
-        return response.data[0] if response.data else {}
+    async def get_org_config(self, organisation_id: str) -> OrgConfig:
+        """The organisation's questions, cached and shared by every call processed for it."""
+        return await self.org_configs.get_or_load(organisation_id, lambda: self._load_org_config(organisation_id))
+
+    async def get_common_questions(self, organisation_id: str) -> List[Dict[str, Any]]:
+        config = await self.get_org_config(organisation_id)
+        return config.common_questions
+
+    async def complete_call_log(self, log_id: str, update_data: Dict[str, Any], answers: List[Dict[str, Any]]) -> Dict:
+        """
+        Saves a processed call's answers and its completed row in one transaction
+        (the complete_call_log function, migrations/005). Safe to repeat.
+        """
+        params = {
+            "p_log_id": log_id,
+            "p_update": update_data,
+            "p_answers": [{"question_id": a["question_id"], "answer_text": a["answer_text"]} for a in answers],
+        }
+        response = await execute_query(self.client.rpc("complete_call_log", params), "complete_call_log")
+        rows = response.data or []
+        for row in rows:
+            self.counts.invalidate(row.get("organisation_id"))
+        return rows[0] if rows else {}
 
     # Get answers by callid for an organisation
     async def get_answers_by_callid(self, call_id: str, organisation_id: str) -> List[Dict[str, str]]:
-        response = (
+        query = (
             self.client.table("answers")
             .select("questions(question_text),answer_text,call_logs(organisation_id)")
             .eq("call_id", call_id)
             .eq("call_logs.organisation_id", organisation_id)
-            .execute()
         )
+        response = await execute_query(query, "get_answers_by_callid")
         if not response.data:
             return []
         return [
@@ -152,21 +421,16 @@ class DatabaseHandler:
     
     # Delete all answers for a call log
     async def delete_answers_by_callid(self, call_id: str):
-        self.client.table("answers").delete().eq("call_id", call_id).execute()
+        await execute_query(self.client.table("answers").delete().eq("call_id", call_id), "delete_answers_by_callid")
 
     # Get all questions for an organisation
     async def get_all_questions(self, organisation_id: str) -> List[Dict[str, Any]]:
-        response = (
-            self.client.table("questions")
-            .select("id", "question_text", "is_active")
-            .eq("organisation_id", organisation_id)
-            .execute()
-        )
-        return response.data if response.data else []
+        config = await self.get_org_config(organisation_id)
+        return [{"id": q["id"], "question_text": q["question_text"], "is_active": q["is_active"]} for q in config.questions]
 
     # Update question text for an organisation
     async def update_question_text(self, id: str, question_text: str, is_active: bool, organisation_id: str) -> bool:
-        response = (
+        query = (
             self.client
             .table("questions")
             .update({
@@ -175,24 +439,26 @@ class DatabaseHandler:
             })
             .eq("id", id)
             .eq("organisation_id", organisation_id)
-            .execute()
         )
+        response = await execute_query(query, "update_question_text")
+        await self.org_configs.invalidate(organisation_id)
         return bool(response.data)  # True if row was updated, False otherwise
     
     # Delete question from an organisation
     async def delete_question(self,id:str,organisation_id: str) -> bool:
-        response = (self.client
+        query = (self.client
         .table("questions")
         .delete()
         .eq("id",id)
         .eq("organisation_id",organisation_id)
-        .execute()
         )
+        response = await execute_query(query, "delete_question")
+        await self.org_configs.invalidate(organisation_id)
         return bool (response.data)
     
     # Add question in an organization
     async def add_question(self,question_text:str,organisation_id: str,is_active:bool) -> bool:
-        response = (self.client
+        query = (self.client
         .table("questions")
         .insert(
             {
@@ -201,12 +467,13 @@ class DatabaseHandler:
                 "is_active":is_active
             }
         )
-        .execute()
         )
+        response = await execute_query(query, "add_question")
+        await self.org_configs.invalidate(organisation_id)
         return bool (response.data)
 
     # Fetch all organisations
     async def get_all_organisations(self) -> List[Dict]:
-        response = self.client.table("organisations").select("*").execute()
+        response = await execute_query(self.client.table("organisations").select("*"), "get_all_organisations")
         return response.data or []
 
@@ -0,0 +1,323 @@
+import asyncio
+import os
+import tarfile
+import uuid
+import zipfile
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import logfire
+
+from filename_parser import parse_call_filename
+
+ALLOWED_EXTS = (".wav", ".mp3")
+# Per-file problems kept in the batch record; the counts are always complete
+MAX_REPORTED = 100
+# Save progress to the batch record every this many uploads
+PROGRESS_EVERY = 50
+
+class ArchiveSource:
+    """Recordings inside a zip or tar (optionally compressed) file on local disk."""
+
+    kind = "archive"
+
+    def __init__(self, path: str):
+        self.path = path
+        if zipfile.is_zipfile(path):
+            self._zip: Optional[zipfile.ZipFile] = zipfile.ZipFile(path)
+            self._tar: Optional[tarfile.TarFile] = None
+        else:
+            try:
+                self._tar = tarfile.open(path, "r:*")
+            except tarfile.TarError:
+                raise ValueError("Expected a zip or tar archive")
+            self._zip = None
+        self._members: Dict[str, Any] = {}
+
+    def names(self) -> List[str]:
+        if self._zip is not None:
+            members = [info for info in self._zip.infolist() if not info.is_dir()]
+            self._members = {info.filename: info for info in members}
+        else:
+            self._members = {info.name: info for info in self._tar.getmembers() if info.isfile()}
+        return list(self._members)
+
+    def read(self, name: str) -> bytes:
+        # Members are read in archive order, so compressed tars are only decompressed once
+        if self._zip is not None:
+            return self._zip.read(self._members[name])
+        return self._tar.extractfile(self._members[name]).read()
+
+    def close(self) -> None:
+        (self._zip or self._tar).close()
+        os.remove(self.path)
+
+class ManifestSource:
+    """Recordings already in object storage, listed by filename."""
+
+    kind = "manifest"
+
+    def __init__(self, filenames: List[str], source_bucket: Optional[str] = None, source_prefix: str = ""):
+        self.filenames = filenames
+        self.source_bucket = source_bucket
+        self.source_prefix = source_prefix
+
+    def names(self) -> List[str]:
+        return list(self.filenames)
+
+    def read(self, name: str) -> None:
+        return None
+
+    def close(self) -> None:
+        pass
+
+class BulkIngestor:
+    """
+    Ingests a whole recording dump as one batch.
+
+    Filenames are parsed and checked up front, duplicates are found with one query
+    per few hundred names, and the initial call_logs rows go in with batched inserts.
+    Objects are then uploaded with bounded concurrency, and each one is queued for
+    processing as soon as it lands, at a lower priority than interactive uploads so
+    the job queue's workers stay the only limit on processing.
+    """
+
+    def __init__(
+        self,
+        db,
+        storage,
+        job_queue,
+        upload_concurrency: int = 8,
+        insert_batch_size: int = 500,
+        priority: int = 10,
+        source_buckets: str = "",
+    ):
+        self.db = db
+        self.storage = storage
+        # (bucket, key prefix) pairs that manifests may copy from, with our credentials
+        self.source_buckets = [
+            (entry.partition("/")[0], entry.partition("/")[2])
+            for entry in (part.strip() for part in source_buckets.split(","))
+            if entry
+        ]
+        self.job_queue = job_queue
+        self.upload_concurrency = upload_concurrency
+        self.insert_batch_size = insert_batch_size
+        self.priority = priority
+        self._tasks: Set[asyncio.Task] = set()
+
+    def allows(self, source) -> bool:
+        """Whether a source may be read from: our own bucket, or one on the allow-list under an allowed prefix."""
+        bucket = getattr(source, "source_bucket", None)
+        if not bucket or bucket == self.storage.bucket:
+            return True
+        return any(bucket == allowed and source.source_prefix.startswith(prefix) for allowed, prefix in self.source_buckets)
+
+    async def start(self, source, organisation_id: str) -> str:
+        """Records a new batch and ingests it in the background. Returns the batch id."""
+        batch_id = str(uuid.uuid4())
+        info = {
+            "status": "received",
+            "source": source.kind,
+            "received": 0,
+            "accepted": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "created": 0,
+            "uploaded": 0,
+            "upload_failed": 0,
+            "errors": [],
+        }
+        await self.job_queue.save_batch(batch_id, organisation_id, info)
+        task = asyncio.ensure_future(self._run(batch_id, organisation_id, source, info))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return batch_id
+
+    async def status(self, batch_id: str, organisation_id: str) -> Optional[Dict[str, Any]]:
+        batch = await self.job_queue.batch_status(batch_id)
+        if batch is None or batch["organisation_id"] != organisation_id:
+            return None
+        info, jobs = batch["info"], batch["jobs"]
+        status = info["status"]
+        if status == "queued" and not jobs.get("queued") and not jobs.get("running"):
+            status = "complete"
+        return {
+            "batch_id": batch_id,
+            **info,
+            "status": status,
+            "processing": {
+                "queued": jobs.get("queued", 0),
+                "running": jobs.get("running", 0),
+                "done": jobs.get("done", 0),
+                "failed": jobs.get("failed", 0),
+            },
+            "created_at": batch["created_at"],
+            "updated_at": batch["updated_at"],
+        }
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _report(self, info: Dict[str, Any], filename: str, error: str) -> None:
+        if len(info["errors"]) < MAX_REPORTED:
+            info["errors"].append({"filename": filename, "error": error})
+
+    async def _run(self, batch_id: str, organisation_id: str, source, info: Dict[str, Any]) -> None:
+        log_ids: Dict[str, str] = {}
+        # Rows that were queued for processing or already marked failed
+        settled: Set[str] = set()
+        try:
+            with logfire.span("ingest batch {batch_id}", batch_id=batch_id, source=source.kind):
+                names = await asyncio.to_thread(source.names)
+                info["received"] = len(names)
+                entries, rows = await self._plan(names, organisation_id, info)
+
+                with logfire.span("ingest insert", rows=len(rows)):
+                    created = await self.db.create_call_logs(rows, batch_size=self.insert_batch_size)
+                log_ids.update((row["filename"], row["id"]) for row in created)
+                info["created"] = len(log_ids)
+                info["status"] = "uploading"
+                await self.job_queue.save_batch(batch_id, organisation_id, info)
+
+                await self._upload_all(batch_id, organisation_id, source, entries, log_ids, info, settled)
+                info["status"] = "queued"
+        except asyncio.CancelledError:
+            info["status"] = "interrupted"
+            raise
+        except Exception as e:
+            logfire.exception("Ingest batch {batch_id} failed: {error}", batch_id=batch_id, error=str(e))
+            info["status"] = "failed"
+            info["error"] = str(e)
+        finally:
+            try:
+                await self._fail_unsettled(log_ids, settled, info)
+            finally:
+                await self.job_queue.save_batch(batch_id, organisation_id, info)
+                await asyncio.to_thread(source.close)
+
+    async def _fail_unsettled(self, log_ids: Dict[str, str], settled: Set[str], info: Dict[str, Any]) -> None:
+        # A batch that stops early would otherwise leave its remaining rows "processing" for good
+        unsettled = [log_id for log_id in log_ids.values() if log_id not in settled]
+        if not unsettled:
+            return
+        try:
+            await self.db.update_call_logs(unsettled, {"status": "failed"})
+        except Exception as e:
+            logfire.exception("Could not mark {count} ingest rows failed: {error}", count=len(unsettled), error=str(e))
+            return
+        info["upload_failed"] += len(unsettled)
+        settled.update(unsettled)
+
+    async def _plan(
+        self, names: List[str], organisation_id: str, info: Dict[str, Any]
+    ) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+        """Parses and deduplicates the batch. Returns (member, filename) pairs and their initial rows."""
+        parsed: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        for name in names:
+            filename = os.path.basename(name)
+            # Archive tool metadata, not recordings
+            if not filename or filename.startswith(".") or "__MACOSX" in name:
+                continue
+            if os.path.splitext(filename)[-1].lower() not in ALLOWED_EXTS:
+                info["rejected"] += 1
+                self._report(info, filename, "Only .wav or .mp3 files are supported")
+                continue
+            if filename in parsed:
+                info["duplicates"] += 1
+                continue
+            try:
+                metadata = await parse_call_filename(filename)
+            except ValueError as e:
+                info["rejected"] += 1
+                self._report(info, filename, str(e))
+                continue
+            parsed[filename] = (name, metadata)
+
+        existing = await self.db.existing_filenames(list(parsed))
+        info["duplicates"] += len(existing)
+        entries, rows = [], []
+        for filename, (name, metadata) in parsed.items():
+            if filename in existing:
+                continue
+            entries.append((name, filename))
+            rows.append({**metadata, "status": "processing", "organisation_id": organisation_id})
+        info["accepted"] = len(rows)
+        return entries, rows
+
+    async def _upload_all(
+        self,
+        batch_id: str,
+        organisation_id: str,
+        source,
+        entries: List[Tuple[str, str]],
+        log_ids: Dict[str, str],
+        info: Dict[str, Any],
+        settled: Set[str],
+    ) -> None:
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+        uploads = []
+        for name, filename in entries:
+            log_id = log_ids.get(filename)
+            if log_id is None:
+                continue
+            # Acquired before reading so at most upload_concurrency files are held in memory
+            await semaphore.acquire()
+            try:
+                body = await asyncio.to_thread(source.read, name)
+            except BaseException:
+                semaphore.release()
+                raise
+            uploads.append(asyncio.ensure_future(
+                self._upload_one(batch_id, organisation_id, source, filename, body, log_id, info, settled, semaphore)
+            ))
+        try:
+            await asyncio.gather(*uploads)
+        except asyncio.CancelledError:
+            for upload in uploads:
+                upload.cancel()
+            raise
+
+    async def _upload_one(
+        self,
+        batch_id: str,
+        organisation_id: str,
+        source,
+        filename: str,
+        body: Optional[bytes],
+        log_id: str,
+        info: Dict[str, Any],
+        settled: Set[str],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        try:
+            if body is not None:
+                await self.storage.put_bytes(filename, body)
+            elif source.source_bucket and source.source_bucket != self.storage.bucket:
+                await self.storage.copy(filename, source.source_bucket, f"{source.source_prefix}{filename}")
+            elif source.source_prefix:
+                # Elsewhere in our bucket; recordings are processed from their bare filename
+                await self.storage.copy(filename, self.storage.bucket, f"{source.source_prefix}{filename}")
+            elif await self.storage.head(filename) is None:
+                # Already in our bucket, supposedly; make sure it's really there before queueing
+                raise FileNotFoundError(f"{filename} is not in {self.storage.bucket}")
+
+            await self.job_queue.enqueue(
+                "create_log",
+                {"filename": filename, "log_id": log_id, "organisation_id": organisation_id},
+                priority=self.priority,
+                batch_id=batch_id,
+            )
+            settled.add(log_id)
+            info["uploaded"] += 1
+            if info["uploaded"] % PROGRESS_EVERY == 0:
+                await self.job_queue.save_batch(batch_id, organisation_id, info)
+        except Exception as e:
+            logfire.warn("Ingest upload of {filename} failed: {error!r}", filename=filename, error=e)
+            info["upload_failed"] += 1
+            self._report(info, filename, f"Upload failed: {e}")
+            await self.db.update_call_log(log_id, {"status": "failed"})
+            settled.add(log_id)
+        finally:
+            semaphore.release()
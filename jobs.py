@@ -0,0 +1,466 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import logfire
+
+# A stage receives the job state and returns updates to merge into it
+StageFn = Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+FailureFn = Callable[[Dict[str, Any], str], Awaitable[None]]
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    state: Dict[str, Any]
+    stage: int = 0
+    attempts: int = 0
+    status: str = "queued"
+    error: Optional[str] = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+    # Lower runs first; bulk imports queue behind interactive uploads
+    priority: int = 0
+    batch_id: Optional[str] = None
+    # The process holding the job, and until when; an expired lease can be claimed by another
+    owner: Optional[str] = None
+    lease_until: Optional[float] = None
+
+@dataclass
+class Handler:
+    stages: List[Tuple[str, StageFn]]
+    on_failure: Optional[FailureFn] = None
+    # State keys still stored once a job has finished
+    keep: Tuple[str, ...] = ()
+
+# Job kinds, registered at import by the modules that define their stages. Queues look
+# them up when a job is enqueued or run, so registering never needs (or builds) a queue.
+HANDLERS: Dict[str, Handler] = {}
+
+def register(
+    kind: str,
+    stages: List[Tuple[str, StageFn]],
+    on_failure: Optional[FailureFn] = None,
+    keep: Tuple[str, ...] = (),
+) -> None:
+    HANDLERS[kind] = Handler(stages, on_failure, tuple(keep))
+
+class JobQueue:
+    """
+    Durable background queue for call processing.
+
+    Jobs are persisted to SQLite and run through a fixed number of workers. Each job
+    is a list of named stages; progress is saved after every stage so a retry or a
+    restart resumes at the stage that failed instead of starting over.
+
+    The workers are the global processing budget: however many jobs are queued, at
+    most `concurrency` run at once, lowest priority value first.
+
+    Several processes can share one store: a job is claimed with a lease before it
+    runs, the lease is renewed while it runs, and jobs whose lease has lapsed (their
+    process died) are picked up by whichever process sweeps next. Finished jobs keep
+    only the state keys their handler lists in `keep`, and are deleted after
+    `retention_seconds`.
+
+    Job kinds come from the module-level HANDLERS unless a queue is given its own table.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        backoff_seconds: float = 5.0,
+        max_backoff_seconds: float = 300.0,
+        lease_seconds: float = 300.0,
+        sweep_seconds: float = 30.0,
+        retention_seconds: float = 7 * 24 * 3600,
+        handlers: Optional[Dict[str, Handler]] = None,
+    ):
+        self.path = path
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.sweep_seconds = sweep_seconds
+        self.retention_seconds = retention_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.handlers = HANDLERS if handlers is None else handlers
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._queued: set = set()
+        self._seq = 0
+        self._workers: List[asyncio.Task] = []
+        self._sweeper: Optional[asyncio.Task] = None
+        self._in_flight: Dict[str, Job] = {}
+        self._retrying: Dict[str, asyncio.TimerHandle] = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                state TEXT NOT NULL,
+                stage INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        # Columns added after the first release
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "priority" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "batch_id" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        if "lease_until" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch_idx ON jobs (batch_id)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                organisation_id TEXT NOT NULL,
+                info TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def register(
+        self,
+        kind: str,
+        stages: List[Tuple[str, StageFn]],
+        on_failure: Optional[FailureFn] = None,
+        keep: Tuple[str, ...] = (),
+    ) -> None:
+        """Adds a job kind to this queue's handler table (the shared HANDLERS by default)."""
+        self.handlers[kind] = Handler(stages, on_failure, tuple(keep))
+
+    # --- persistence ---
+
+    def _write(self, job: Job) -> None:
+        job.updated_at = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO jobs (id, kind, state, stage, attempts, status, error, created_at, updated_at, priority, batch_id, owner, lease_until)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    state = excluded.state,
+                    stage = excluded.stage,
+                    attempts = excluded.attempts,
+                    status = excluded.status,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at,
+                    owner = excluded.owner,
+                    lease_until = excluded.lease_until
+                """,
+                (
+                    job.id, job.kind, json.dumps(job.state, default=str), job.stage, job.attempts,
+                    job.status, job.error, job.created_at, job.updated_at, job.priority, job.batch_id,
+                    job.owner, job.lease_until,
+                ),
+            )
+            self._conn.commit()
+
+    def _read(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT id, kind, state, stage, attempts, status, error, created_at, updated_at, priority, batch_id, owner, lease_until
+                FROM jobs WHERE id = ?
+                """,
+                (job_id,),
+            ).fetchone()
+        if not row:
+            return None
+        return Job(
+            id=row[0], kind=row[1], state=json.loads(row[2]), stage=row[3], attempts=row[4],
+            status=row[5], error=row[6], created_at=row[7], updated_at=row[8], priority=row[9], batch_id=row[10],
+            owner=row[11], lease_until=row[12],
+        )
+
+    def _claim(self, job_id: str) -> Optional[Job]:
+        """Marks the job running under this process's lease, or returns None if it isn't ours to run."""
+        now = time.time()
+        with self._lock:
+            claimed = self._conn.execute(
+                """
+                UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, updated_at = ?
+                WHERE id = ? AND status IN ('queued', 'running')
+                    AND (lease_until IS NULL OR lease_until <= ? OR (status = 'queued' AND owner = ?))
+                """,
+                (self.owner, now + self.lease_seconds, now, job_id, now, self.owner),
+            ).rowcount
+            self._conn.commit()
+        return self._read(job_id) if claimed else None
+
+    def _claimable(self) -> List[Tuple[str, int]]:
+        # Unleased jobs, and jobs whose process stopped renewing the lease
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT id, priority FROM jobs
+                WHERE status IN ('queued', 'running') AND (lease_until IS NULL OR lease_until <= ?)
+                ORDER BY created_at
+                """,
+                (time.time(),),
+            ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def _renew(self, job_ids: List[str], until: float) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                [(until, job_id, self.owner) for job_id in job_ids],
+            )
+            self._conn.commit()
+
+    def _prune(self) -> int:
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM batches WHERE updated_at < ? AND id NOT IN (SELECT batch_id FROM jobs WHERE batch_id IS NOT NULL)",
+                (cutoff,),
+            )
+            self._conn.commit()
+        return deleted
+
+    def _status_counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def _batch_counts(self, batch_id: str) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def _save_batch(self, batch_id: str, organisation_id: str, info: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO batches (id, organisation_id, info, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET info = excluded.info, updated_at = excluded.updated_at
+                """,
+                (batch_id, organisation_id, json.dumps(info, default=str), now, now),
+            )
+            self._conn.commit()
+
+    def _read_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT organisation_id, info, created_at, updated_at FROM batches WHERE id = ?", (batch_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return {"organisation_id": row[0], "info": json.loads(row[1]), "created_at": row[2], "updated_at": row[3]}
+
+    def _put(self, job_id: str, priority: int) -> None:
+        # The sequence number keeps FIFO order within a priority
+        self._seq += 1
+        self._queued.add(job_id)
+        self._queue.put_nowait((priority, self._seq, job_id))
+
+    # --- public API ---
+
+    async def enqueue(
+        self,
+        kind: str,
+        state: Dict[str, Any],
+        priority: int = 0,
+        batch_id: Optional[str] = None,
+    ) -> str:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = time.time()
+        job = Job(
+            id=str(uuid.uuid4()), kind=kind, state=state, created_at=now, updated_at=now,
+            priority=priority, batch_id=batch_id,
+        )
+        await asyncio.to_thread(self._write, job)
+        self._put(job.id, priority)
+        logfire.info("Job {job_id} queued ({kind})", job_id=job.id, kind=kind)
+        return job.id
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._read, job_id)
+
+    async def start(self) -> None:
+        self._queue = asyncio.PriorityQueue()
+        self._queued.clear()
+        # Anything left unleased by a previous process is picked up again
+        resumed = await self._sweep()
+        if resumed:
+            logfire.info("Resuming {count} unfinished jobs", count=resumed)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        for handle in self._retrying.values():
+            handle.cancel()
+        self._retrying.clear()
+        tasks = [*self._workers, *([self._sweeper] if self._sweeper else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._sweeper = None
+
+    async def status(self) -> Dict[str, Any]:
+        counts = await asyncio.to_thread(self._status_counts)
+        now = time.time()
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "retrying": len(self._retrying),
+            "workers": self.concurrency,
+            "in_flight": [
+                {
+                    "id": job.id,
+                    "kind": job.kind,
+                    "stage": self.handlers[job.kind].stages[job.stage][0] if job.stage < len(self.handlers[job.kind].stages) else None,
+                    "attempts": job.attempts,
+                    "running_for_s": round(now - job.updated_at, 1),
+                }
+                for job in self._in_flight.values()
+            ],
+            "counts": counts,
+        }
+
+    async def save_batch(self, batch_id: str, organisation_id: str, info: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._save_batch, batch_id, organisation_id, info)
+
+    async def batch_status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """The batch's saved info plus a count of its jobs by status, or None if unknown."""
+        batch = await asyncio.to_thread(self._read_batch, batch_id)
+        if batch is None:
+            return None
+        batch["jobs"] = await asyncio.to_thread(self._batch_counts, batch_id)
+        return batch
+
+    # --- workers ---
+
+    def _retry_later(self, job_id: str, priority: int, delay: float) -> None:
+        def requeue():
+            self._retrying.pop(job_id, None)
+            self._put(job_id, priority)
+        self._retrying[job_id] = asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _sweep(self) -> int:
+        """Renews the leases of running jobs, queues claimable ones and prunes old ones."""
+        if self._in_flight:
+            until = time.time() + self.lease_seconds
+            for job in self._in_flight.values():
+                job.lease_until = until
+            await asyncio.to_thread(self._renew, list(self._in_flight), until)
+        found = 0
+        for job_id, priority in await asyncio.to_thread(self._claimable):
+            if job_id not in self._queued and job_id not in self._in_flight and job_id not in self._retrying:
+                self._put(job_id, priority)
+                found += 1
+        pruned = await asyncio.to_thread(self._prune)
+        if pruned:
+            logfire.info("Pruned {count} finished jobs", count=pruned)
+        return found
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_seconds)
+            try:
+                await self._sweep()
+            except Exception as e:
+                logfire.exception("Job sweep failed: {error}", error=str(e))
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logfire.exception("Job {job_id} crashed the worker: {error}", job_id=job_id, error=str(e))
+            finally:
+                self._in_flight.pop(job_id, None)
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        # Another process may hold it, or have finished it already
+        job = await asyncio.to_thread(self._claim, job_id)
+        if job is None:
+            return
+
+        handler = self.handlers[job.kind]
+        stages = handler.stages
+        self._in_flight[job.id] = job
+
+        while job.stage < len(stages):
+            name, fn = stages[job.stage]
+            try:
+                with logfire.span("job {kind}.{stage}", kind=job.kind, stage=name, job_id=job.id, attempt=job.attempts + 1):
+                    updates = await fn(job.state)
+            except Exception as e:
+                job.attempts += 1
+                job.error = f"{name}: {e!r}"
+                if job.attempts >= self.max_attempts:
+                    state = dict(job.state)
+                    await self._finish(job, "failed")
+                    logfire.error("Job {job_id} failed at {stage}: {error}", job_id=job.id, stage=name, error=job.error)
+                    if handler.on_failure:
+                        await handler.on_failure(state, job.error)
+                    return
+
+                # Free the worker while waiting; the job stays queued in the store, leased
+                # to this process until the retry is due
+                delay = min(self.backoff_seconds * 2 ** (job.attempts - 1), self.max_backoff_seconds)
+                job.status = "queued"
+                job.lease_until = time.time() + delay
+                await asyncio.to_thread(self._write, job)
+                logfire.warn("Job {job_id} retrying {stage} in {delay}s", job_id=job.id, stage=name, delay=delay)
+                self._retry_later(job.id, job.priority, delay)
+                return
+
+            job.state.update(updates or {})
+            job.stage += 1
+            job.attempts = 0
+            job.error = None
+            await asyncio.to_thread(self._write, job)
+
+        await self._finish(job, "done")
+
+    async def _finish(self, job: Job, status: str) -> None:
+        # Stage outputs (transcripts, payloads) aren't needed once the job is over
+        keep = self.handlers[job.kind].keep
+        job.state = {key: value for key, value in job.state.items() if key in keep}
+        job.status = status
+        job.owner = None
+        job.lease_until = None
+        await asyncio.to_thread(self._write, job)
@@ -1,84 +1,175 @@
-from transcription import TranscriptionService
-from santization import SanitizationService
-from agents import deps, call_log_agent, report_agent, database_agent, chat_agent, questionary_agent
-from memory import MemoryHandler
-from database import DatabaseHandler
+from transcript import Transcript
+from agents import Form, answer_field, build_extraction_model, build_retry_model
+from cache import digest
+from scheduler import INTERACTIVE, prioritized
+from services import get_settings, services
 from filename_parser import parse_call_filename
-import transcription
 from upload_filename_parser import upload_parse_call_filename
 
-from pydantic_ai.messages import SystemPromptPart, ModelRequest
+from pydantic_ai import Agent
+from pydantic_ai.messages import SystemPromptPart, ModelRequest, UserPromptPart
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional
 from uuid import UUID
+import asyncio
 import re
-from settings import Settings
+import time
 import logfire
 import json
 
-settings = Settings()
-logfire.configure(token=settings.logfire_write_token)
-transcription_service = TranscriptionService(bucket_name="call-logs-audio-files")
-sanitization_service = SanitizationService()
-memory = MemoryHandler(deps=deps)
-db = DatabaseHandler(deps=deps)
-
-@logfire.instrument("process_log")
-async def process_log(filename: str, log_id: str) -> str:
-
-    metadata = await parse_call_filename(filename=filename)
-
-    transcript = await transcription_service.transcribe(filename=filename, prompt="Transcribe and pay close attention to smaller details like names and personal details")
+settings = get_settings()
+
+async def _run_stage(name: str, coro: Awaitable[Any], timeout: float) -> Any:
+    """Run a single pipeline stage with a timeout and report its timing to logfire."""
+    start = time.perf_counter()
+    with logfire.span("stage {stage}", stage=name) as span:
+        try:
+            result = await asyncio.wait_for(coro, timeout=timeout)
+            span.set_attribute("outcome", "ok")
+            return result
+        except asyncio.TimeoutError:
+            span.set_attribute("outcome", "timeout")
+            raise
+        except Exception:
+            span.set_attribute("outcome", "error")
+            raise
+        finally:
+            span.set_attribute("duration_ms", round((time.perf_counter() - start) * 1000, 2))
+
+async def _fan_out(stages: Dict[str, Awaitable[Any]], timeout: float) -> Dict[str, Any]:
+    """
+    Runs independent stages concurrently. A failed or timed out stage maps to None
+    so the caller can still save whatever finished; only a total failure raises.
+    """
+    names = list(stages)
+    results = await asyncio.gather(
+        *(_run_stage(name, stages[name], timeout) for name in names),
+        return_exceptions=True,
+    )
 
-    sanitized_transcript = await sanitization_service.sanitize(transcript=transcript)
+    outputs: Dict[str, Any] = {}
+    errors: Dict[str, BaseException] = {}
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            errors[name] = result
+            outputs[name] = None
+            logfire.warn("Stage {stage} failed: {error!r}", stage=name, error=result)
+        else:
+            outputs[name] = result
+
+    if errors and len(errors) == len(names):
+        raise next(iter(errors.values()))
+    return outputs
+
+async def _run_agent(name: str, agent: Agent, user_prompt: str) -> Any:
+    """Runs an agent through the result cache and returns its output."""
+    async def compute():
+        response = await agent.run(user_prompt=user_prompt)
+        return response.output
+
+    return await services.result_cache.get_or_compute(f"agent.{name}", [digest(user_prompt), services.agents.versions[name]], compute)
+
+def _is_filled(value: Optional[str]) -> bool:
+    return bool(value and value.strip())
+
+async def _run_extraction(sanitized_transcript: str, question_groups: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    # One field per distinct question; its answer goes to every question in the group
+    output_model = build_extraction_model([group[0] for group in question_groups])
+    result = await services.agents.extraction.run(user_prompt=sanitized_transcript, output_type=output_model)
+    values = result.output.model_dump()
+    history = result.all_messages()
+
+    # Ask again for just the empty fields, in the same conversation so the transcript isn't re-read cold
+    for _ in range(settings.extraction_field_retries):
+        missing = [name for name, value in values.items() if not _is_filled(value)]
+        if not missing:
+            break
+        logfire.info("Extraction retrying {count} empty fields", count=len(missing), fields=missing)
+        retry = await services.agents.extraction.run(
+            user_prompt=f"These fields were left empty, fill in only them: {', '.join(missing)}",
+            message_history=history,
+            output_type=build_retry_model(output_model, missing),
+        )
+        values.update({name: value for name, value in retry.output.model_dump().items() if _is_filled(value)})
+        history = retry.all_messages()
+
+    answers = []
+    for index, group in enumerate(question_groups, start=1):
+        answer = values.get(answer_field(index))
+        if not _is_filled(answer):
+            logfire.warn("No answer extracted for question {question_id}", question_id=group[0]["id"])
+            continue
+        answers.extend({"question_id": question["id"], "answer_text": answer.strip()} for question in group)
+    return {"form": {name: values.get(name) for name in Form.model_fields}, "answers": answers}
+
+async def _extract(sanitized_transcript: str, organisation_id: str, db) -> Dict[str, Any]:
+    """
+    Form fields and answers to the organisation's active common questions, from one
+    structured call over the transcript.
+    """
+    config = await db.get_org_config(organisation_id)
+    question_groups = list(config.question_groups.values())
+    question_key = json.dumps([[[q["id"], q["question_text"]] for q in group] for group in question_groups])
+    return await services.result_cache.get_or_compute(
+        "agent.extraction",
+        [digest(sanitized_transcript), services.agents.versions["extraction"], digest(question_key)],
+        lambda: _run_extraction(sanitized_transcript, question_groups),
+    )
 
-    call_log_agent_response = await call_log_agent.run(user_prompt=sanitized_transcript)
+async def _run_agent_stages(sanitized_transcript: str, organisation_id: str, db) -> Dict[str, Any]:
+    # Every agent only reads the sanitized transcript, so they can run side by side
+    return await _fan_out(
+        {
+            "call_log": _run_agent("call_log", services.agents.call_log, sanitized_transcript),
+            "report": _run_agent("report", services.agents.report, sanitized_transcript),
+            "extraction": _extract(sanitized_transcript, organisation_id, db),
+        },
+        timeout=settings.agent_stage_timeout,
+    )
 
-    report_agent_response = await report_agent.run(user_prompt=sanitized_transcript)
+async def complete_log(log_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Saves a processed call's row and its answers together, in one round trip."""
+    update_data = {key: value for key, value in payload.items() if key != "answers"}
+    return await services.db.complete_call_log(log_id, {**update_data, "status": "complete"}, payload.get("answers", []))
+
+def _build_payload(stages: Dict[str, Any], sanitized_transcript: str, redacted: Transcript) -> Dict[str, Any]:
+    form = (stages["extraction"] or {}).get("form") or {}
+    report = stages["report"]
+    report_cleaned_response = re.sub(r'<think>.*?</think>', '', report, flags=re.DOTALL) if report else None
+
+    return {
+        "responder_name": form.get("responder_name"),
+        "caller_name": form.get("caller_name"),
+        "request_type": form.get("request_type"),
+        "issue_summary": form.get("issue_summary"),
+        "key_points": form.get("key_points"),
+        "caller_sentiment": form.get("caller_sentiment"),
+        "report_generated": report_cleaned_response,
+        "call_log": stages["call_log"],
+        "transcription": sanitized_transcript,
+        "transcript_segments": redacted.to_columns(),
+        # Not a call_logs column; written to the answers table by complete_log
+        "answers": (stages["extraction"] or {}).get("answers", []),
+    }
 
-    report_cleaned_response = re.sub(r'<think>.*?</think>', '', report_agent_response.output, flags=re.DOTALL)
+TRANSCRIBE_PROMPT = "Transcribe and pay close attention to smaller details like names and personal details"
 
-    database_agent_response = await database_agent.run(user_prompt=sanitized_transcript)
+async def transcribe_log(filename: str) -> Transcript:
+    return await services.transcription_service.transcribe_detailed(filename=filename, prompt=TRANSCRIBE_PROMPT)
 
-    if not database_agent_response.output:
-        raise ValueError("Database Agent failed to extract structured data")
-    
-    common_questions = await db.get_common_questions(organisation_id)
+@logfire.instrument("process_log")
+async def process_log(filename: str, log_id: str, organisation_id: str, transcript: Optional[Transcript] = None) -> dict:
 
-    questions = [q["question_text"] for q in common_questions]
+    metadata = await parse_call_filename(filename=filename)
 
-    combined_prompt = f"""Transcript Context:
-                      {sanitized_transcript}
+    if transcript is None:
+        transcript = await transcribe_log(filename)
 
-                         Questions to Answer:
-                    {'\n'.join(questions)}
-   """
-    question_answer_response = await questionary_agent.run(user_prompt=combined_prompt)
+    sanitized_transcript, redacted = await services.sanitization_service.sanitize_transcript(transcript)
 
-    answers_data = json.loads(question_answer_response.output)
-    for item in answers_data["answers"]:
-        matching_question = next(
-            (q for q in common_questions if q["question_text"] == item["question_text"]),
-            None
-        )
-        if not matching_question:
-            continue
-        
-        answer_payload = {
-            "call_id": log_id,
-            "question_id": matching_question["id"],
-            "answer_text": item["answer_text"]
-        }
-        await db.create_answer(answer_payload)
+    stages = await _run_agent_stages(sanitized_transcript, organisation_id, services.db)
 
     payload = {
-        "responder_name": database_agent_response.output.responder_name,
-        "caller_name": database_agent_response.output.caller_name,
-        "request_type": database_agent_response.output.request_type,
-        "issue_summary": database_agent_response.output.issue_summary,
-        "key_points": database_agent_response.output.key_points,
-        "caller_sentiment": database_agent_response.output.caller_sentiment,
-        "report_generated": report_cleaned_response,
-        "call_log": call_log_agent_response.output,
-        "transcription": sanitized_transcript,
+        **_build_payload(stages, sanitized_transcript, redacted),
         "filename": metadata["filename"],
         "call_type": metadata["call_type"],
         "toll_free_did": metadata["toll_free_did"],
@@ -96,85 +187,20 @@ async def upload_process_log(
     filename: str,
     log_id: str,
     organisation_id: str,
-    db
-) -> str:
+    db,
+    transcript: Optional[Transcript] = None,
+) -> dict:
     metadata = await upload_parse_call_filename(filename=filename)
 
-    transcript = await transcription_service.transcribe(
-        filename=filename,
-        prompt="Transcribe and pay close attention to smaller details like names and personal details"
-    )
+    if transcript is None:
+        transcript = await transcribe_log(filename)
 
-    sanitized_transcript = await sanitization_service.sanitize(transcript=transcript)
+    sanitized_transcript, redacted = await services.sanitization_service.sanitize_transcript(transcript)
 
-    call_log_agent_response = await call_log_agent.run(user_prompt=sanitized_transcript)
-    report_agent_response = await report_agent.run(user_prompt=sanitized_transcript)
-    report_cleaned_response = re.sub(r'<think>.*?</think>', '', report_agent_response.output, flags=re.DOTALL)
-    database_agent_response = await database_agent.run(user_prompt=sanitized_transcript)
-
-    if not database_agent_response.output:
-        raise ValueError("Database Agent failed to extract structured data")
-    
-    common_questions = await db.get_common_questions(organisation_id)
-    questions = [q["question_text"] for q in common_questions]
-
-    combined_prompt = f"""Transcript Context:
-                      {sanitized_transcript}
-
-                         Questions to Answer:
-                    {'\n'.join(questions)}
-   """
-    question_answer_response = await questionary_agent.run(user_prompt=combined_prompt)
-
-    # for item in question_answer_response.output.answers:
-    #     matching_question = next(
-    #         (q for q in common_questions if q["question_text"] == item.question_text),
-    #         None
-    #     )
-    #     if not matching_question:
-    #         continue
-    #     print(f"Call id:{log_id}")
-    #     answer_payload = {
-    #         "call_id": log_id,
-    #         "question_id": matching_question["id"],
-    #         "answer_text": item.answer_text
-    #     }
-    #     await db.create_answer(answer_payload)
-
-    try:
-        output = question_answer_response.output.strip()
-        output = re.sub(r"^```(?:json)?|```$", "", output, flags=re.MULTILINE).strip()
-        answers_data = json.loads(output)
-        answers = answers_data["answers"]
-    except Exception as e:
-        print("Failed to parse answers:", question_answer_response.output)
-        answers = []
-
-    for item in answers:
-        matching_question = next(
-            (q for q in common_questions if q["question_text"] == item["question_text"]),
-            None
-        )
-        if not matching_question:
-            continue
-        print(f"Call id:{log_id}")
-        answer_payload = {
-            "call_id": log_id,
-            "question_id": matching_question["id"],
-            "answer_text": item["answer_text"]
-        }
-        await db.create_answer(answer_payload)
+    stages = await _run_agent_stages(sanitized_transcript, organisation_id, db)
 
     payload = {
-        "responder_name": getattr(database_agent_response.output, "responder_name", None),
-        "caller_name": getattr(database_agent_response.output, "caller_name", None),
-        "request_type": getattr(database_agent_response.output, "request_type", None),
-        "issue_summary": getattr(database_agent_response.output, "issue_summary", None),
-        "key_points": getattr(database_agent_response.output, "key_points", None),
-        "caller_sentiment": getattr(database_agent_response.output, "caller_sentiment", None),
-        "report_generated": report_cleaned_response,
-        "call_log": getattr(call_log_agent_response, "output", None),
-        "transcription": sanitized_transcript,
+        **_build_payload(stages, sanitized_transcript, redacted),
         "filename": metadata.get("filename"),
         "call_type": metadata.get("call_type"),
         "toll_free_did": metadata.get("toll_free_did"),
@@ -186,32 +212,65 @@ async def upload_process_log(
     }
     
     return payload
-@logfire.instrument("chat")
-async def chat(user_prompt: str, uuid : UUID, organisation_id: str) -> str:
-    print(f"[Chat] User prompt: {user_prompt} | Log UUID: {uuid}")
 
-    user_id : str = "TestUser"
-    messages = await memory.get_memory(user_id=user_id, organisation_id=organisation_id, limit=20)
+async def _chat_history(user_prompt: str, uuid: UUID, organisation_id: str, user_id: str) -> List[Any]:
+    """Memory plus the transcript context for this turn."""
+    messages = await services.memory.get_memory(
+        user_id=user_id,
+        organisation_id=organisation_id,
+        call_id=str(uuid),
+        max_tokens=settings.memory_token_budget,
+    )
     print(f"[Chat] Retrieved {len(messages)} messages from memory")
 
-    await memory.append_message(user_id=user_id, organisation_id=organisation_id, role="user", content=user_prompt)
-    print(f"[Chat] Appended user message")
+    # Follow-ups like "and after that?" need the previous question to retrieve well
+    previous = [p.content for m in messages if isinstance(m, ModelRequest) for p in m.parts if isinstance(p, UserPromptPart)]
+    context = await services.retriever.context_for(uuid=uuid, organisation_id=organisation_id, query=" ".join(previous[-1:] + [user_prompt]))
+    if context is None:
+        raise ValueError("No transcription found for this call log")
 
-    # transcription = await db.get_transcription(uuid=uuid)
-    # print(f"[Chat] Retrieved transcription from DB")
+    messages.append(ModelRequest(parts=[SystemPromptPart(content=context)]))
+    return messages
 
-    transcription = await db.get_transcription(uuid=uuid)
-    if not transcription or "transcription" not in transcription:
-        raise ValueError("No transcription found for this call log")
+async def _save_turn(user_id: str, organisation_id: str, uuid: UUID, user_prompt: str, bot_response: str) -> None:
+    # Goes into the memory cache now, the table write is batched in the background
+    await services.memory.append_message(user_id=user_id, organisation_id=organisation_id, role="user", content=user_prompt, call_id=str(uuid))
+    await services.memory.append_message(user_id=user_id, organisation_id=organisation_id, role="bot", content=bot_response, call_id=str(uuid))
 
-    messages.append(ModelRequest(parts=[SystemPromptPart(content=transcription["transcription"])]))
+@logfire.instrument("chat")
+async def chat(user_prompt: str, uuid : UUID, organisation_id: str, user_id: str) -> str:
+    print(f"[Chat] User prompt: {user_prompt} | Log UUID: {uuid}")
 
-    response = await chat_agent.run(user_prompt=user_prompt, message_history=messages)
+    messages = await _chat_history(user_prompt, uuid, organisation_id, user_id)
+
+    with prioritized(INTERACTIVE):
+        response = await services.agents.chat.run(user_prompt=user_prompt, message_history=messages)
     bot_response = response.output
 
     print(f"[Chat] Agent response: {bot_response}")
 
-    await memory.append_message(user_id=user_id, organisation_id=organisation_id, role="bot", content=bot_response)
-    print(f"[Chat] Appended bot response")
+    await _save_turn(user_id, organisation_id, uuid, user_prompt, bot_response)
+    logfire.info("Saved chat turn for {uuid}", uuid=str(uuid))
 
     return bot_response
+
+async def chat_stream(user_prompt: str, uuid: UUID, organisation_id: str, user_id: str) -> AsyncIterator[str]:
+    """
+    Yields the chat response as text deltas while the model generates it. The turn is
+    saved to memory once the stream completes (the table write happens in the
+    background). If the consumer stops early (client disconnected) the upstream
+    request is closed and nothing is saved.
+    """
+    with logfire.span("chat_stream") as span, prioritized(INTERACTIVE):
+        messages = await _chat_history(user_prompt, uuid, organisation_id, user_id)
+
+        start = time.perf_counter()
+        deltas: List[str] = []
+        async with services.agents.chat.run_stream(user_prompt=user_prompt, message_history=messages) as result:
+            async for delta in result.stream_text(delta=True, debounce_by=None):
+                if not deltas:
+                    span.set_attribute("time_to_first_token_ms", round((time.perf_counter() - start) * 1000, 2))
+                deltas.append(delta)
+                yield delta
+
+        await _save_turn(user_id, organisation_id, uuid, user_prompt, "".join(deltas))
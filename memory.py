@@ -1,16 +1,87 @@
-from typing import Any, List
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from pydantic_ai.messages import (
     ModelMessage,
     ModelRequest,
     ModelResponse,
+    SystemPromptPart,
     UserPromptPart,
     TextPart,
 )
+import logfire
+from database import execute_query
+
+# (user_id, organisation_id, call_id)
+ConversationKey = Tuple[str, str, Optional[str]]
+
+# Rough size of a token in characters, good enough for trimming history to a budget
+CHARS_PER_TOKEN = 4
+
+# Turns older text into a summary: (previous summary or "", transcript of the turns) -> summary
+Summarizer = Callable[[str, str], Awaitable[str]]
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(len(m["content"]) for m in messages) // CHARS_PER_TOKEN
+
+@dataclass
+class Conversation:
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    # Rows in the table for this conversation as of the last load or flush
+    persisted: int = 0
+    checked_at: float = 0.0
 
 class MemoryHandler:
-    def __init__(self, deps):
-        self.client = deps.supabase_client
+    """
+    Chat history per (user, organisation, call), served from an in-process LRU.
+
+    New messages go into the cache straight away and are written to the memory table
+    in batches by a background flusher. Another worker may also be writing to the same
+    conversation, so a cached conversation that hasn't been checked for a while is
+    compared against the table's row count and reloaded if it moved.
+
+    Once a conversation passes summary_threshold tokens, everything but the last
+    keep_recent messages is folded into one "summary" row in the background. The
+    summary is timestamped just before the first kept message, so a reload reads it
+    as "latest summary, then everything after it".
+    """
+
+    def __init__(
+        self,
+        deps,
+        cache_size: int = 1024,
+        load_limit: int = 100,
+        flush_interval: float = 1.0,
+        flush_batch: int = 50,
+        revalidate_seconds: float = 15.0,
+        summarize: Optional[Summarizer] = None,
+        summary_threshold: int = 2000,
+        keep_recent: int = 6,
+    ):
+        self.client = deps.postgrest_client
         self.table = "memory"
+        self.cache_size = cache_size
+        self.load_limit = load_limit
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.revalidate_seconds = revalidate_seconds
+        self.summarize = summarize
+        self.summary_threshold = summary_threshold
+        self.keep_recent = keep_recent
+
+        self._cache: "OrderedDict[ConversationKey, Conversation]" = OrderedDict()
+        self._pending: List[Tuple[ConversationKey, Dict[str, Any]]] = []
+        self._flush_lock = asyncio.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._compacting: Set[ConversationKey] = set()
+        self._compactions: Set[asyncio.Task] = set()
 
     async def _message_handler(self, response: List[Any]) -> List[ModelMessage]:
         messages: List[ModelMessage] = []
@@ -23,32 +94,196 @@ class MemoryHandler:
                 messages.append(ModelRequest(parts=[UserPromptPart(content=content)]))
             elif role == "bot":
                 messages.append(ModelResponse(parts=[TextPart(content=content)]))
+            elif role == "summary":
+                messages.append(ModelRequest(parts=[SystemPromptPart(content=f"Summary of the earlier conversation:\n{content}")]))
         return messages
 
-    async def get_memory(self, user_id: str, organisation_id: str, limit: int) -> List[ModelMessage]:
+    def _filtered(self, query, key: ConversationKey):
+        user_id, organisation_id, call_id = key
+        query = query.eq("user_id", user_id).eq("organisation_id", organisation_id)
+        return query.eq("call_id", call_id) if call_id else query.is_("call_id", "null")
 
-        # Fetch the latest messages from Supabase
-        response = (
-            self.client.table(self.table)
-            .select("role, content")
-            .eq("user_id", user_id)
-            .eq("organisation_id", organisation_id)
+    async def _load(self, key: ConversationKey) -> Conversation:
+        # Fetch the latest messages from Supabase, with the total for later version checks
+        query = (
+            self._filtered(self.client.table(self.table).select("role, content, timestamp", count="exact"), key)
             .order("timestamp", desc=True)
-            .limit(limit)
-            .execute()
+            .limit(self.load_limit)
+        )
+        response = await execute_query(query, "get_memory")
+        rows = list(reversed(response.data or []))  # Reverse for chronological order
+        # Older rows are covered by the latest summary
+        summaries = [i for i, r in enumerate(rows) if r["role"] == "summary"]
+        if summaries:
+            rows = rows[summaries[-1]:]
+        return Conversation(
+            messages=[{"role": r["role"], "content": r["content"], "timestamp": r.get("timestamp")} for r in rows],
+            persisted=response.count or len(rows),
+            checked_at=time.time(),
         )
-        response = list(reversed(response.data))  # Reverse for chronological order
 
-        messages = await self._message_handler(response)
+    async def _is_current(self, key: ConversationKey, conversation: Conversation) -> bool:
+        # Our own writes must land first or they'd look like someone else's
+        await self.flush()
+        query = self._filtered(self.client.table(self.table).select("id", count="exact"), key).limit(1)
+        response = await execute_query(query, "check_memory")
+        return (response.count or 0) == conversation.persisted
 
-        return messages
+    async def _conversation(self, key: ConversationKey) -> Conversation:
+        conversation = self._cache.get(key)
+        if conversation is not None and time.time() - conversation.checked_at > self.revalidate_seconds:
+            if await self._is_current(key, conversation):
+                conversation.checked_at = time.time()
+            else:
+                conversation = None
+
+        if conversation is None:
+            if any(pending_key == key for pending_key, _ in self._pending):
+                await self.flush()
+            conversation = await self._load(key)
+            self._cache[key] = conversation
+
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return conversation
 
-    async def append_message(self, user_id: str, organisation_id: str, role: str, content: str) -> None:
+    async def get_memory(
+        self,
+        user_id: str,
+        organisation_id: str,
+        call_id: Optional[str] = None,
+        max_tokens: int = 3000,
+    ) -> List[ModelMessage]:
+        """The summary, if any, then the most recent messages that fit in max_tokens, oldest first."""
+        key = (user_id, organisation_id, str(call_id) if call_id else None)
+        conversation = await self._conversation(key)
 
+        messages = conversation.messages
+        summary = messages[:1] if messages and messages[0]["role"] == "summary" else []
+        kept: List[Dict[str, str]] = []
+        budget = max_tokens * CHARS_PER_TOKEN - _tokens(summary) * CHARS_PER_TOKEN
+        for message in reversed(messages[len(summary):]):
+            budget -= len(message["content"])
+            if budget < 0 and kept:
+                break
+            kept.append(message)
+        kept.reverse()
+        # Never open the history with an answer to a question that was trimmed away
+        while kept and kept[0]["role"] != "user":
+            kept.pop(0)
+
+        return await self._message_handler(summary + kept)
+
+    async def append_message(
+        self,
+        user_id: str,
+        organisation_id: str,
+        role: str,
+        content: str,
+        call_id: Optional[str] = None,
+    ) -> None:
+        key = (user_id, organisation_id, str(call_id) if call_id else None)
+        # Timestamped here rather than by the database so a summary can be slotted in before a given message
+        timestamp = _now()
+        conversation = self._cache.get(key)
+        if conversation is not None:
+            conversation.messages.append({"role": role, "content": content, "timestamp": timestamp})
+            del conversation.messages[:-self.load_limit]
+            if role == "bot":
+                self._maybe_compact(key, conversation)
+
+        self._enqueue(key, role, content, timestamp)
+
+    def _enqueue(self, key: ConversationKey, role: str, content: str, timestamp: str) -> None:
+        user_id, organisation_id, call_id = key
         payload = {
                 "user_id": user_id,
                 "organisation_id": organisation_id,
+                "call_id": call_id,
                 "role": role,
                 "content": content,
+                "timestamp": timestamp,
                 }
-        self.client.table("memory").insert(payload).execute()
\ No newline at end of file
+        self._pending.append((key, payload))
+        self._ensure_flusher()
+        if len(self._pending) >= self.flush_batch:
+            self._wake.set()
+
+    def _maybe_compact(self, key: ConversationKey, conversation: Conversation) -> None:
+        if self.summarize is None or key in self._compacting:
+            return
+        if len(conversation.messages) <= self.keep_recent or _tokens(conversation.messages) <= self.summary_threshold:
+            return
+        self._compacting.add(key)
+        task = asyncio.ensure_future(self._compact(key, conversation))
+        self._compactions.add(task)
+        task.add_done_callback(self._compactions.discard)
+
+    async def _compact(self, key: ConversationKey, conversation: Conversation) -> None:
+        try:
+            old = conversation.messages[:-self.keep_recent]
+            first_kept = conversation.messages[-self.keep_recent]
+            previous = old[0]["content"] if old[0]["role"] == "summary" else ""
+            turns = "\n\n".join(f"{m['role']}: {m['content']}" for m in old if m["role"] != "summary")
+
+            with logfire.span("memory compact", messages=len(old)):
+                summary = (await self.summarize(previous, turns)).strip()
+            if not summary:
+                return
+
+            # Just before the first kept message, so it sorts between what it covers and what it doesn't
+            kept_at = datetime.fromisoformat(first_kept["timestamp"]) if first_kept.get("timestamp") else datetime.now(timezone.utc)
+            timestamp = (kept_at - timedelta(microseconds=1)).isoformat()
+
+            # Messages may have been appended while the model was running; keep all of them
+            index = next((i for i, m in enumerate(conversation.messages) if m is first_kept), None)
+            if index is None:
+                return
+            conversation.messages[:index] = [{"role": "summary", "content": summary, "timestamp": timestamp}]
+            self._enqueue(key, "summary", summary, timestamp)
+        except Exception as e:
+            # History just stays longer until the next attempt
+            logfire.warn("Memory compaction failed: {error!r}", error=e)
+        finally:
+            self._compacting.discard(key)
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._wake = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Writes every pending message in one insert. Failed batches are retried on the next flush."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            try:
+                await execute_query(self.client.table(self.table).insert([payload for _, payload in batch]), "append_message")
+            except Exception as e:
+                logfire.warn("Memory flush of {count} messages failed: {error!r}", count=len(batch), error=e)
+                self._pending = batch + self._pending
+                return
+
+            for key, _ in batch:
+                conversation = self._cache.get(key)
+                if conversation is not None:
+                    conversation.persisted += 1
+
+    async def close(self) -> None:
+        if self._compactions:
+            await asyncio.gather(*self._compactions, return_exceptions=True)
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
@@ -0,0 +1,5 @@
+-- Timed transcript stored next to the sanitized text, in columnar form:
+-- {"segments": {"start": [...], "end": [...], "text": [...]},
+--  "words":    {"start": [...], "end": [...], "text": [...]}}
+alter table call_logs
+    add column if not exists transcript_segments jsonb;
@@ -0,0 +1,4 @@
+-- Keyset pagination seeks on (created_at, id) within an organisation, so page N
+-- is an index range scan instead of reading and discarding N * limit rows.
+create index if not exists call_logs_org_created_at_id_idx
+    on call_logs (organisation_id, created_at desc, id desc);
@@ -0,0 +1,82 @@
+-- Indexed search over caller name, customer number, DID, filename and transcript.
+-- Leading-wildcard ilike can't use a btree index; trigram GIN indexes serve both the
+-- fuzzy search below and the existing ilike filters on /logs/searching.
+create extension if not exists pg_trgm;
+
+-- Short identifying fields, lowercased, for trigram prefix/substring/fuzzy matching
+alter table call_logs
+    add column if not exists search_text text generated always as (
+        lower(
+            coalesce(caller_name, '') || ' ' ||
+            coalesce(customer_number, '') || ' ' ||
+            coalesce(toll_free_did, '') || ' ' ||
+            coalesce(filename, '')
+        )
+    ) stored;
+
+-- Weighted document: caller name ranks above numbers and filename, which rank above the transcript
+alter table call_logs
+    add column if not exists search_tsv tsvector generated always as (
+        setweight(to_tsvector('simple', coalesce(caller_name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(customer_number, '') || ' ' || coalesce(toll_free_did, '') || ' ' || coalesce(filename, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(transcription, '')), 'C')
+    ) stored;
+
+create index if not exists call_logs_search_text_trgm_idx on call_logs using gin (search_text gin_trgm_ops);
+create index if not exists call_logs_search_tsv_idx on call_logs using gin (search_tsv);
+
+create index if not exists call_logs_caller_name_trgm_idx on call_logs using gin (caller_name gin_trgm_ops);
+create index if not exists call_logs_customer_number_trgm_idx on call_logs using gin (customer_number gin_trgm_ops);
+create index if not exists call_logs_toll_free_did_trgm_idx on call_logs using gin (toll_free_did gin_trgm_ops);
+
+-- Ranked search for one organisation. Every word of the query is matched as a prefix
+-- ("jo smi" finds "John Smith"), transcript words are also matched after stemming, and
+-- a trigram word similarity catches typos ("jonh").
+create or replace function search_call_logs(
+    p_organisation_id call_logs.organisation_id%type,
+    p_query text,
+    p_limit int default 20,
+    p_offset int default 0
+)
+returns table (
+    id call_logs.id%type,
+    call_date call_logs.call_date%type,
+    call_type call_logs.call_type%type,
+    caller_name call_logs.caller_name%type,
+    status call_logs.status%type,
+    filename call_logs.filename%type,
+    customer_number call_logs.customer_number%type,
+    toll_free_did call_logs.toll_free_did%type,
+    created_at call_logs.created_at%type,
+    rank real
+)
+language sql
+stable
+as $$
+    with q as (
+        select
+            lower(trim(p_query)) as term,
+            to_tsquery('simple', array_to_string(array(
+                select quote_literal(word) || ':*'
+                from regexp_split_to_table(lower(trim(p_query)), '\s+') as word
+                where word <> ''
+            ), ' & ')) || websearch_to_tsquery('english', p_query) as tsq
+    )
+    select
+        c.id,
+        c.call_date,
+        c.call_type,
+        c.caller_name,
+        c.status,
+        c.filename,
+        c.customer_number,
+        c.toll_free_did,
+        c.created_at,
+        (ts_rank(c.search_tsv, q.tsq) + word_similarity(q.term, c.search_text))::real as rank
+    from call_logs c, q
+    where c.organisation_id = p_organisation_id
+      and (c.search_tsv @@ q.tsq or q.term <% c.search_text)
+    order by rank desc, c.created_at desc, c.id desc
+    limit p_limit
+    offset p_offset;
+$$;
@@ -0,0 +1,6 @@
+-- Chat memory is kept per user, organisation and call instead of one shared history
+alter table memory
+    add column if not exists call_id uuid references call_logs (id) on delete cascade;
+
+create index if not exists memory_conversation_idx
+    on memory (user_id, organisation_id, call_id, "timestamp" desc);
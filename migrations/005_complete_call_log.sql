@@ -0,0 +1,48 @@
+-- Finishing a processed call in one round trip: its answers and the completed
+-- call_logs row are written together by complete_call_log, in one transaction.
+
+-- One answer per question per call, so a retried job overwrites instead of duplicating.
+-- Keep the newest of any duplicates written before this constraint existed.
+delete from answers a
+using answers b
+where a.call_id = b.call_id
+  and a.question_id = b.question_id
+  and a.ctid < b.ctid;
+
+do $$
+begin
+    if not exists (select 1 from pg_constraint where conname = 'answers_call_question_key') then
+        alter table answers add constraint answers_call_question_key unique (call_id, question_id);
+    end if;
+end;
+$$;
+
+-- p_update holds call_logs columns (keys that aren't listed below are ignored and
+-- columns missing from it keep their value); p_answers is [{question_id, answer_text}]
+create or replace function complete_call_log(p_log_id uuid, p_update jsonb, p_answers jsonb default '[]'::jsonb)
+returns setof call_logs
+language plpgsql
+as $$
+begin
+    insert into answers (call_id, question_id, answer_text)
+    select p_log_id, a.question_id, a.answer_text
+    from jsonb_to_recordset(p_answers) as a(question_id uuid, answer_text text)
+    on conflict (call_id, question_id) do update set answer_text = excluded.answer_text;
+
+    return query
+    update call_logs c
+    set (
+        status, responder_name, caller_name, request_type, issue_summary, key_points, caller_sentiment,
+        report_generated, call_log, transcription, transcript_segments, filename, call_type, toll_free_did,
+        agent_extension, customer_number, call_date, call_start_time, call_id
+    ) = (
+        select
+            r.status, r.responder_name, r.caller_name, r.request_type, r.issue_summary, r.key_points, r.caller_sentiment,
+            r.report_generated, r.call_log, r.transcription, r.transcript_segments, r.filename, r.call_type, r.toll_free_did,
+            r.agent_extension, r.customer_number, r.call_date, r.call_start_time, r.call_id
+        from jsonb_populate_record(c, p_update) r
+    )
+    where c.id = p_log_id
+    returning c.*;
+end;
+$$;
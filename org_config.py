@@ -0,0 +1,169 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import logfire
+
+ORG_CONFIG_CHANNEL = "org_config"
+
+def normalise_question(text: str) -> str:
+    """Case, spacing and trailing punctuation don't make a different question."""
+    return re.sub(r"\s+", " ", text).strip().rstrip("?.!:").strip().lower()
+
+@dataclass
+class OrgConfig:
+    """An organisation's questions as loaded from the questions table."""
+    organisation_id: str
+    questions: List[Dict[str, Any]]
+    loaded_at: float = 0.0
+    # Active common questions grouped by normalised text, in table order
+    question_groups: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        for question in self.common_questions:
+            self.question_groups.setdefault(normalise_question(question["question_text"]), []).append(question)
+
+    @property
+    def common_questions(self) -> List[Dict[str, Any]]:
+        return [q for q in self.questions if q.get("is_common") and q.get("is_active")]
+
+class InvalidationBus:
+    """
+    Cross-worker invalidation messages through a shared SQLite file, standing in for
+    Redis pub/sub when every worker runs on one host. Publishing appends a row; each
+    worker polls for rows newer than the last one it saw and hands them to its
+    subscribers. Its own messages are skipped since they were applied locally.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 1.0, retention_seconds: float = 3600.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.origin = uuid.uuid4().hex
+        self._subscribers: Dict[str, List[Callable[[str], None]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                key TEXT NOT NULL,
+                origin TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def _publish(self, channel: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (channel, key, origin, created_at) VALUES (?, ?, ?, ?)",
+                (channel, key, self.origin, time.time()),
+            )
+            self._conn.commit()
+
+    async def publish(self, channel: str, key: str) -> None:
+        await asyncio.to_thread(self._publish, channel, key)
+
+    def _poll(self) -> List[tuple]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, channel, key, origin FROM messages WHERE id > ? ORDER BY id", (self._last_id,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - self.retention_seconds,))
+            self._conn.commit()
+        if rows:
+            self._last_id = rows[-1][0]
+        return rows
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                for _, channel, key, origin in await asyncio.to_thread(self._poll):
+                    if origin == self.origin:
+                        continue
+                    for callback in self._subscribers.get(channel, []):
+                        callback(key)
+            except Exception as e:
+                logfire.warn("Invalidation bus poll failed: {error!r}", error=e)
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+class OrgConfigCache:
+    """
+    Organisation configs for ttl seconds, shared by every call processed for that
+    organisation. Concurrent misses share one load. Invalidating drops the local
+    entry and tells the other workers through the bus.
+    """
+
+    def __init__(self, ttl: float = 300.0, bus: Optional[InvalidationBus] = None):
+        self.ttl = ttl
+        self.bus = bus
+        self._entries: Dict[str, OrgConfig] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        # Bumped on invalidation so a load that started before it isn't cached
+        self._generation: Dict[str, int] = {}
+        if bus is not None:
+            bus.subscribe(ORG_CONFIG_CHANNEL, self._drop)
+
+    def _drop(self, organisation_id: str) -> None:
+        self._entries.pop(organisation_id, None)
+        # Callers from now on start a fresh load instead of joining one that may be stale
+        self._loading.pop(organisation_id, None)
+        self._generation[organisation_id] = self._generation.get(organisation_id, 0) + 1
+
+    async def get_or_load(self, organisation_id: str, load: Callable[[], Awaitable[OrgConfig]]) -> OrgConfig:
+        entry = self._entries.get(organisation_id)
+        if entry is not None and entry.loaded_at + self.ttl > time.time():
+            return entry
+
+        task = self._loading.get(organisation_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(organisation_id, load))
+            self._loading[organisation_id] = task
+            task.add_done_callback(lambda done: self._forget(organisation_id, done))
+        # One caller giving up (a client disconnect) mustn't cancel the load the others wait on
+        return await asyncio.shield(task)
+
+    def _forget(self, organisation_id: str, task: asyncio.Task) -> None:
+        if self._loading.get(organisation_id) is task:
+            del self._loading[organisation_id]
+
+    async def _load(self, organisation_id: str, load: Callable[[], Awaitable[OrgConfig]]) -> OrgConfig:
+        generation = self._generation.get(organisation_id, 0)
+        config = await load()
+        if self._generation.get(organisation_id, 0) == generation:
+            self._entries[organisation_id] = config
+        return config
+
+    async def invalidate(self, organisation_id: str) -> None:
+        self._drop(organisation_id)
+        if self.bus is not None:
+            try:
+                await self.bus.publish(ORG_CONFIG_CHANNEL, organisation_id)
+            except Exception as e:
+                # Other workers catch up when their entry expires
+                logfire.warn("Org config invalidation publish failed: {error!r}", error=e)
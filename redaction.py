@@ -0,0 +1,182 @@
+import re
+from dataclasses import dataclass
+from typing import Iterable, List
+
+# Spans at or above this confidence are redacted without asking the model
+REDACT_THRESHOLD = 0.8
+# Spans between this and REDACT_THRESHOLD are undecided and go to the model
+REVIEW_THRESHOLD = 0.4
+
+SPOKEN_DIGITS = {
+    "zero": "0", "oh": "0", "one": "1", "two": "2", "three": "3", "four": "4",
+    "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9",
+}
+REPEATS = {"double": 2, "triple": 3}
+
+# A number token is a written digit group, a spoken digit or a repeat word
+_TOKEN = re.compile(r"\b(?:\d+|" + "|".join(list(SPOKEN_DIGITS) + list(REPEATS)) + r")\b", re.IGNORECASE)
+# What may sit between two tokens of the same number
+_GAP = re.compile(r"^[\s,\-/]*$")
+_ALNUM_ID = re.compile(r"\b(?=[A-Za-z0-9]*\d)(?=[A-Za-z0-9]*[A-Za-z])[A-Za-z0-9]{6,12}\b")
+_SSN_SHAPE = re.compile(r"^\d{3}[- ]\d{2}[- ]\d{4}$")
+
+_CARD_CONTEXT = re.compile(r"\b(card|visa|master ?card|amex|american express|discover|credit|debit|cvv)\b", re.IGNORECASE)
+_SSN_CONTEXT = re.compile(r"\b(social|ssn|security number)\b", re.IGNORECASE)
+_ID_CONTEXT = re.compile(
+    r"\b(passport|driver'?s? licen[cs]e|licen[cs]e number|state id|id number|identification number|"
+    r"tax id|taxpayer|tin|ein|itin|medicare|medicaid|member id)\b",
+    re.IGNORECASE,
+)
+CONTEXT_CHARS = 60
+
+@dataclass
+class Span:
+    start: int
+    end: int
+    kind: str
+    confidence: float
+    replacement: str
+
+def luhn_valid(digits: str) -> bool:
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        n = int(ch)
+        if i % 2 == 1:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return total % 10 == 0
+
+def _mask(value: str, keep_start: int, keep_end: int) -> str:
+    hidden = max(0, len(value) - keep_start - keep_end)
+    return value[:keep_start] + "X" * hidden + (value[-keep_end:] if keep_end else "")
+
+def mask_text(value: str, keep_start: int = 1, keep_end: int = 2) -> str:
+    """Masks the letters and digits of free-form text, keeping separators in place."""
+    positions = [i for i, ch in enumerate(value) if ch.isalnum()]
+    hidden = set(positions[keep_start:len(positions) - keep_end])
+    return "".join("X" if i in hidden else ch for i, ch in enumerate(value))
+
+def merge_spans(text: str, spans: Iterable[Span]) -> List[Span]:
+    """Unions overlapping spans so a partial overlap can never leave digits exposed."""
+    merged: List[Span] = []
+    for span in sorted(spans, key=lambda s: (s.start, -s.end)):
+        if merged and span.start < merged[-1].end:
+            last = merged[-1]
+            if span.end <= last.end:
+                continue
+            merged[-1] = Span(
+                last.start,
+                span.end,
+                last.kind,
+                max(last.confidence, span.confidence),
+                mask_text(text[last.start:span.end]),
+            )
+        else:
+            merged.append(span)
+    return merged
+
+class RedactionEngine:
+    """
+    Deterministic PII detector for SSNs, card numbers and government IDs, written
+    either as digits or spoken ("four five six"). Every candidate gets a confidence
+    score so only the ones the rules can't settle need a model call.
+    """
+
+    def scan(self, text: str) -> List[Span]:
+        spans = self._number_spans(text)
+        spans.extend(self._id_spans(text, spans))
+        return sorted(spans, key=lambda s: s.start)
+
+    def redact(self, text: str, include_undecided: bool = True) -> str:
+        """Redacts confident spans, and undecided ones too unless told otherwise."""
+        threshold = REVIEW_THRESHOLD if include_undecided else REDACT_THRESHOLD
+        return self.apply(text, [s for s in self.scan(text) if s.confidence >= threshold])
+
+    @staticmethod
+    def apply(text: str, spans: Iterable[Span]) -> str:
+        out = []
+        cursor = 0
+        for span in sorted(spans, key=lambda s: s.start):
+            if span.start < cursor:
+                continue
+            out.append(text[cursor:span.start])
+            out.append(span.replacement)
+            cursor = span.end
+        out.append(text[cursor:])
+        return "".join(out)
+
+    def _number_runs(self, text: str):
+        """Yields (start, end, digits, spoken) for each run of adjacent number tokens."""
+        run_start = run_end = None
+        digits = ""
+        spoken = False
+        repeat = 1
+        for match in _TOKEN.finditer(text):
+            if run_end is not None and not _GAP.match(text[run_end:match.start()]):
+                yield run_start, run_end, digits, spoken
+                run_start = run_end = None
+                digits = ""
+                spoken = False
+                repeat = 1
+
+            token = match.group(0).lower()
+            if run_start is None:
+                run_start = match.start()
+            run_end = match.end()
+            if token in REPEATS:
+                repeat = REPEATS[token]
+                continue
+            if token in SPOKEN_DIGITS:
+                spoken = True
+                digits += SPOKEN_DIGITS[token] * repeat
+            else:
+                digits += token[0] * (repeat - 1) + token
+            repeat = 1
+
+        if run_start is not None:
+            yield run_start, run_end, digits, spoken
+
+    def _context(self, text: str, start: int, end: int) -> str:
+        return text[max(0, start - CONTEXT_CHARS):min(len(text), end + CONTEXT_CHARS // 3)]
+
+    def _number_spans(self, text: str) -> List[Span]:
+        spans = []
+        for start, end, digits, spoken in self._number_runs(text):
+            if len(digits) < 6:
+                continue
+            context = self._context(text, start, end)
+            raw = text[start:end]
+            # Whisper sometimes mishears spoken digits, so trust them slightly less
+            spoken_penalty = 0.03 if spoken else 0.0
+
+            if 13 <= len(digits) <= 19:
+                if luhn_valid(digits):
+                    confidence = round(0.97 - spoken_penalty, 2)
+                elif _CARD_CONTEXT.search(context):
+                    confidence = 0.6
+                else:
+                    confidence = 0.45
+                spans.append(Span(start, end, "card", confidence, _mask(digits, 6, 4)))
+            elif len(digits) == 9 and (_SSN_SHAPE.match(raw) or _SSN_CONTEXT.search(context)):
+                spans.append(Span(start, end, "ssn", round(0.95 - spoken_penalty, 2), f"XXX-XX-{digits[-4:]}"))
+            elif _ID_CONTEXT.search(context):
+                spans.append(Span(start, end, "government_id", round(0.85 - spoken_penalty, 2), _mask(digits, 1, 2)))
+            elif len(digits) == 10 or (len(digits) == 11 and digits[0] == "1"):
+                # Looks like a phone number, which is kept on purpose
+                continue
+            elif len(digits) == 9:
+                spans.append(Span(start, end, "ssn", 0.6, f"XXX-XX-{digits[-4:]}"))
+            elif len(digits) >= 7:
+                spans.append(Span(start, end, "number", 0.45, _mask(digits, 1, 2)))
+        return spans
+
+    def _id_spans(self, text: str, taken: List[Span]) -> List[Span]:
+        spans = []
+        for match in _ALNUM_ID.finditer(text):
+            if any(s.start < match.end() and match.start() < s.end for s in taken):
+                continue
+            if _ID_CONTEXT.search(self._context(text, match.start(), match.end())):
+                spans.append(Span(match.start(), match.end(), "government_id", 0.85, _mask(match.group(0), 1, 2)))
+        return spans
@@ -0,0 +1,195 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import logfire
+
+from search_index import bm25, cosine, embed, fuse, tokenize
+from transcript import Transcript
+
+@dataclass
+class Chunk:
+    text: str
+    start: Optional[float] = None
+    end: Optional[float] = None
+
+    def render(self) -> str:
+        if self.start is None:
+            return self.text
+        return f"[{_clock(self.start)}-{_clock(self.end)}] {self.text}"
+
+@dataclass
+class CallContext:
+    """One call's transcript, chunked and indexed for retrieval."""
+    transcript: str
+    summary: Optional[str]
+    chunks: List[Chunk] = field(default_factory=list)
+    terms: List[Counter] = field(default_factory=list)
+    vectors: list = field(default_factory=list)
+    df: Counter = field(default_factory=Counter)
+    avg_length: float = 0.0
+    loaded_at: float = 0.0
+
+def _clock(seconds: float) -> str:
+    return f"{int(seconds // 60):02d}:{int(seconds % 60):02d}"
+
+def chunk_transcript(transcript: Optional[Transcript], text: str, chunk_chars: int) -> List[Chunk]:
+    """
+    Groups timed segments into chunks of about chunk_chars, keeping their timestamps.
+    Falls back to cutting the plain text on sentence ends when there are no segments.
+    """
+    chunks: List[Chunk] = []
+    if transcript is not None and transcript.segments and transcript.duration > 0:
+        current: List[str] = []
+        start = None
+        end = None
+        for segment in transcript.segments:
+            piece = segment.text.strip()
+            if not piece:
+                continue
+            if current and sum(len(p) + 1 for p in current) + len(piece) > chunk_chars:
+                chunks.append(Chunk(" ".join(current), start, end))
+                current, start = [], None
+            start = segment.start if start is None else start
+            end = segment.end
+            current.append(piece)
+        if current:
+            chunks.append(Chunk(" ".join(current), start, end))
+        return chunks
+
+    position = 0
+    while position < len(text):
+        end = min(len(text), position + chunk_chars)
+        if end < len(text):
+            cut = max(text.rfind(". ", position, end), text.rfind("? ", position, end), text.rfind("! ", position, end))
+            end = cut + 1 if cut > position + chunk_chars // 2 else end
+        chunks.append(Chunk(text[position:end].strip()))
+        position = end
+    return [c for c in chunks if c.text]
+
+class TranscriptRetriever:
+    """
+    Builds the transcript context for a chat turn. Short calls are sent whole. Long
+    calls are chunked and indexed once per call (cached by uuid), and each turn only
+    gets the chunks most relevant to the question plus the call summary, so the
+    prompt stays about the same size however long the call was.
+    """
+
+    def __init__(
+        self,
+        db,
+        full_transcript_chars: int = 8000,
+        chunk_chars: int = 1200,
+        top_k: int = 6,
+        cache_size: int = 256,
+        ttl: float = 3600.0,
+    ):
+        self.db = db
+        self.full_transcript_chars = full_transcript_chars
+        self.chunk_chars = chunk_chars
+        self.top_k = top_k
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, CallContext]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Task] = {}
+
+    def invalidate(self, uuid: str) -> None:
+        self._cache.pop(str(uuid), None)
+        # Turns from now on start a fresh load instead of joining one that may be stale
+        self._loading.pop(str(uuid), None)
+
+    async def _get(self, uuid: str, organisation_id: str) -> Optional[CallContext]:
+        context = self._cache.get(uuid)
+        if context is not None and context.loaded_at + self.ttl > time.time():
+            self._cache.move_to_end(uuid)
+            return context
+
+        # Concurrent turns on the same call share one load
+        task = self._loading.get(uuid)
+        if task is None:
+            task = asyncio.ensure_future(self._load(uuid, organisation_id))
+            self._loading[uuid] = task
+            task.add_done_callback(lambda done: self._forget(uuid, done))
+        # One turn giving up mustn't cancel the load the others wait on
+        context = await asyncio.shield(task)
+        if context is not None:
+            self._cache[uuid] = context
+            self._cache.move_to_end(uuid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return context
+
+    def _forget(self, uuid: str, task: asyncio.Task) -> None:
+        # After an invalidation the entry may already be a newer load
+        if self._loading.get(uuid) is task:
+            del self._loading[uuid]
+
+    async def _load(self, uuid: str, organisation_id: str) -> Optional[CallContext]:
+        row = await self.db.get_chat_context(uuid=uuid, organisation_id=organisation_id)
+        if not row or not row.get("transcription"):
+            return None
+        text = row["transcription"]
+        context = CallContext(transcript=text, summary=row.get("issue_summary"), loaded_at=time.time())
+        if len(text) <= self.full_transcript_chars:
+            return context
+
+        segments = row.get("transcript_segments")
+        transcript = Transcript.from_columns(segments) if segments else None
+        with logfire.span("retrieval index {uuid}", uuid=uuid):
+            await asyncio.to_thread(self._index, context, transcript)
+        return context
+
+    def _index(self, context: CallContext, transcript: Optional[Transcript]) -> None:
+        context.chunks = chunk_transcript(transcript, context.transcript, self.chunk_chars)
+        context.terms = [Counter(tokenize(c.text)) for c in context.chunks]
+        context.vectors = [embed(c.text) for c in context.chunks]
+        for terms in context.terms:
+            context.df.update(terms.keys())
+        context.avg_length = sum(sum(t.values()) for t in context.terms) / max(1, len(context.terms))
+
+    def _select(self, context: CallContext, query: str) -> List[Chunk]:
+        n = len(context.chunks)
+        query_terms = set(tokenize(query))
+        keyword: List[Tuple[int, float]] = []
+        for i, terms in enumerate(context.terms):
+            length = sum(terms.values())
+            score = sum(bm25(terms[t], context.df[t], length, n, context.avg_length) for t in query_terms if t in terms)
+            if score > 0:
+                keyword.append((i, score))
+        keyword.sort(key=lambda item: item[1], reverse=True)
+
+        query_vector = embed(query)
+        semantic = sorted(range(n), key=lambda i: cosine(query_vector, context.vectors[i]), reverse=True)
+
+        fused = fuse([str(i) for i, _ in keyword], [str(i) for i in semantic])
+        best = sorted(fused, key=fused.get, reverse=True)[:self.top_k]
+        # Back in call order so the model reads the conversation as it happened
+        return [context.chunks[i] for i in sorted(int(i) for i in best)]
+
+    async def context_for(self, uuid: str, organisation_id: str, query: str) -> Optional[str]:
+        """Transcript context for a chat turn, or None if the call has no transcript."""
+        uuid = str(uuid)
+        context = await self._get(uuid, organisation_id)
+        if context is None:
+            return None
+        if not context.chunks:
+            return context.transcript
+
+        selected = self._select(context, query)
+        logfire.info(
+            "retrieval selected {selected}/{total} chunks",
+            selected=len(selected),
+            total=len(context.chunks),
+            uuid=uuid,
+        )
+        parts = []
+        if context.summary:
+            parts.append(f"Call summary:\n{context.summary}")
+        parts.append(
+            "Relevant excerpts from the call transcript (the full transcript is longer; "
+            "say so if the answer is not in these excerpts):\n\n"
+            + "\n\n".join(chunk.render() for chunk in selected)
+        )
+        return "\n\n".join(parts)
@@ -1,68 +1,278 @@
+import asyncio
+import json
 import re
-from agents import async_groq_client
+from dataclasses import asdict, replace
+import logfire
+from transcript import Transcript, Word
+from cache import ResultCache, digest
+from redaction import RedactionEngine, Span, REDACT_THRESHOLD, REVIEW_THRESHOLD, mask_text, merge_spans
+from services import get_settings
+from typing import Iterable, List, Optional, Set, Tuple
 
-class SanitizationService:
-    def __init__(self):
-        self.groq_client = async_groq_client
-
-    def _regex_filter(self, text: str) -> str:
-        """Fast masking for SSNs and card numbers."""
-        # Card number masking (shows first 6 and last 4)
-        card_pattern = r'\b((?:\d[ -]?){6})(?:(?:[Xx\- ]{1,6}|\d[ -]?){2,9})([ -]?\d{4})\b'
-        def mask_card(match):
-            first = re.sub(r'\D', '', match.group(1))[:6]
-            last = re.sub(r'\D', '', match.group(2))[-4:]
-            masked = f"{first}{'X' * max(0, 16 - len(first) - len(last))}{last}"
-            return masked
-        text = re.sub(card_pattern, mask_card, text)
-
-        # SSN masking
-        ssn_pattern = r'\b(\d{3}|X{3})[- ]?(\d{2}|X{2})[- ]?(\d{4})\b'
-        text = re.sub(ssn_pattern, r'XXX-XX-\3', text)
-
-        return text
+settings = get_settings()
 
-    async def sanitize(self, transcript: str) -> str:
-        """
-        Combines regex masking + Groq LLM-based redaction for full PII cleansing.
-        """
-        filtered = self._regex_filter(transcript)
+def _normalize(value: str) -> str:
+    return re.sub(r"[^0-9a-z]", "", value.lower())
+
+def _words_matching(words: List[Word], values: Iterable[str]) -> Set[int]:
+    """
+    Indexes of the words that spell out any of `values`, ignoring case, spacing and
+    punctuation, so "123-45-6789" matches the words "123", "45", "6789". A match
+    must start and end on word boundaries.
+    """
+    normalized = [_normalize(w.text) for w in words]
+    joined = "".join(normalized)
+    bounds = []
+    cursor = 0
+    for value in normalized:
+        bounds.append((cursor, cursor + len(value)))
+        cursor += len(value)
+    starts = {start for start, end in bounds if end > start}
+    ends = {end for start, end in bounds if end > start}
+
+    matched: Set[int] = set()
+    for value in values:
+        target = _normalize(value)
+        if not target:
+            continue
+        pos = joined.find(target)
+        while pos != -1:
+            end = pos + len(target)
+            if pos in starts and end in ends:
+                matched.update(i for i, (a, b) in enumerate(bounds) if a < end and pos < b)
+            pos = joined.find(target, pos + 1)
+    return matched
 
-        prompt = f"""
+def _clip(span: Span, start: int, end: int, text: str) -> Span:
+    """`span` in the coordinates of text[start:end]; a part of a span is masked as it stands."""
+    if start <= span.start and span.end <= end:
+        return replace(span, start=span.start - start, end=span.end - start)
+    lo, hi = max(span.start, start), min(span.end, end)
+    return replace(span, start=lo - start, end=hi - start, replacement=mask_text(text[lo:hi], 0, 0))
+
+SPAN_REVIEW_PROMPT = """
             You are a redaction assistant.
 
-            Redact personal identifiable information (PII) such as:
+            Below are numbered excerpts from a customer support call. In each excerpt the
+            candidate is wrapped in [[ ]]. Decide for each candidate whether it is personal
+            identifiable information (PII) that must be redacted:
             - Social Security Numbers (SSNs)
             - Credit/debit card numbers
             - Government-issued ID numbers
 
-            Replace them with X and only expose a few digits at the start and at the end.
-            
-            Keep these details:
-            - Names
-            - Phone numbers
-            - Email addresses
+            Do not redact names, phone numbers, email addresses, dates, prices, order or
+            ticket numbers.
+
+            {candidates}
 
-            Except the names that are mentioned
+            Respond with JSON only, in the form {{"redact": [<numbers of the candidates to redact>]}}.
+            """
 
-            Example:
-            Input: Call me at 555-123-4567 or email john.doe@example.com.
-            Output: Call me at 5XX-XXX-XX67 or email john.doe@example.com.
+WINDOW_REVIEW_PROMPT = """
+            You are a redaction assistant.
 
-            Now redact this transcript:
-            
-            {filtered}
-            
-            Respond with the redacted transcript only do not add any headers or footers.
-            """.strip()
+            Find personal identifiable information (PII) in the transcript excerpt below:
+            - Social Security Numbers (SSNs)
+            - Credit/debit card numbers
+            - Government-issued ID numbers
+
+            Do not report names, phone numbers, email addresses, dates, prices, order or
+            ticket numbers.
+
+            Excerpt:
+
+            {excerpt}
+
+            Do not rewrite the excerpt. Respond with JSON only, listing each piece of PII
+            exactly as it appears in the excerpt:
+            {{"spans": [{{"text": "<exact text>", "type": "ssn" | "card" | "government_id"}}]}}
+            Respond with {{"spans": []}} if there is none.
+            """
+
+class SanitizationService:
+    MODEL = "deepseek-r1-distill-llama-70b"
+    # Bump when the redaction rules change so cached results are recomputed
+    VERSION = "3"
+    # Characters of surrounding transcript shown to the model for each undecided span
+    REVIEW_CONTEXT_CHARS = 80
+    # Window size and overlap for the windowed mode; the overlap keeps a number cut
+    # at a window edge whole in at least one window
+    WINDOW_CHARS = 6000
+    WINDOW_OVERLAP_CHARS = 400
+
+    def __init__(self, groq_client, cache: Optional[ResultCache] = None, mode: Optional[str] = None):
+        self.groq_client = groq_client
+        self.cache = cache
+        self.engine = RedactionEngine()
+        self.mode = mode or settings.sanitization_mode
+        if self.mode not in ("fast", "windowed"):
+            raise ValueError(f"Unknown sanitization mode: {self.mode}")
+        self._semaphore = asyncio.Semaphore(settings.sanitization_concurrency)
+
+    async def sanitize_transcript(self, transcript: Transcript) -> Tuple[str, Transcript]:
+        """The sanitized text, and the segments and words stored next to it redacted with the same spans."""
+        text = transcript.text
+        spans = await self.find_spans(text)
+        return self.engine.apply(text, spans), self.redact_transcript(transcript, spans)
+
+    async def sanitize(self, transcript: str) -> str:
+        return self.engine.apply(transcript, await self.find_spans(transcript))
+
+    @logfire.instrument("sanitization", extract_args=False)
+    async def find_spans(self, transcript: str) -> List[Span]:
+        """
+        The SSNs, card numbers and government IDs to redact. The rule engine settles
+        most spans on its own. In "fast" mode the model only sees the spans it is
+        unsure about; in "windowed" mode the model also reviews the whole transcript
+        in parallel windows and reports spans for the engine to apply.
+        """
+        find = self._spans if self.mode == "fast" else self._spans_windowed
+        if self.cache is None:
+            return await find(transcript)
+        prompt = SPAN_REVIEW_PROMPT if self.mode == "fast" else WINDOW_REVIEW_PROMPT
+        return await self.cache.get_or_compute(
+            f"sanitization.{self.mode}",
+            [digest(transcript), self.MODEL, digest(prompt), self.VERSION],
+            lambda: find(transcript),
+            dumps=lambda spans: json.dumps([asdict(span) for span in spans]),
+            loads=lambda value: [Span(**span) for span in json.loads(value)],
+        )
+
+    def redact_transcript(self, transcript: Transcript, spans: List[Span]) -> Transcript:
+        """
+        Redacts the timed segments and words of `transcript` with the `spans` found in
+        its text. Each segment gets the part of the spans it holds. Every word a span
+        touches is masked whole, and the words are also scanned on their own (undecided
+        spans included) since Whisper's word stream isn't punctuated like the text.
+        """
+        text = transcript.text
+        segments = []
+        cursor = 0
+        for segment in transcript.segments:
+            stripped = segment.text.strip()
+            if not stripped:
+                segments.append(segment)
+                continue
+            start, end = cursor, cursor + len(stripped)
+            cursor = end + 1
+            inside = [_clip(span, start, end, text) for span in spans if span.start < end and start < span.end]
+            segments.append(replace(segment, text=self.engine.apply(stripped, inside)))
+
+        words_text = ""
+        bounds = []
+        for word in transcript.words:
+            if words_text:
+                words_text += " "
+            bounds.append((len(words_text), len(words_text) + len(word.text)))
+            words_text += word.text
+
+        masked = _words_matching(transcript.words, [text[span.start:span.end] for span in spans])
+        for span in self.engine.scan(words_text):
+            if span.confidence >= REVIEW_THRESHOLD:
+                masked.update(i for i, (a, b) in enumerate(bounds) if a < span.end and span.start < b)
+
+        words = [
+            replace(word, text=mask_text(word.text, 0, 0)) if i in masked else word
+            for i, word in enumerate(transcript.words)
+        ]
+        return Transcript(segments=segments, words=words)
+
+    async def _spans(self, transcript: str) -> List[Span]:
+        spans = self.engine.scan(transcript)
+        confident = [s for s in spans if s.confidence >= REDACT_THRESHOLD]
+        undecided = [s for s in spans if REVIEW_THRESHOLD <= s.confidence < REDACT_THRESHOLD]
+
+        if undecided:
+            confident.extend(await self._review_spans(transcript, undecided))
+
+        return merge_spans(transcript, confident)
+
+    async def _review_spans(self, transcript: str, spans: List[Span]) -> List[Span]:
+        """Asks the model which undecided spans are PII. Fails closed on a bad answer."""
+        excerpts = []
+        for i, span in enumerate(spans, start=1):
+            before = transcript[max(0, span.start - self.REVIEW_CONTEXT_CHARS):span.start]
+            after = transcript[span.end:span.end + self.REVIEW_CONTEXT_CHARS]
+            excerpts.append(f"{i}. ...{before}[[{transcript[span.start:span.end]}]]{after}...")
+
+        prompt = SPAN_REVIEW_PROMPT.format(candidates="\n".join(excerpts)).strip()
 
         response = await self.groq_client.chat.completions.create(
-            model="deepseek-r1-distill-llama-70b",
+            model=self.MODEL,
             reasoning_format="hidden",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.1,
         )
 
-        cleaned_response = re.sub(r'<think>.*?</think>', '', response.choices[0].message.content, flags=re.DOTALL)
+        content = re.sub(r'<think>.*?</think>', '', response.choices[0].message.content, flags=re.DOTALL)
+        try:
+            content = re.sub(r"^```(?:json)?|```$", "", content.strip(), flags=re.MULTILINE).strip()
+            selected = {int(n) for n in json.loads(content)["redact"]}
+        except Exception:
+            logfire.warn("Failed to parse span review, redacting all undecided spans: {content}", content=content)
+            return spans
+
+        return [span for i, span in enumerate(spans, start=1) if i in selected]
+
+    async def _spans_windowed(self, transcript: str) -> List[Span]:
+        confident = [s for s in self.engine.scan(transcript) if s.confidence >= REDACT_THRESHOLD]
+
+        windows = self._windows(transcript)
+        results = await asyncio.gather(*(self._review_window(transcript, start, end) for start, end in windows))
+        found = [span for spans in results for span in spans]
+
+        return merge_spans(transcript, confident + found)
+
+    def _windows(self, text: str) -> List[Tuple[int, int]]:
+        """Overlapping (start, end) windows, cut on whitespace where possible."""
+        windows = []
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + self.WINDOW_CHARS)
+            if end < len(text):
+                space = text.rfind(" ", start + self.WINDOW_CHARS // 2, end)
+                end = space if space != -1 else end
+            windows.append((start, end))
+            if end >= len(text):
+                break
+            start = max(end - self.WINDOW_OVERLAP_CHARS, start + 1)
+            space = text.find(" ", start, end)
+            start = space + 1 if space != -1 else start
+        return windows
+
+    async def _review_window(self, transcript: str, start: int, end: int) -> List[Span]:
+        excerpt = transcript[start:end]
+        prompt = WINDOW_REVIEW_PROMPT.format(excerpt=excerpt).strip()
+
+        async with self._semaphore:
+            response = await self.groq_client.chat.completions.create(
+                model=self.MODEL,
+                reasoning_format="hidden",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+            )
+
+        content = re.sub(r'<think>.*?</think>', '', response.choices[0].message.content, flags=re.DOTALL)
+        try:
+            content = re.sub(r"^```(?:json)?|```$", "", content.strip(), flags=re.MULTILINE).strip()
+            reported = json.loads(content)["spans"]
+        except Exception as e:
+            # Unlike a single undecided span there is nothing sensible to fail closed on here
+            raise ValueError(f"Unparseable redaction response for window {start}-{end}: {content[:200]}") from e
 
-        return cleaned_response.strip()
+        spans = []
+        for item in reported:
+            value = str(item.get("text", "")).strip()
+            if not value:
+                continue
+            # Match loosely on whitespace, models don't always echo it exactly
+            pattern = r"\s+".join(re.escape(part) for part in value.split())
+            for match in re.finditer(pattern, excerpt, flags=re.IGNORECASE):
+                spans.append(Span(
+                    start + match.start(),
+                    start + match.end(),
+                    item.get("type", "pii"),
+                    0.9,
+                    mask_text(match.group(0)),
+                ))
+        return spans
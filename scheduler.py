@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import logfire
+
+# Request priorities; lower goes first
+INTERACTIVE = 0
+BATCH = 10
+
+# (requests per minute, tokens per minute); None means no limit of that kind.
+# Tokens per minute is corrected from Groq's x-ratelimit-limit-tokens header after
+# the first response, so only requests per minute really needs configuring.
+DEFAULT_LIMITS: Dict[str, Tuple[Optional[float], Optional[float]]] = {
+    "whisper-large-v3-turbo": (400, None),
+    "llama-3.3-70b-versatile": (1000, 300_000),
+    "deepseek-r1-distill-llama-70b": (1000, 300_000),
+    "llama-3.1-8b-instant": (1000, 250_000),
+}
+
+# Rough size of a token in characters
+CHARS_PER_TOKEN = 4
+# Completion budget assumed when a request doesn't set max_tokens
+DEFAULT_COMPLETION_TOKENS = 512
+# Pause after a 429 that says nothing about when to come back
+DEFAULT_BACKOFF_SECONDS = 2.0
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("groq_priority", default=BATCH)
+
+_MODEL_FIELD = re.compile(rb'name="model"\r\n\r\n([^\r]+)')
+_DURATION = re.compile(r"^(?:(\d+)h)?(?:(\d+)m(?!s))?(?:([\d.]+)s)?(?:([\d.]+)ms)?$")
+
+@contextmanager
+def prioritized(priority: int):
+    """Groq requests made inside the block are scheduled at this priority."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def parse_limits(text: str) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+    """Parses GROQ_RATE_LIMITS, a JSON object of model -> [requests per minute, tokens per minute]."""
+    if not text:
+        return {}
+    return {model: (limits[0], limits[1]) for model, limits in json.loads(text).items()}
+
+def _seconds(value: Optional[str]) -> Optional[float]:
+    """Reads retry-after (seconds or an HTTP date) and Groq's reset headers ("1m2.5s", "250ms")."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    match = _DURATION.match(value.strip())
+    if match and any(match.groups()):
+        hours, minutes, seconds, millis = (float(g) if g else 0.0 for g in match.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _estimate(request: httpx.Request) -> Tuple[Optional[str], int]:
+    """The model a request is for and how many tokens it may use, from its body."""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        body = json.loads(request.content or b"{}")
+        prompt_chars = len(json.dumps(body.get("messages", []))) + len(json.dumps(body.get("tools", [])))
+        completion = body.get("max_completion_tokens") or body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        return body.get("model"), prompt_chars // CHARS_PER_TOKEN + completion
+    if content_type.startswith("multipart/form-data"):
+        match = _MODEL_FIELD.search(request.content)
+        return (match.group(1).decode() if match else None), 0
+    return None, 0
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    tokens: int
+    queued_at: float
+    priority: int
+
+class _ModelState:
+    """Token buckets for one model plus the requests waiting on them."""
+
+    def __init__(self, rpm: Optional[float], tpm: Optional[float]):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm or 0)
+        self.tokens = float(tpm or 0)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting: List[Tuple[int, int, _Waiter]] = []
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.in_flight = 0
+        self.sent = 0
+        self.throttled = 0
+        self.retried = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def delay_for(self, tokens: int) -> float:
+        """Seconds until a request of this size fits in both buckets."""
+        delay = 0.0
+        if self.rpm and self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm:
+            # A request bigger than the whole budget waits for a full bucket, then runs into debt
+            needed = min(tokens, self.tpm)
+            if self.tokens < needed:
+                delay = max(delay, (needed - self.tokens) * 60 / self.tpm)
+        return delay
+
+    def take(self, tokens: int) -> None:
+        if self.rpm:
+            self.requests -= 1
+        if self.tpm:
+            self.tokens -= tokens
+
+class RateLimitScheduler:
+    """
+    Paces every Groq request against per-model request and token budgets.
+
+    Requests wait in a priority queue per model and are released as the budgets
+    refill, so bursts queue here instead of turning into 429s. A 429 that does get
+    through pauses the whole model for its retry-after, and the token budget is kept
+    in line with Groq's x-ratelimit headers, which also covers other processes
+    sharing the same API key.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._models: Dict[str, _ModelState] = {}
+        self._seq = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = _ModelState(*self.limits.get(model, (None, None)))
+        return state
+
+    async def acquire(self, model: str, tokens: int, priority: int) -> None:
+        state = self._state(model)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens, time.monotonic(), priority)
+        heapq.heappush(state.waiting, (priority, next(self._seq), waiter))
+        if state.dispatcher is None or state.dispatcher.done():
+            state.dispatcher = asyncio.ensure_future(self._dispatch(state))
+        await waiter.future
+
+    async def _dispatch(self, state: _ModelState) -> None:
+        while state.waiting:
+            now = time.monotonic()
+            if state.paused_until > now:
+                await asyncio.sleep(state.paused_until - now)
+                continue
+            _, _, waiter = state.waiting[0]
+            if waiter.future.done():
+                # The caller gave up while queued
+                heapq.heappop(state.waiting)
+                continue
+            state.refill(now)
+            delay = state.delay_for(waiter.tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(state.waiting)
+            state.take(waiter.tokens)
+            waited = now - waiter.queued_at
+            state.wait_total += waited
+            state.wait_max = max(state.wait_max, waited)
+            state.sent += 1
+            waiter.future.set_result(None)
+
+    def observe(self, model: str, response: httpx.Response) -> Optional[float]:
+        """Syncs the budgets with a response's headers. Returns the pause after a 429, else None."""
+        state = self._state(model)
+        headers = response.headers
+        limit = headers.get("x-ratelimit-limit-tokens")
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            if limit:
+                state.tpm = float(limit)
+            if remaining:
+                state.refill(time.monotonic())
+                state.tokens = min(state.tokens, float(remaining))
+        except ValueError:
+            pass
+
+        if response.status_code != 429:
+            return None
+        delay = (
+            _seconds(headers.get("retry-after"))
+            or _seconds(headers.get("x-ratelimit-reset-tokens"))
+            or DEFAULT_BACKOFF_SECONDS
+        )
+        state.throttled += 1
+        state.paused_until = max(state.paused_until, time.monotonic() + delay)
+        state.requests = min(state.requests, 0.0)
+        logfire.warn("Groq {model} rate limited, pausing {delay}s", model=model, delay=delay)
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        models = {}
+        for model, state in self._models.items():
+            state.refill(now)
+            queued = [waiter for _, _, waiter in state.waiting if not waiter.future.done()]
+            models[model] = {
+                "rpm": state.rpm,
+                "tpm": state.tpm,
+                "available_requests": round(state.requests, 1) if state.rpm else None,
+                "available_tokens": round(state.tokens) if state.tpm else None,
+                "queued": len(queued),
+                "queued_by_priority": dict(Counter(waiter.priority for waiter in queued)),
+                "oldest_queued_s": round(max((now - w.queued_at for w in queued), default=0.0), 2),
+                "in_flight": state.in_flight,
+                "sent": state.sent,
+                "throttled": state.throttled,
+                "retried": state.retried,
+                "avg_wait_ms": round(state.wait_total / state.sent * 1000, 1) if state.sent else 0.0,
+                "max_wait_ms": round(state.wait_max * 1000, 1),
+                "paused_for_s": round(max(0.0, state.paused_until - now), 2),
+            }
+        return models
+
+class SchedulingTransport(httpx.AsyncBaseTransport):
+    """httpx transport that sends each Groq request through a RateLimitScheduler."""
+
+    def __init__(
+        self,
+        scheduler: RateLimitScheduler,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        max_throttle_retries: int = 5,
+    ):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.max_throttle_retries = max_throttle_retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # Buffered so the body can be sent again after a 429
+        await request.aread()
+        model, tokens = _estimate(request)
+        if model is None:
+            return await self.transport.handle_async_request(request)
+
+        state = self.scheduler._state(model)
+        priority = _priority.get()
+        for attempt in range(self.max_throttle_retries + 1):
+            await self.scheduler.acquire(model, tokens, priority)
+            state.in_flight += 1
+            try:
+                response = await self.transport.handle_async_request(request)
+            finally:
+                state.in_flight -= 1
+            if self.scheduler.observe(model, response) is None or attempt == self.max_throttle_retries:
+                return response
+            # The scheduler holds the request until the pause is over
+            await response.aclose()
+            state.retried += 1
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import math
+import operator
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import logfire
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be but by for from has have he her his i if in into is it its
+    me my no not of on or our she so than that the their them then there these they
+    this to was we were what when which who will with you your um uh yeah okay ok
+    """.split()
+)
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Reciprocal rank fusion constant for hybrid queries
+RRF_K = 60
+
+def _stem(word: str) -> str:
+    # Light suffix stripping so "refunded", "refunds" and "refund" share a term
+    for suffix in ("ing", "ed", "es", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text: str) -> List[str]:
+    return [_stem(t) for t in _WORD.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+def _bucket(feature: str, dim: int) -> Tuple[int, float]:
+    h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+    return h % dim, 1.0 if (h >> 63) & 1 else -1.0
+
+def embed(text: str, dim: int = 256) -> array:
+    """
+    CPU-only text embedding using the hashing trick: word unigrams, bigrams and
+    character trigrams are hashed into a fixed number of signed buckets, log-scaled
+    and L2-normalised. Trigrams make related word forms ("refund", "refunded") and
+    small typos land close together without a model download.
+    """
+    vector = [0.0] * dim
+    words = tokenize(text)
+    features: Counter = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f"#{word}#"
+        features.update(f"#3{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    for feature, count in features.items():
+        index, sign = _bucket(feature, dim)
+        vector[index] += sign * (1.0 + math.log(count))
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return array("f", (v / norm for v in vector))
+
+def cosine(a: Iterable[float], b: Iterable[float]) -> float:
+    # Both sides are normalised, so the dot product is the cosine
+    return sum(map(operator.mul, a, b))
+
+def bm25(tf: int, df: int, length: int, n_docs: int, avg_length: float) -> float:
+    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    return idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / (avg_length or 1.0)))
+
+def fuse(*rankings: List[str]) -> Dict[str, float]:
+    """Reciprocal rank fusion of several ranked id lists."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (RRF_K + rank)
+    return scores
+
+class SearchIndex:
+    """
+    Local search over call transcripts, reports and call logs.
+
+    Keeps a BM25 inverted index for keyword queries and a hashed embedding per call
+    for semantic queries, both in SQLite and scoped by organisation. Calls are
+    (re)indexed one at a time as they complete. The file lives on the data volume;
+    each host keeps its own copy, and the app rebuilds it at startup when it's empty.
+    """
+
+    MODES = ("keyword", "semantic", "hybrid")
+
+    def __init__(self, path: str, dim: int = 256):
+        self.path = path
+        self.dim = dim
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                call_id TEXT PRIMARY KEY,
+                organisation_id TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_org_idx ON docs (organisation_id)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS postings (
+                organisation_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                call_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (organisation_id, term, call_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_call_idx ON postings (call_id)")
+        self._conn.commit()
+
+    # --- writes ---
+
+    def _remove(self, call_id: str) -> None:
+        self._conn.execute("DELETE FROM postings WHERE call_id = ?", (call_id,))
+        self._conn.execute("DELETE FROM docs WHERE call_id = ?", (call_id,))
+
+    def _add(self, call_id: str, organisation_id: str, text: str) -> None:
+        terms = Counter(tokenize(text))
+        vector = embed(text, self.dim)
+        with self._lock:
+            self._remove(call_id)
+            self._conn.execute(
+                "INSERT INTO docs (call_id, organisation_id, length, vector, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (call_id, organisation_id, sum(terms.values()), vector.tobytes(), time.time()),
+            )
+            self._conn.executemany(
+                "INSERT INTO postings (organisation_id, term, call_id, tf) VALUES (?, ?, ?, ?)",
+                [(organisation_id, term, call_id, tf) for term, tf in terms.items()],
+            )
+            self._conn.commit()
+
+    def _delete(self, call_id: str) -> None:
+        with self._lock:
+            self._remove(call_id)
+            self._conn.commit()
+
+    async def add(self, call_id: str, organisation_id: str, fields: Dict[str, Optional[str]]) -> None:
+        """Indexes (or reindexes) a call from its text fields."""
+        text = "\n".join(value for value in fields.values() if value)
+        with logfire.span("search_index add"):
+            await asyncio.to_thread(self._add, call_id, organisation_id, text)
+
+    async def delete(self, call_id: str) -> None:
+        await asyncio.to_thread(self._delete, call_id)
+
+    # --- reads ---
+
+    def _keyword(self, organisation_id: str, terms: List[str], limit: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            n_docs, avg_length = self._conn.execute(
+                "SELECT COUNT(*), AVG(length) FROM docs WHERE organisation_id = ?", (organisation_id,)
+            ).fetchone()
+            if not n_docs:
+                return []
+            scores: Dict[str, float] = {}
+            for term in set(terms):
+                rows = self._conn.execute(
+                    """
+                    SELECT p.call_id, p.tf, d.length FROM postings p JOIN docs d ON d.call_id = p.call_id
+                    WHERE p.organisation_id = ? AND p.term = ?
+                    """,
+                    (organisation_id, term),
+                ).fetchall()
+                for call_id, tf, length in rows:
+                    scores[call_id] = scores.get(call_id, 0.0) + bm25(tf, len(rows), length, n_docs, avg_length)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def _semantic(self, organisation_id: str, query: array, limit: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT call_id, vector FROM docs WHERE organisation_id = ?", (organisation_id,)).fetchall()
+        scored = []
+        for call_id, blob in rows:
+            vector = array("f")
+            vector.frombytes(blob)
+            scored.append((call_id, cosine(query, vector)))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return [item for item in scored[:limit] if item[1] > 0]
+
+    def _search(self, organisation_id: str, text: str, limit: int, mode: str) -> List[Dict[str, float]]:
+        # Fetch deeper lists than asked for so fusion has something to combine
+        depth = max(limit * 3, 50)
+        keyword = self._keyword(organisation_id, tokenize(text), depth) if mode != "semantic" else []
+        semantic = self._semantic(organisation_id, embed(text, self.dim), depth) if mode != "keyword" else []
+
+        if mode == "keyword":
+            ranked = keyword
+        elif mode == "semantic":
+            ranked = semantic
+        else:
+            fused = fuse([id for id, _ in keyword], [id for id, _ in semantic])
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+        return [{"call_id": call_id, "score": round(score, 6)} for call_id, score in ranked[:limit]]
+
+    async def search(self, organisation_id: str, text: str, limit: int = 20, mode: str = "hybrid") -> List[Dict[str, float]]:
+        """Ranked call ids for one organisation; mode is keyword, semantic or hybrid."""
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        with logfire.span("search_index search", mode=mode):
+            return await asyncio.to_thread(self._search, organisation_id, text, limit, mode)
+
+    def _stats(self) -> Dict[str, int]:
+        with self._lock:
+            docs = self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            postings = self._conn.execute("SELECT COUNT(*) FROM postings").fetchone()[0]
+        return {"documents": docs, "postings": postings}
+
+    async def stats(self) -> Dict[str, int]:
+        return await asyncio.to_thread(self._stats)
@@ -0,0 +1,336 @@
+import time
+
+# Startup is measured from here; app.py imports this module first
+IMPORTED_AT = time.perf_counter()
+
+import asyncio
+import os
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, Generic, List, Optional, TypeVar
+
+import logfire
+from settings import Settings
+
+BUCKET_NAME = "call-logs-audio-files"
+
+# Built in a background thread once the app is serving, so the first request doesn't pay for them
+WARM_UP = ("postgrest_client", "groq_client", "storage", "agents")
+
+def _enabled(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+def _test_stand_ins() -> Dict[str, Any]:
+    """
+    TEST_MODE settings: Groq, S3 and Supabase all point at TEST_SERVICES_URL (the
+    stand-ins from `python -m benchmarks.fakes`) and no real credentials are needed.
+    These win over the environment and .env, so a test run never reaches a real service.
+    """
+    url = os.environ.get("TEST_SERVICES_URL", "http://127.0.0.1:9100")
+    return {
+        "TEST_MODE": True,
+        "GROQ_API_KEY": "test",
+        "GROQ_BASE_URL": url,
+        "SUPABASE_URL": url,
+        "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.e30.test",
+        "S3_ENDPOINT_URL": url,
+        "AWS_ACCESS_KEY": "test",
+        "AWS_SECRET_ACCESS_KEY": "test",
+        "LOGFIRE_WRITE_TOKEN": "test",
+    }
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """The process's settings, read from the environment once."""
+    if _enabled("TEST_MODE"):
+        return Settings(**_test_stand_ins())
+    return Settings()
+
+@lru_cache(maxsize=None)
+def configure_logfire() -> None:
+    settings = get_settings()
+    if settings.test_mode:
+        logfire.configure(send_to_logfire=False, console=False)
+    else:
+        logfire.configure(token=settings.logfire_write_token)
+    logfire.instrument_pydantic_ai()
+
+T = TypeVar("T")
+
+class service(Generic[T]):
+    """A Services attribute that is built on first access, once, and timed."""
+
+    def __init__(self, build: Callable[["Services"], T]):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance: Optional["Services"], owner=None) -> T:
+        if instance is None:
+            return self
+        # Once built the value sits in the instance dict, which shadows this descriptor.
+        # Each service has its own lock, so building one (say in the warm-up thread)
+        # only holds up callers of that service and of the ones built from it
+        with instance._lock_for(self.name):
+            if self.name not in instance.__dict__:
+                start = time.perf_counter()
+                value = self.build(instance)
+                instance.timings[self.name] = round((time.perf_counter() - start) * 1000, 2)
+                instance.__dict__[self.name] = value
+        return instance.__dict__[self.name]
+
+class Services:
+    """
+    The clients and handlers shared by the whole process, one of each. Nothing is
+    built until it's first used: importing the app creates no HTTP clients, SSL
+    contexts or boto3 service models, and the libraries behind them are only
+    imported then. The app's lifespan starts the background parts and closes
+    whatever got built.
+
+    Also the `deps` handed to DatabaseHandler and MemoryHandler.
+    """
+
+    def __init__(self):
+        # Guards _locks only; never held while a service is built
+        self._lock = threading.Lock()
+        self._locks: Dict[str, threading.RLock] = {}
+        # Build time of each service in ms, including anything it built in turn
+        self.timings: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+        self._warm_up: Optional[asyncio.Future] = None
+
+    def _lock_for(self, name: str) -> threading.RLock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.RLock())
+
+    def built(self, name: str) -> bool:
+        return name in self.__dict__
+
+    @service
+    def settings(self) -> Settings:
+        return get_settings()
+
+    @service
+    def groq_scheduler(self):
+        from scheduler import DEFAULT_LIMITS, RateLimitScheduler, parse_limits
+
+        # Every Groq call (agents, transcription, sanitization) goes through one scheduler
+        return RateLimitScheduler(limits={**DEFAULT_LIMITS, **parse_limits(self.settings.groq_rate_limits)})
+
+    @service
+    def groq_client(self):
+        import groq
+        import httpx
+        from scheduler import SchedulingTransport
+
+        return groq.AsyncGroq(
+            api_key=self.settings.groq_api_key,
+            base_url=self.settings.groq_base_url,
+            http_client=groq.DefaultAsyncHttpxClient(
+                transport=SchedulingTransport(
+                    self.groq_scheduler,
+                    transport=httpx.AsyncHTTPTransport(limits=groq.DEFAULT_CONNECTION_LIMITS),
+                    max_throttle_retries=self.settings.groq_throttle_retries,
+                ),
+            ),
+        )
+
+    @service
+    def agents(self):
+        from agents import build_agents
+
+        return build_agents(self.groq_client)
+
+    @service
+    def storage(self):
+        from storage import ObjectStorage, create_s3_client
+
+        client = create_s3_client(
+            access_key=self.settings.aws_access_key,
+            secret_key=self.settings.aws_secret_access_key,
+            endpoint_url=self.settings.s3_endpoint_url,
+            max_connections=self.settings.s3_max_connections,
+            timeout=self.settings.s3_timeout,
+        )
+        return ObjectStorage(client, BUCKET_NAME, max_connections=self.settings.s3_max_connections)
+
+    @service
+    def postgrest_client(self):
+        from database import create_postgrest_client
+
+        return create_postgrest_client(
+            supabase_url=self.settings.supabase_url,
+            supabase_key=self.settings.supabase_key,
+            max_connections=self.settings.db_max_connections,
+            max_keepalive_connections=self.settings.db_max_keepalive_connections,
+            timeout=self.settings.db_timeout,
+        )
+
+    @service
+    def log_counts(self):
+        from database import CountCache
+
+        return CountCache(ttl=self.settings.log_count_ttl_seconds)
+
+    @service
+    def org_configs(self):
+        from org_config import InvalidationBus, OrgConfigCache
+
+        return OrgConfigCache(
+            ttl=self.settings.org_config_ttl_seconds,
+            bus=InvalidationBus(self.settings.invalidation_bus_path),
+        )
+
+    @service
+    def users(self):
+        from auth import ExpiringLRU
+
+        return ExpiringLRU(self.settings.user_cache_size, ttl=self.settings.user_cache_ttl_seconds)
+
+    @service
+    def db(self):
+        from database import DatabaseHandler
+
+        return DatabaseHandler(deps=self)
+
+    @service
+    def result_cache(self):
+        from cache import create_result_cache
+
+        return create_result_cache(self.settings)
+
+    @service
+    def transcription_service(self):
+        from transcription import TranscriptionService
+
+        return TranscriptionService(
+            groq_client=self.groq_client,
+            storage=self.storage,
+            cache=self.result_cache,
+        )
+
+    @service
+    def sanitization_service(self):
+        from santization import SanitizationService
+
+        return SanitizationService(groq_client=self.groq_client, cache=self.result_cache)
+
+    @service
+    def memory(self):
+        from memory import MemoryHandler
+
+        return MemoryHandler(
+            deps=self,
+            cache_size=self.settings.memory_cache_size,
+            flush_interval=self.settings.memory_flush_interval,
+            revalidate_seconds=self.settings.memory_revalidate_seconds,
+            summarize=lambda previous, turns: self.agents.summarize_conversation(previous, turns),
+            summary_threshold=self.settings.memory_summary_threshold,
+            keep_recent=self.settings.memory_keep_recent,
+        )
+
+    @service
+    def retriever(self):
+        from retrieval import TranscriptRetriever
+
+        return TranscriptRetriever(
+            self.db,
+            full_transcript_chars=self.settings.chat_full_transcript_chars,
+            chunk_chars=self.settings.chat_chunk_chars,
+            top_k=self.settings.chat_top_k,
+            cache_size=self.settings.chat_context_cache_size,
+        )
+
+    @service
+    def job_queue(self):
+        from jobs import JobQueue
+
+        return JobQueue(
+            path=self.settings.job_db_path,
+            concurrency=self.settings.job_concurrency,
+            max_attempts=self.settings.job_max_attempts,
+            backoff_seconds=self.settings.job_backoff_seconds,
+            lease_seconds=self.settings.job_lease_seconds,
+            retention_seconds=self.settings.job_retention_days * 24 * 3600,
+        )
+
+    @service
+    def search_index(self):
+        from search_index import SearchIndex
+
+        return SearchIndex(self.settings.search_index_path)
+
+    @service
+    def ingestor(self):
+        from ingest import BulkIngestor
+
+        return BulkIngestor(
+            self.db,
+            self.storage,
+            job_queue=self.job_queue,
+            upload_concurrency=self.settings.ingest_upload_concurrency,
+            insert_batch_size=self.settings.ingest_insert_batch_size,
+            priority=self.settings.ingest_job_priority,
+            source_buckets=self.settings.ingest_source_buckets,
+        )
+
+    def mark(self, name: str) -> None:
+        """Records how long after startup began a milestone was reached."""
+        self.marks[name] = round((time.perf_counter() - IMPORTED_AT) * 1000, 2)
+
+    def _build(self, names: List[str]) -> None:
+        for name in names:
+            try:
+                getattr(self, name)
+            except Exception as e:
+                # Left for the first request that needs it, which then sees the error
+                logfire.warn("Warming up {service} failed: {error!r}", service=name, error=e)
+
+    async def start(self) -> None:
+        await self.job_queue.start()
+        await self.org_configs.bus.start()
+        self.mark("ready")
+        report = self.startup_report()
+        if report["within_budget"]:
+            logfire.info("Started in {ready_ms}ms", **report)
+        else:
+            logfire.warn("Started in {ready_ms}ms, over the {budget_ms}ms budget", **report)
+        if self.settings.services_warmup:
+            self._warm_up = asyncio.ensure_future(asyncio.to_thread(self._build, list(WARM_UP)))
+
+    async def aclose(self) -> None:
+        """Stops and closes whatever was built, without building anything new."""
+        if self._warm_up is not None:
+            await asyncio.gather(self._warm_up, return_exceptions=True)
+        if self.built("ingestor"):
+            await self.ingestor.stop()
+        if self.built("job_queue"):
+            await self.job_queue.stop()
+        if self.built("org_configs"):
+            await self.org_configs.bus.stop()
+        if self.built("memory"):
+            await self.memory.close()
+        if self.built("postgrest_client"):
+            await self.postgrest_client.aclose()
+        if self.built("groq_client"):
+            await self.groq_client.close()
+        if self.built("storage"):
+            self.storage.close()
+        if self.built("transcription_service"):
+            from transcription import shutdown_encode_pool
+
+            shutdown_encode_pool()
+
+    def startup_report(self) -> Dict[str, Any]:
+        budget = self.settings.startup_budget_ms
+        ready = self.marks.get("ready")
+        return {
+            "ready_ms": ready,
+            "budget_ms": budget,
+            "within_budget": ready is None or ready <= budget,
+            "marks": dict(self.marks),
+            "built_ms": dict(self.timings),
+            "not_built": [name for name, value in vars(Services).items() if isinstance(value, service) and not self.built(name)],
+        }
+
+services = Services()
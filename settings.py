@@ -2,15 +2,70 @@ from pydantic_settings import BaseSettings
 from pydantic import Field
 import json
 import base64
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 class Settings(BaseSettings):
     groq_api_key : str = Field(..., validation_alias="GROQ_API_KEY")
+    groq_base_url : Optional[str] = Field(None, validation_alias="GROQ_BASE_URL")
+    groq_rate_limits: str = Field("", validation_alias="GROQ_RATE_LIMITS")  # JSON {"model": [rpm, tpm]}, merged over the defaults
+    groq_throttle_retries: int = Field(5, validation_alias="GROQ_THROTTLE_RETRIES")
     supabase_url : str = Field(..., validation_alias="SUPABASE_URL")
     supabase_key : str = Field(..., validation_alias="SUPABASE_KEY")
     logfire_write_token : str = Field(..., validation_alias="LOGFIRE_WRITE_TOKEN")
     aws_access_key: str = Field(..., validation_alias="AWS_ACCESS_KEY")
     aws_secret_access_key: str = Field(..., validation_alias="AWS_SECRET_ACCESS_KEY")
+    s3_endpoint_url: Optional[str] = Field(None, validation_alias="S3_ENDPOINT_URL")
+    s3_upload_part_size_mb: int = Field(8, validation_alias="S3_UPLOAD_PART_SIZE_MB")
+    s3_max_connections: int = Field(20, validation_alias="S3_MAX_CONNECTIONS")
+    s3_timeout: float = Field(60.0, validation_alias="S3_TIMEOUT")
+    s3_presign_expiry_seconds: int = Field(900, validation_alias="S3_PRESIGN_EXPIRY_SECONDS")
+    db_max_connections: int = Field(20, validation_alias="DB_MAX_CONNECTIONS")
+    db_max_keepalive_connections: int = Field(10, validation_alias="DB_MAX_KEEPALIVE_CONNECTIONS")
+    db_timeout: float = Field(30.0, validation_alias="DB_TIMEOUT")
+    transcription_concurrency: int = Field(4, validation_alias="TRANSCRIPTION_CONCURRENCY")
+    transcription_max_retries: int = Field(2, validation_alias="TRANSCRIPTION_MAX_RETRIES")  # after the first attempt
+    transcription_encode_workers: Optional[int] = Field(None, validation_alias="TRANSCRIPTION_ENCODE_WORKERS")
+    cache_backend: str = Field("memory", validation_alias="CACHE_BACKEND")  # memory, disk, redis or none
+    cache_ttl_seconds: Optional[float] = Field(7 * 24 * 3600, validation_alias="CACHE_TTL_SECONDS")
+    cache_max_entries: int = Field(1000, validation_alias="CACHE_MAX_ENTRIES")
+    cache_disk_path: str = Field("cache.sqlite3", validation_alias="CACHE_DISK_PATH")
+    cache_max_mb: int = Field(1024, validation_alias="CACHE_MAX_MB")
+    redis_url: Optional[str] = Field(None, validation_alias="REDIS_URL")
+    sanitization_mode: str = Field("fast", validation_alias="SANITIZATION_MODE")  # fast or windowed
+    sanitization_concurrency: int = Field(4, validation_alias="SANITIZATION_CONCURRENCY")
+    log_count_ttl_seconds: float = Field(300.0, validation_alias="LOG_COUNT_TTL_SECONDS")
+    auth_token_cache_size: int = Field(4096, validation_alias="AUTH_TOKEN_CACHE_SIZE")
+    bcrypt_concurrency: int = Field(2, validation_alias="BCRYPT_CONCURRENCY")
+    user_cache_ttl_seconds: float = Field(60.0, validation_alias="USER_CACHE_TTL_SECONDS")
+    user_cache_size: int = Field(1024, validation_alias="USER_CACHE_SIZE")
+    org_config_ttl_seconds: float = Field(300.0, validation_alias="ORG_CONFIG_TTL_SECONDS")
+    invalidation_bus_path: str = Field("bus.sqlite3", validation_alias="INVALIDATION_BUS_PATH")  # shared by workers on one host
+    search_index_path: str = Field("data/search.sqlite3", validation_alias="SEARCH_INDEX_PATH")  # rebuilt at startup if empty
+    chat_full_transcript_chars: int = Field(8000, validation_alias="CHAT_FULL_TRANSCRIPT_CHARS")
+    chat_chunk_chars: int = Field(1200, validation_alias="CHAT_CHUNK_CHARS")
+    chat_top_k: int = Field(6, validation_alias="CHAT_TOP_K")
+    chat_context_cache_size: int = Field(256, validation_alias="CHAT_CONTEXT_CACHE_SIZE")
+    memory_token_budget: int = Field(3000, validation_alias="MEMORY_TOKEN_BUDGET")
+    memory_cache_size: int = Field(1024, validation_alias="MEMORY_CACHE_SIZE")
+    memory_flush_interval: float = Field(1.0, validation_alias="MEMORY_FLUSH_INTERVAL")
+    memory_revalidate_seconds: float = Field(15.0, validation_alias="MEMORY_REVALIDATE_SECONDS")
+    memory_summary_threshold: int = Field(2000, validation_alias="MEMORY_SUMMARY_THRESHOLD")  # tokens
+    memory_keep_recent: int = Field(6, validation_alias="MEMORY_KEEP_RECENT")  # messages left unsummarised
+    agent_stage_timeout: float = Field(180.0, validation_alias="AGENT_STAGE_TIMEOUT")
+    extraction_field_retries: int = Field(1, validation_alias="EXTRACTION_FIELD_RETRIES")  # follow-ups for fields left empty
+    job_db_path: str = Field("data/jobs.sqlite3", validation_alias="JOB_DB_PATH")  # data/ is a volume in deploys
+    job_concurrency: int = Field(4, validation_alias="JOB_CONCURRENCY")
+    job_max_attempts: int = Field(3, validation_alias="JOB_MAX_ATTEMPTS")
+    job_backoff_seconds: float = Field(5.0, validation_alias="JOB_BACKOFF_SECONDS")
+    job_lease_seconds: float = Field(300.0, validation_alias="JOB_LEASE_SECONDS")
+    job_retention_days: float = Field(7.0, validation_alias="JOB_RETENTION_DAYS")  # finished jobs are deleted after this
+    ingest_upload_concurrency: int = Field(8, validation_alias="INGEST_UPLOAD_CONCURRENCY")
+    ingest_insert_batch_size: int = Field(500, validation_alias="INGEST_INSERT_BATCH_SIZE")
+    ingest_source_buckets: str = Field("", validation_alias="INGEST_SOURCE_BUCKETS")  # comma-separated bucket or bucket/prefix manifests may copy from
+    test_mode: bool = Field(False, validation_alias="TEST_MODE")  # local stand-ins, see services.get_settings
+    startup_budget_ms: float = Field(1500.0, validation_alias="STARTUP_BUDGET_MS")
+    services_warmup: bool = Field(True, validation_alias="SERVICES_WARMUP")  # build clients in the background once serving
+    ingest_job_priority: int = Field(10, validation_alias="INGEST_JOB_PRIORITY")  # interactive uploads are 0
     # gcp_service_account_json_base64: str = Field(..., validation_alias="GCP_SERVICE_ACCOUNT_JSON_BASE64")
     # gcp_project_id: str = Field(..., validation_alias="GCP_PROJECT_ID")
     
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+def create_s3_client(
+    access_key: str,
+    secret_key: str,
+    endpoint_url: Optional[str] = None,
+    max_connections: int = 20,
+    timeout: float = 60.0,
+):
+    """A boto3 S3 client whose connection pool is sized to max_connections."""
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "s3",
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        endpoint_url=endpoint_url,
+        # region_name="us-east-1"  # Adjust region as needed
+        config=Config(
+            max_pool_connections=max_connections,
+            # Presigned URLs need SigV4 in every region
+            signature_version="s3v4",
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            retries={"max_attempts": 3, "mode": "standard"},
+        ),
+    )
+
+def _is_missing(error: Exception) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+class ObjectStorage:
+    """
+    The bucket, through one pooled boto3 client shared by the whole process.
+
+    boto3 is synchronous, so every call (and reading a response body) runs on a
+    thread pool with one thread per pooled connection: object traffic never blocks
+    the event loop, and can't queue up behind unrelated to_thread work or open more
+    connections than the pool holds.
+    """
+
+    def __init__(self, client, bucket: str, max_connections: int = 20):
+        self.client = client
+        self.bucket = bucket
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="s3")
+
+    async def _call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_bytes(self, key: str) -> bytes:
+        def get() -> bytes:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+        return await self._call(get)
+
+    async def put_bytes(self, key: str, body: bytes, content_type: Optional[str] = None) -> None:
+        extra = {"ContentType": content_type} if content_type else {}
+        await self._call(self.client.put_object, Bucket=self.bucket, Key=key, Body=body, **extra)
+
+    async def copy(self, key: str, source_bucket: str, source_key: str) -> None:
+        copy_source = {"Bucket": source_bucket, "Key": source_key}
+        await self._call(self.client.copy_object, Bucket=self.bucket, Key=key, CopySource=copy_source)
+
+    async def head(self, key: str) -> Optional[Dict[str, Any]]:
+        """The object's metadata, or None if there is no such object."""
+        try:
+            return await self._call(self.client.head_object, Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if _is_missing(e):
+                return None
+            raise
+
+    def presign_put(
+        self,
+        key: str,
+        content_type: Optional[str] = None,
+        expires_in: int = 900,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Tuple[str, Dict[str, str]]:
+        """
+        A URL the holder can PUT the object to directly until it expires, and the
+        headers the PUT must send. Signed locally, no request is made. The PUT only
+        succeeds if the key doesn't exist yet, so it can never overwrite an object,
+        and it stores `metadata` on the object for the caller to check later.
+        """
+        params = {"Bucket": self.bucket, "Key": key, "IfNoneMatch": "*"}
+        headers = {"If-None-Match": "*"}
+        if content_type:
+            params["ContentType"] = content_type
+            headers["Content-Type"] = content_type
+        if metadata:
+            params["Metadata"] = metadata
+            headers.update({f"x-amz-meta-{name}": value for name, value in metadata.items()})
+        url = self.client.generate_presigned_url("put_object", Params=params, ExpiresIn=expires_in, HttpMethod="PUT")
+        return url, headers
+
+    async def stream_upload(
+        self,
+        key: str,
+        file: Any,
+        content_type: Optional[str] = None,
+        part_size: int = 8 * 1024 * 1024,
+    ) -> int:
+        """
+        Streams an async readable (e.g. a FastAPI UploadFile) to the bucket in parts.
+
+        Only one part is held in memory at a time, so peak memory per upload is
+        bounded by `part_size`. Files smaller than one part go through a single
+        put_object. Returns the number of bytes uploaded.
+        """
+        part_size = max(part_size, MIN_PART_SIZE)
+        extra = {"ContentType": content_type} if content_type else {}
+
+        chunk = await file.read(part_size)
+        if len(chunk) < part_size:
+            await self._call(self.client.put_object, Bucket=self.bucket, Key=key, Body=chunk, **extra)
+            return len(chunk)
+
+        upload = await self._call(self.client.create_multipart_upload, Bucket=self.bucket, Key=key, **extra)
+        upload_id = upload["UploadId"]
+        parts = []
+        total = 0
+
+        try:
+            while chunk:
+                part_number = len(parts) + 1
+                response = await self._call(
+                    self.client.upload_part,
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=chunk,
+                )
+                parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+                total += len(chunk)
+                chunk = await file.read(part_size)
+
+            await self._call(
+                self.client.complete_multipart_upload,
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            # Don't leave orphaned parts accruing storage costs
+            await self._call(self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+        return total
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,23 @@
+import httpx
+import pytest
+from postgrest import AsyncPostgrestClient
+
+from benchmarks.fakes import Faults, create_app
+
+class InProcessPostgrest(AsyncPostgrestClient):
+    """A PostgREST client wired straight to the benchmark fakes' app, no server needed."""
+
+    def __init__(self, app):
+        self.app = app
+        super().__init__("http://fakes/rest/v1")
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None) -> httpx.AsyncClient:
+        return httpx.AsyncClient(base_url=base_url, headers=headers, timeout=timeout, transport=httpx.ASGITransport(app=self.app))
+
+@pytest.fixture
+def db_faults() -> Faults:
+    return Faults()
+
+@pytest.fixture
+def postgrest(db_faults) -> InProcessPostgrest:
+    return InProcessPostgrest(create_app(groq=Faults(), db=db_faults, s3=Faults()))
@@ -0,0 +1,149 @@
+import asyncio
+import os
+
+os.environ.setdefault("TEST_MODE", "1")
+
+from jobs import JobQueue
+
+def _queue(path, handlers, **options) -> JobQueue:
+    options = {"concurrency": 2, "backoff_seconds": 0.01, "sweep_seconds": 0.05, **options}
+    return JobQueue(str(path), handlers=handlers, **options)
+
+async def _wait_for(queue: JobQueue, job_id: str, status: str, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        job = await queue.get(job_id)
+        if job.status == status:
+            return job
+        assert asyncio.get_running_loop().time() < deadline, f"job still {job.status}"
+        await asyncio.sleep(0.01)
+
+def test_failed_stage_is_retried_with_backoff_then_resumed_where_it_failed(tmp_path):
+    calls = []
+
+    async def fetch(state):
+        calls.append("fetch")
+        return {"body": "x" * 100}
+
+    async def flaky(state):
+        calls.append("flaky")
+        if calls.count("flaky") < 3:
+            raise RuntimeError("upstream busy")
+        return {"result": len(state["body"])}
+
+    async def main():
+        queue = _queue(tmp_path / "jobs.sqlite3", {}, max_attempts=3)
+        queue.register("work", [("fetch", fetch), ("flaky", flaky)], keep=("name",))
+        delays = []
+        retry_later = queue._retry_later
+        queue._retry_later = lambda job_id, priority, delay: (delays.append(delay), retry_later(job_id, priority, delay))
+        await queue.start()
+        try:
+            job_id = await queue.enqueue("work", {"name": "a"})
+            job = await _wait_for(queue, job_id, "done")
+        finally:
+            await queue.stop()
+        return job, delays
+
+    job, delays = asyncio.run(main())
+
+    # The first stage isn't repeated when the second one is retried
+    assert calls == ["fetch", "flaky", "flaky", "flaky"]
+    # Exponential: backoff, then twice that
+    assert delays == [0.01, 0.02]
+    # Stage outputs are dropped once the job is done
+    assert job.state == {"name": "a"}
+    assert job.owner is None and job.lease_until is None
+
+def test_job_fails_after_max_attempts_and_calls_on_failure(tmp_path):
+    failures = []
+
+    async def broken(state):
+        raise ValueError("bad recording")
+
+    async def on_failure(state, error):
+        failures.append((state, error))
+
+    async def main():
+        queue = _queue(tmp_path / "jobs.sqlite3", {}, max_attempts=2)
+        queue.register("work", [("broken", broken)], on_failure=on_failure, keep=("log_id",))
+        await queue.start()
+        try:
+            job_id = await queue.enqueue("work", {"log_id": "1", "transcript": "private"})
+            return await _wait_for(queue, job_id, "failed")
+        finally:
+            await queue.stop()
+
+    job = asyncio.run(main())
+
+    assert job.attempts == 2
+    assert "bad recording" in job.error
+    assert job.state == {"log_id": "1"}
+    # The failure handler still sees the whole state
+    assert failures == [({"log_id": "1", "transcript": "private"}, job.error)]
+
+def test_unfinished_job_resumes_in_a_new_process_once_its_lease_lapses(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    handlers = {}
+    started = []
+
+    async def first(state):
+        return {"first": True}
+
+    async def second(state):
+        started.append(state)
+        if len(started) == 1:
+            # The first process dies here
+            await asyncio.sleep(3600)
+        return None
+
+    async def main():
+        before = _queue(path, handlers, lease_seconds=0.3)
+        before.register("work", [("first", first), ("second", second)])
+        await before.start()
+        job_id = await before.enqueue("work", {"name": "a"})
+        while not started:
+            await asyncio.sleep(0.01)
+        # Cancelled without finishing: the row stays running under the old lease
+        await before.stop()
+
+        after = _queue(path, handlers, lease_seconds=0.3)
+        await after.start()
+        try:
+            job = await after.get(job_id)
+            assert job.status == "running" and job.owner == before.owner
+            return await _wait_for(after, job_id, "done")
+        finally:
+            await after.stop()
+
+    asyncio.run(main())
+
+    # Picked up at the stage it stopped in, with the earlier stage's output
+    assert len(started) == 2
+    assert started[1]["first"] is True
+
+def test_queues_sharing_a_store_run_each_job_once(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    handlers = {}
+    runs = []
+
+    async def work(state):
+        runs.append(state["n"])
+        await asyncio.sleep(0.01)
+
+    async def main():
+        queues = [_queue(path, handlers) for _ in range(2)]
+        queues[0].register("work", [("work", work)])
+        for queue in queues:
+            await queue.start()
+        try:
+            ids = [await queues[n % 2].enqueue("work", {"n": n}) for n in range(20)]
+            for job_id in ids:
+                await _wait_for(queues[0], job_id, "done")
+        finally:
+            for queue in queues:
+                await queue.stop()
+
+    asyncio.run(main())
+
+    assert sorted(runs) == list(range(20))
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("TEST_MODE", "1")
+
+from memory import MemoryHandler
+
+def _memory(postgrest, **options) -> MemoryHandler:
+    # A long flush interval so only explicit flushes write, unless a test says otherwise
+    options = {"flush_interval": 3600, **options}
+    return MemoryHandler(SimpleNamespace(postgrest_client=postgrest), **options)
+
+async def _rows(postgrest):
+    rows = (await postgrest.from_("memory").select("role,content").order("timestamp").execute()).data
+    return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+def _contents(messages):
+    return [part.content for message in messages for part in message.parts]
+
+def test_appended_messages_are_served_at_once_and_written_in_one_flush(postgrest):
+    async def main():
+        memory = _memory(postgrest)
+        await memory.get_memory("u", "org", "call")
+        await memory.append_message("u", "org", "user", "what was the refund?", call_id="call")
+        await memory.append_message("u", "org", "bot", "forty dollars", call_id="call")
+
+        served = await memory.get_memory("u", "org", "call")
+        before = await _rows(postgrest)
+        await memory.flush()
+        after = await _rows(postgrest)
+        await memory.close()
+        return served, before, after, memory
+
+    served, before, after, memory = asyncio.run(main())
+
+    assert _contents(served) == ["what was the refund?", "forty dollars"]
+    assert before == []
+    assert after == [{"role": "user", "content": "what was the refund?"}, {"role": "bot", "content": "forty dollars"}]
+    assert memory._cache[("u", "org", "call")].persisted == 2
+
+def test_failed_flush_keeps_the_batch_for_the_next_one(postgrest, db_faults):
+    async def main():
+        memory = _memory(postgrest)
+        await memory.append_message("u", "org", "user", "hello")
+        db_faults.error_rate = 1.0
+        await memory.flush()
+        pending = len(memory._pending)
+        db_faults.error_rate = 0.0
+        await memory.flush()
+        rows = await _rows(postgrest)
+        await memory.close()
+        return pending, rows, memory
+
+    pending, rows, memory = asyncio.run(main())
+
+    assert pending == 1
+    assert rows == [{"role": "user", "content": "hello"}]
+    assert memory._pending == []
+
+def test_cached_conversation_is_reloaded_once_another_worker_writes_to_it(postgrest):
+    async def main():
+        ours = _memory(postgrest, revalidate_seconds=3600)
+        theirs = _memory(postgrest)
+        await ours.get_memory("u", "org", "call")
+
+        await theirs.append_message("u", "org", "user", "from the other worker", call_id="call")
+        await theirs.flush()
+
+        # Within the revalidation window the cached copy is served as is
+        cached = await ours.get_memory("u", "org", "call")
+        ours.revalidate_seconds = 0.0
+        revalidated = await ours.get_memory("u", "org", "call")
+        await ours.close()
+        await theirs.close()
+        return cached, revalidated
+
+    cached, revalidated = asyncio.run(main())
+
+    assert _contents(cached) == []
+    assert _contents(revalidated) == ["from the other worker"]
+
+def test_revalidation_does_not_mistake_our_own_writes_for_someone_elses(postgrest):
+    async def main():
+        memory = _memory(postgrest, revalidate_seconds=0.0)
+        await memory.get_memory("u", "org", "call")
+        await memory.append_message("u", "org", "user", "hi", call_id="call")
+        conversation = memory._cache[("u", "org", "call")]
+        served = await memory.get_memory("u", "org", "call")
+        still_cached = memory._cache[("u", "org", "call")] is conversation
+        await memory.close()
+        return served, still_cached
+
+    served, still_cached = asyncio.run(main())
+
+    assert _contents(served) == ["hi"]
+    assert still_cached
@@ -0,0 +1,66 @@
+import asyncio
+import base64
+import json
+import os
+import uuid
+from types import SimpleNamespace
+
+os.environ.setdefault("TEST_MODE", "1")
+
+import pytest
+
+from database import CountCache, DatabaseHandler, decode_cursor, encode_cursor, keyset_page
+
+def _cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+def test_cursor_round_trips():
+    row = {"created_at": "2025-01-01T10:00:00+00:00", "id": str(uuid.uuid4())}
+
+    assert decode_cursor(encode_cursor(row)) == (row["created_at"], row["id"])
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 at all!",
+    _cursor({"created_at": "2025-01-01T10:00:00+00:00"}),
+    _cursor(["2025-01-01T10:00:00+00:00"]),
+    _cursor(["yesterday", str(uuid.uuid4())]),
+    _cursor(["2025-01-01T10:00:00+00:00", "42"]),
+    # Would otherwise be spliced into the PostgREST or= filter
+    _cursor(['2025-01-01T10:00:00+00:00",organisation_id.neq.x', str(uuid.uuid4())]),
+    _cursor(["2025-01-01T10:00:00+00:00", f"{uuid.uuid4()}),or(id.neq.0"]),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+def test_keyset_pages_through_rows_sharing_a_timestamp(postgrest):
+    tied = "2025-01-01T10:00:00+00:00"
+    rows = [{"id": str(uuid.uuid4()), "organisation_id": "org", "created_at": tied} for _ in range(5)]
+    rows += [
+        {"id": str(uuid.uuid4()), "organisation_id": "org", "created_at": "2025-01-01T09:00:00+00:00"},
+        {"id": str(uuid.uuid4()), "organisation_id": "org", "created_at": "2025-01-01T11:00:00+00:00"},
+    ]
+
+    async def pages():
+        await postgrest.from_("call_logs").insert(rows).execute()
+        seen, cursor = [], None
+        while True:
+            query = postgrest.from_("call_logs").select("id,created_at").eq("organisation_id", "org")
+            page = (await keyset_page(query, 2, cursor).execute()).data
+            seen.extend(row["id"] for row in page[:2])
+            if len(page) <= 2:
+                return seen
+            cursor = encode_cursor(page[1])
+
+    seen = asyncio.run(pages())
+
+    expected = [row["id"] for row in sorted(rows, key=lambda row: (row["created_at"], row["id"]), reverse=True)]
+    assert seen == expected
+
+def test_cursor_with_another_sort_column_is_refused(postgrest):
+    db = DatabaseHandler(SimpleNamespace(postgrest_client=postgrest, log_counts=CountCache(), org_configs=None, users=None))
+    query = postgrest.from_("call_logs").select("*")
+    cursor = encode_cursor({"created_at": "2025-01-01T10:00:00+00:00", "id": str(uuid.uuid4())})
+
+    with pytest.raises(ValueError, match="created_at"):
+        asyncio.run(db.paginate_logs(query, query, "org", limit=10, cursor=cursor, sort_column="caller_name"))
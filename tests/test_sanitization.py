@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+os.environ.setdefault("TEST_MODE", "1")
+
+from redaction import Span
+from santization import SanitizationService
+from transcript import Segment, Transcript, Word
+
+SPOKEN_SSN = "my social is four five six one two three seven eight nine"
+
+def _transcript(text: str, segment_breaks=()) -> Transcript:
+    words = [Word(text=word, start=float(i), end=i + 0.5) for i, word in enumerate(text.split())]
+    cuts = [0, *segment_breaks, len(words)]
+    segments = [
+        Segment(text=" ".join(w.text for w in words[a:b]), start=words[a].start, end=words[b - 1].end)
+        for a, b in zip(cuts, cuts[1:])
+    ]
+    return Transcript(segments=segments, words=words)
+
+def test_spoken_ssn_is_masked_in_text_segments_and_words():
+    service = SanitizationService(groq_client=None, mode="fast")
+    transcript = _transcript(SPOKEN_SSN)
+
+    sanitized, redacted = asyncio.run(service.sanitize_transcript(transcript))
+
+    assert sanitized == "my social is XXX-XX-3789"
+    assert redacted.segments[0].text == "my social is XXX-XX-3789"
+    assert [w.text for w in redacted.words] == ["my", "social", "is", *["XXXX"] * 2, "XXX", "XXX", "XXX", "XXXXX", "XXXXX", "XXXXX", "XXXX"]
+    # Timings are kept
+    assert [w.start for w in redacted.words] == [w.start for w in transcript.words]
+
+def test_span_across_segments_is_masked_in_both():
+    service = SanitizationService(groq_client=None, mode="fast")
+    transcript = _transcript(SPOKEN_SSN, segment_breaks=[6])
+
+    _, redacted = asyncio.run(service.sanitize_transcript(transcript))
+
+    assert "four" not in redacted.segments[0].text and "five" not in redacted.segments[0].text
+    assert not any(digit in redacted.segments[1].text for digit in ("one", "two", "three", "seven", "eight", "nine"))
+
+def test_model_found_spans_reach_the_words():
+    service = SanitizationService(groq_client=None, mode="windowed")
+    transcript = _transcript("my passport is alpha bravo charlie thanks")
+    text = transcript.text
+    start = text.index("alpha")
+    # As reported by a windowed review; the rule engine alone wouldn't find this
+    span = Span(start, start + len("alpha bravo charlie"), "government_id", 0.9, "XXXXX XXXXX XXXXXXX")
+
+    redacted = service.redact_transcript(transcript, [span])
+
+    assert redacted.segments[0].text == "my passport is XXXXX XXXXX XXXXXXX thanks"
+    assert [w.text for w in redacted.words] == ["my", "passport", "is", "XXXXX", "XXXXX", "XXXXXXX", "thanks"]
@@ -0,0 +1,50 @@
+import pytest
+
+from transcript import Segment, Transcript, Word
+
+def _chunk(words, segment_size=3) -> Transcript:
+    words = [Word(text=text, start=start, end=end) for text, start, end in words]
+    segments = [
+        Segment(text=" ".join(w.text for w in words[i:i + segment_size]), start=words[i].start, end=words[min(i + segment_size, len(words)) - 1].end)
+        for i in range(0, len(words), segment_size)
+    ]
+    return Transcript(segments=segments, words=words)
+
+# Two chunks that both heard 8s-10s; the seam sits in the middle of the overlap
+FIRST = _chunk([("one", 6.0, 6.6), ("two", 7.0, 7.6), ("three", 8.0, 8.6), ("four", 8.7, 9.5), ("five", 9.6, 10.0)])
+SECOND = _chunk([("three", 8.0, 8.6), ("four", 8.7, 9.5), ("five", 9.6, 10.2), ("six", 10.4, 11.0), ("seven", 11.2, 11.8)])
+SEAM = 9.0
+
+def test_overlap_is_emitted_once():
+    stitched = Transcript.stitch([FIRST, SECOND], [SEAM])
+
+    assert [w.text for w in stitched.words] == ["one", "two", "three", "four", "five", "six", "seven"]
+
+def test_word_goes_to_the_chunk_holding_its_midpoint():
+    # "four" spans the seam (8.7-9.5) but its midpoint, 9.1, is after it
+    first = FIRST.slice(None, SEAM)
+    second = SECOND.slice(SEAM, None)
+
+    assert [w.text for w in first.words] == ["one", "two", "three"]
+    assert [w.text for w in second.words] == ["four", "five", "six", "seven"]
+
+def test_word_midpoint_on_the_seam_belongs_to_the_later_chunk():
+    first = _chunk([("a", 8.0, 8.5), ("b", 8.5, 9.5)])
+    second = _chunk([("b", 8.5, 9.5), ("c", 9.6, 10.0)])
+
+    stitched = Transcript.stitch([first, second], [9.0])
+
+    assert [w.text for w in stitched.words] == ["a", "b", "c"]
+
+def test_segment_across_the_seam_is_rebuilt_from_its_kept_words():
+    stitched = Transcript.stitch([FIRST, SECOND], [SEAM])
+
+    # FIRST's second segment (four five) and SECOND's first (three four five) both cross 9.0
+    assert [s.text for s in stitched.segments] == ["one two three", "four five", "six seven"]
+    assert stitched.segments[1].start == SEAM
+    assert stitched.segments[0].end <= SEAM
+    assert stitched.text == "one two three four five six seven"
+
+def test_stitch_needs_one_seam_per_pair_of_chunks():
+    with pytest.raises(ValueError):
+        Transcript.stitch([FIRST, SECOND], [])
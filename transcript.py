@@ -0,0 +1,125 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+@dataclass
+class Word:
+    text: str
+    start: float
+    end: float
+
+    @property
+    def mid(self) -> float:
+        return (self.start + self.end) / 2
+
+@dataclass
+class Segment:
+    text: str
+    start: float
+    end: float
+
+@dataclass
+class Transcript:
+    """
+    Whisper output with absolute timings. Segments carry the punctuated text, words
+    carry the fine-grained timestamps used to cut cleanly at chunk seams.
+    """
+    segments: List[Segment] = field(default_factory=list)
+    words: List[Word] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return " ".join(s.text.strip() for s in self.segments if s.text.strip())
+
+    @property
+    def duration(self) -> float:
+        return self.segments[-1].end if self.segments else 0.0
+
+    @classmethod
+    def from_verbose_json(cls, result: Any, offset: float = 0.0) -> "Transcript":
+        """Builds a transcript from a verbose_json transcription, shifted by `offset` seconds."""
+        def get(obj, name, default=None):
+            return obj.get(name, default) if isinstance(obj, dict) else getattr(obj, name, default)
+
+        segments = [
+            Segment(text=get(s, "text", ""), start=get(s, "start") + offset, end=get(s, "end") + offset)
+            for s in get(result, "segments") or []
+        ]
+        words = [
+            Word(text=get(w, "word", "").strip(), start=get(w, "start") + offset, end=get(w, "end") + offset)
+            for w in get(result, "words") or []
+        ]
+        if not segments and get(result, "text"):
+            # Provider returned plain text only, keep it as a single untimed segment
+            segments = [Segment(text=get(result, "text"), start=offset, end=offset)]
+        return cls(segments=segments, words=words)
+
+    def slice(self, start: Optional[float], end: Optional[float]) -> "Transcript":
+        """
+        Keeps what falls in [start, end). Words are assigned by their midpoint. A segment
+        that straddles a bound is rebuilt from its words on the kept side, so the same
+        speech is never emitted twice when two overlapping chunks are stitched.
+        """
+        lo = float("-inf") if start is None else start
+        hi = float("inf") if end is None else end
+
+        words = [w for w in self.words if lo <= w.mid < hi]
+        segments = []
+        for s in self.segments:
+            if s.end <= lo or s.start >= hi:
+                continue
+            if lo <= s.start and s.end <= hi:
+                segments.append(s)
+                continue
+            inner = [w for w in words if s.start <= w.mid <= s.end]
+            if inner:
+                segments.append(Segment(
+                    text=" ".join(w.text for w in inner),
+                    start=max(s.start, lo),
+                    end=min(s.end, hi),
+                ))
+            elif lo <= (s.start + s.end) / 2 < hi:
+                segments.append(s)
+        return Transcript(segments=segments, words=words)
+
+    @classmethod
+    def stitch(cls, chunks: List["Transcript"], seams: List[float]) -> "Transcript":
+        """Joins chunk transcripts, cutting chunk i at seams[i - 1] and seams[i]."""
+        if len(seams) != len(chunks) - 1:
+            raise ValueError("Expected one seam between each pair of chunks")
+        bounds = [None, *seams, None]
+        merged = cls()
+        for i, chunk in enumerate(chunks):
+            part = chunk.slice(bounds[i], bounds[i + 1])
+            merged.segments.extend(part.segments)
+            merged.words.extend(part.words)
+        return merged
+
+    def to_columns(self) -> Dict[str, Dict[str, list]]:
+        """Columnar form for JSONB storage; far smaller than a list of objects."""
+        return {
+            "segments": {
+                "start": [round(s.start, 2) for s in self.segments],
+                "end": [round(s.end, 2) for s in self.segments],
+                "text": [s.text.strip() for s in self.segments],
+            },
+            "words": {
+                "start": [round(w.start, 2) for w in self.words],
+                "end": [round(w.end, 2) for w in self.words],
+                "text": [w.text for w in self.words],
+            },
+        }
+
+    @classmethod
+    def from_columns(cls, data: Dict[str, Dict[str, list]]) -> "Transcript":
+        segments = data.get("segments") or {}
+        words = data.get("words") or {}
+        return cls(
+            segments=[
+                Segment(text=t, start=s, end=e)
+                for t, s, e in zip(segments.get("text", []), segments.get("start", []), segments.get("end", []))
+            ],
+            words=[
+                Word(text=t, start=s, end=e)
+                for t, s, e in zip(words.get("text", []), words.get("start", []), words.get("end", []))
+            ],
+        )
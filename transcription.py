@@ -1,87 +1,201 @@
 import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from typing import List
-from agents import async_groq_client
-import boto3
+from typing import List, Optional, Tuple
+import logfire
 from pydub import AudioSegment
-from settings import Settings
+from pydub.silence import detect_silence
+from services import get_settings
+from transcript import Transcript
+from cache import ResultCache, digest
 
-settings = Settings()
+settings = get_settings()
+
+_encode_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_encode_pool() -> ProcessPoolExecutor:
+    global _encode_pool
+    if _encode_pool is None:
+        # Forking a process that already runs the S3, bcrypt and to_thread pools can
+        # deadlock on a lock some thread held; forkserver children start clean
+        _encode_pool = ProcessPoolExecutor(
+            max_workers=settings.transcription_encode_workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _encode_pool
+
+def shutdown_encode_pool() -> None:
+    global _encode_pool
+    if _encode_pool is not None:
+        _encode_pool.shutdown(wait=False, cancel_futures=True)
+        _encode_pool = None
+
+def _encode_chunk(raw: bytes, sample_width: int, frame_rate: int, channels: int) -> bytes:
+    """Encodes raw PCM to a compact mono MP3. Runs in a worker process."""
+    segment = AudioSegment(data=raw, sample_width=sample_width, frame_rate=frame_rate, channels=channels)
+    # Whisper resamples to 16 kHz mono anyway, so there's no point uploading more
+    segment = segment.set_channels(1).set_frame_rate(16000)
+    buf = BytesIO()
+    segment.export(buf, format="mp3", bitrate=TranscriptionService.CHUNK_BITRATE)
+    return buf.getvalue()
+
+class TranscriptionError(Exception):
+    pass
 
 class TranscriptionService:
     MAX_CHUNK_SIZE_MB = 5
-    
-    def __init__(self, bucket_name: str):
-        self.groq_client = async_groq_client
-        self.s3 = boto3.client(
-            "s3",
-            aws_access_key_id=settings.aws_access_key,
-            aws_secret_access_key=settings.aws_secret_access_key,
-            # region_name="us-east-1"  # Adjust region as needed
-        )
-        self.bucket = bucket_name
-    
+    MAX_CHUNK_SECONDS = 120
+    CHUNK_BITRATE = "64k"
+    # How far back from the ideal cut point to look for a pause
+    SILENCE_SEARCH_MS = 15_000
+    MIN_SILENCE_MS = 400
+    # Each chunk also includes this much audio before its cut so seams can be deduplicated
+    OVERLAP_MS = 2000
+    MODEL = "whisper-large-v3-turbo"
+
+    def __init__(self, groq_client, storage, cache: Optional[ResultCache] = None):
+        self.groq_client = groq_client
+        self.storage = storage
+        self.cache = cache
+        self.max_retries = settings.transcription_max_retries
+        self._semaphore = asyncio.Semaphore(settings.transcription_concurrency)
+
     async def transcribe(self, filename: str, prompt: str = "") -> str:
+        transcript = await self.transcribe_detailed(filename, prompt)
+        return transcript.text
 
-        response = self.s3.get_object(Bucket=self.bucket, Key=filename)
-        audio_bytes = response["Body"].read()
-        
-        # Load audio from bytes
-        audio = AudioSegment.from_file(BytesIO(audio_bytes))
-        
-        # Check if chunking is needed
+    async def transcribe_audio(self, audio_bytes: bytes, filename: str, prompt: str = "") -> str:
+        """Transcribes audio that is already in memory, e.g. a short voice prompt, without going through S3."""
+        transcript = await self._transcribe_bytes(filename, audio_bytes, prompt)
+        return transcript.text
+
+    @logfire.instrument("transcription", extract_args=False)
+    async def transcribe_detailed(self, filename: str, prompt: str = "") -> Transcript:
+
+        audio_bytes = await self.storage.get_bytes(filename)
+
+        if self.cache is None:
+            return await self._transcribe_bytes(filename, audio_bytes, prompt)
+
+        # Same recording under another name, or a reprocess, skips Whisper entirely
+        audio_hash = await asyncio.to_thread(digest, audio_bytes)
+        return await self.cache.get_or_compute(
+            "transcription",
+            [audio_hash, self.MODEL, prompt, self._chunking_version()],
+            lambda: self._transcribe_bytes(filename, audio_bytes, prompt),
+            dumps=lambda transcript: json.dumps(transcript.to_columns()),
+            loads=lambda value: Transcript.from_columns(json.loads(value)),
+        )
+
+    def _chunking_version(self) -> str:
+        return f"{self.MAX_CHUNK_SIZE_MB}:{self.MAX_CHUNK_SECONDS}:{self.CHUNK_BITRATE}:{self.OVERLAP_MS}"
+
+    async def _transcribe_bytes(self, filename: str, audio_bytes: bytes, prompt: str) -> Transcript:
+        # Check if chunking is needed before paying for a full decode
         if len(audio_bytes) <= self.MAX_CHUNK_SIZE_MB * 1024 * 1024:
             print("[Info] File size within limits, processing as single chunk")
             # Create a properly named BytesIO for the whole file
             audio_stream = BytesIO(audio_bytes)
             audio_stream.name = filename  # Set the name attribute
-            return await self._transcribe_chunk(audio_stream, prompt)
-        
-        # File is too large, chunk it
-        chunks = self._chunk_audio_to_memory(audio)
-        
-        tasks = [self._transcribe_chunk(chunk, prompt) for chunk in chunks]
+            return await self._transcribe_with_retry(audio_stream, prompt, label=filename, offset=0.0)
+
+        # File is too large, decode and split it on pauses
+        audio, spans = await asyncio.to_thread(self._plan_chunks, audio_bytes)
+        del audio_bytes
+
+        tasks = [self._process_chunk(audio, i, start, end, prompt) for i, (start, end) in enumerate(spans)]
         results = await asyncio.gather(*tasks)
-        self.s3.delete_object(Bucket=self.bucket, Key=filename)  # Clean up the original file
-        return "\n".join(results)
-    
-    def _chunk_audio_to_memory(self, audio: AudioSegment) -> List[BytesIO]:
+
+        # Cut in the middle of each overlap, where both neighbouring chunks heard the full audio
+        seams = [(start - self.OVERLAP_MS / 2) / 1000 for start, _ in spans[1:]]
+        return Transcript.stitch(results, seams)
+
+    def _plan_chunks(self, audio_bytes: bytes) -> Tuple[AudioSegment, List[Tuple[int, int]]]:
+        audio = AudioSegment.from_file(BytesIO(audio_bytes))
+        return audio, self._split_points(audio)
+
+    def _split_points(self, audio: AudioSegment) -> List[Tuple[int, int]]:
+        """Returns (start_ms, end_ms) spans that end on a pause where one exists."""
         max_bytes = self.MAX_CHUNK_SIZE_MB * 1024 * 1024
-        bytes_per_ms_est = (len(audio.raw_data) / len(audio))  # size per ms
-        chunk_duration = int(max_bytes / bytes_per_ms_est)
-        
-        chunks = [
-            audio[i:i + chunk_duration] for i in range(0, len(audio), chunk_duration)
-        ]
-        
-        byte_chunks = []
-        for i, chunk in enumerate(chunks):
-            buf = BytesIO()
-            chunk.export(buf, format="mp3")  # ensure valid format
-            buf.seek(0)
-            buf.name = f"chunk_{i}.mp3"  # Set the name attribute with proper extension
-            byte_chunks.append(buf)
-            print(f"[Chunking] Exported chunk {i} to mp3 ({buf.getbuffer().nbytes / (1024 * 1024):.2f} MB)")
-        
-        return byte_chunks
-    
-    async def _transcribe_chunk(self, audio_stream: BytesIO, prompt: str) -> str:
-        
+        bytes_per_ms = int(self.CHUNK_BITRATE.rstrip("k")) * 1000 / 8 / 1000
+        target_ms = int(min(self.MAX_CHUNK_SECONDS * 1000, max_bytes / bytes_per_ms))
+        silence_thresh = audio.dBFS - 16
+
+        spans = []
+        start = 0
+        while len(audio) - start > target_ms:
+            ideal = start + target_ms
+            window_start = max(start + target_ms // 2, ideal - self.SILENCE_SEARCH_MS)
+            silences = detect_silence(
+                audio[window_start:ideal],
+                min_silence_len=self.MIN_SILENCE_MS,
+                silence_thresh=silence_thresh,
+                seek_step=10,
+            )
+            if silences:
+                # Cut in the middle of the last pause before the ideal point
+                quiet_start, quiet_end = silences[-1]
+                cut = window_start + (quiet_start + quiet_end) // 2
+            else:
+                cut = ideal
+            spans.append((start, cut))
+            start = cut
+        spans.append((start, len(audio)))
+        return spans
+
+    async def _process_chunk(self, audio: AudioSegment, index: int, start: int, end: int, prompt: str) -> Transcript:
+        if index > 0:
+            start = max(0, start - self.OVERLAP_MS)
+        segment = audio[start:end]
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(
+            _get_encode_pool(),
+            _encode_chunk,
+            segment.raw_data,
+            segment.sample_width,
+            segment.frame_rate,
+            segment.channels,
+        )
+        buf = BytesIO(encoded)
+        buf.name = f"chunk_{index}.mp3"  # Set the name attribute with proper extension
+        logfire.debug(
+            "Encoded chunk {index} ({start_s}s-{end_s}s, {size_mb} MB)",
+            index=index, start_s=start / 1000, end_s=end / 1000, size_mb=round(len(encoded) / (1024 * 1024), 2),
+        )
+        return await self._transcribe_with_retry(buf, prompt, label=buf.name, offset=start / 1000)
+
+    async def _transcribe_with_retry(self, audio_stream: BytesIO, prompt: str, label: str, offset: float) -> Transcript:
+        # One attempt plus max_retries retries, counted like SchedulingTransport's
+        attempts = max(0, self.max_retries) + 1
+        for attempt in range(1, attempts + 1):
+            try:
+                async with self._semaphore:
+                    result = await self._transcribe_chunk(audio_stream, prompt)
+                return Transcript.from_verbose_json(result, offset=offset)
+            except Exception as e:
+                logfire.warn(
+                    "Transcription of {label} failed (attempt {attempt}/{attempts}): {error!r}",
+                    label=label, attempt=attempt, attempts=attempts, error=e,
+                )
+                if attempt == attempts:
+                    raise TranscriptionError(f"Transcription of {label} failed after {attempt} attempts") from e
+                await asyncio.sleep(2 ** attempt)
+
+    async def _transcribe_chunk(self, audio_stream: BytesIO, prompt: str):
+
         # Ensure the stream is at the beginning
         audio_stream.seek(0)
-        
-        try:
-            result = await self.groq_client.audio.transcriptions.create(
-                file=audio_stream,
-                model="whisper-large-v3-turbo",
-                prompt=prompt,
-                response_format="verbose_json",
-                timestamp_granularities=["word", "segment"],
-                language="en",
-                temperature=0.0
-            )
-            return result.text
-        except Exception as e:
-            print(f"[Error] Transcription failed: {str(e)}")
-            # You might want to return empty string or raise depending on your needs
-            return ""
+
+        result = await self.groq_client.audio.transcriptions.create(
+            file=audio_stream,
+            model=self.MODEL,
+            prompt=prompt,
+            response_format="verbose_json",
+            timestamp_granularities=["word", "segment"],
+            language="en",
+            temperature=0.0
+        )
+        return result